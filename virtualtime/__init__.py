@@ -3,6 +3,7 @@
 """Implements a system for simulating a virtual time (based on an offset from the current actual time) so that all Python objects believe it though the actual system time remains the same"""
 
 import sys
+import collections
 import threading
 import types
 import time
@@ -30,13 +31,15 @@ except ImportError as e:
       def wraps(f, *args, **kw):
           return f
 
-# Try and import pandas before patching datetime, else it gets upset
+# Packages like pandas must be loaded with the original datetime type in place, else they get upset.
+# From Python 3.4, import_hook takes care of this whenever they are first imported; before that, pandas is imported now
 # Import errors are ignored so that this is safe to do when they are not present
 
-try:
-    import pandas
-except ImportError as e:
-    pass
+if sys.version_info < (3, 4):
+    try:
+        import pandas
+    except ImportError as e:
+        pass
 
 TIME_CHANGE_LOG_LEVEL = logging.CRITICAL
 MAX_CALLBACK_TIME = 1.0
@@ -55,11 +58,23 @@ _virtual_time_state = threading.Condition()
 __virtual_time_enabled = False
 # In PyPy (as of 1.6) on all platforms, and CPython (as of 2.7.1) on Windows, datetime.datetime.[utc]now calls time.time()
 _datetime_now_uses_time = ("PyPy" in sys.version or sys.platform == 'win32')
+# Python 3.3 replaced the global import lock with per-module locks, so the ImportErrors that datetime methods can raise while
+# another thread holds the import lock (see test_importlock_thread_issue) only happen before that, and the methods that
+# guard against them are only installed where they are needed
+_import_lock_errors_possible = sys.version_info < (3, 3)
 _virtual_time_notify_events = WeakSet()
 _virtual_time_callback_events = WeakSet()
 _fast_forward_delay_events = WeakSet()
+_virtual_time_change_listeners = []
 _in_skip_time_change = False
 _time_offset = 0
+# incremented on every change to the offset, so that caches of derived values can cheaply check whether they are still valid
+_offset_generation = 0
+
+# Describes a change to the virtual time offset, as passed to change listeners
+# When a fast forward finishes, a final change is sent with is_fast_forward_complete set, and previous_offset as the offset it started at
+OffsetChange = collections.namedtuple('OffsetChange', ['offset', 'previous_offset', 'is_fast_forward_change', 'is_fast_forward_complete'])
+OffsetChange.__new__.__defaults__ = (False,)
 
 def _repair_year(s1, s2, y1, y2, year):
     """takes two strings differing only by year, and replaces their years (which must be 4-digit) with a new one"""
@@ -81,6 +96,66 @@ def _repair_year(s1, s2, y1, y2, year):
     t += s1[i:]
     return t
 
+# directives that may render the year in a way that can't be substituted directly (locale-dependent, or alternative eras)
+_YEAR_OPAQUE_DIRECTIVES = frozenset(['%c', '%x', '%+', '%E', '%O'])
+# directives that render the year (or a part of it that differs between years 400 apart)
+_YEAR_DIRECTIVES = frozenset(['%Y', '%G', '%C', '%F'])
+
+def _year_number_format(flags, width, default_padding='0'):
+    """returns the %-format that renders a number as a numeric strftime directive with the given GNU flags and width does"""
+    padding = ([flag for flag in flags if flag in '-_0'] or [default_padding])[-1]
+    if not width:
+        return "%d"
+    # - only drops the padding when there is no explicit width; with one, it pads with spaces like _
+    return ("%0" if padding == '0' else "%") + width + "d"
+
+def _parse_year_format(format):
+    """splits format into a tuple of (literal, year_directive, number_format) pieces, with an empty directive on the last
+    piece, returning whether format also contains directives that need the year to be repaired after formatting, and the pieces"""
+    pieces, start, needs_repair = [], 0, False
+    for m in alt_time_funcs.directive_re.finditer(format):
+        flags, width, modifier, conversion = m.groups()
+        directive = '%' + conversion
+        if modifier or directive in _YEAR_OPAQUE_DIRECTIVES:
+            needs_repair = True
+        elif directive == '%F':
+            # %F is %Y-%m-%d with the width beyond the month and day applied to the year, padded with spaces by default
+            year_width = str(int(width) - 6) if width and int(width) > 6 else ''
+            pieces.append((format[start:m.start()], directive, _year_number_format(flags, year_width, '_')))
+            start = m.end()
+        elif directive in _YEAR_DIRECTIVES:
+            pieces.append((format[start:m.start()], directive, _year_number_format(flags, width)))
+            start = m.end()
+    pieces.append((format[start:], '', ''))
+    return needs_repair, tuple(pieces)
+
+_year_format_cache = alt_time_funcs.FormatCache(_parse_year_format)
+
+def _substitute_year(format, year, month, day):
+    """Returns format with the year directives replaced by their rendering for the given date, so that the rest of it can be
+    rendered using a year in the same position of the 400-year Gregorian cycle, and whether the year still needs to be
+    repaired in the rendered result, as the format includes it in a way that can't be substituted"""
+    needs_repair, pieces = _year_format_cache.get(format)
+    if len(pieces) == 1:
+        return format, needs_repair
+    parts = []
+    for literal, directive, number_format in pieces:
+        parts.append(literal)
+        if directive == '%Y':
+            parts.append(number_format % year)
+        elif directive == '%F':
+            parts.append(number_format % year + "-%m-%d")
+        elif directive == '%C':
+            parts.append(number_format % (year // 100))
+        elif directive == '%G':
+            shifted_year = _shift_year(year)
+            parts.append(number_format % (_underlying_date_type(shifted_year, month, day).isocalendar()[0] - shifted_year + year))
+    return ''.join(parts), needs_repair
+
+def _shift_year(year):
+    """returns the first year from 1900 onwards that is a whole number of 400-year Gregorian cycles after year"""
+    return year + 400 * ((1900 - year + 399) // 400) if year < 1900 else year
+
 def _fixed_strftime(format, when_tuple=None):
     """Overlayed form of time.strftime() that allows dates before 1900 or 1000, if Python's is broken"""
     if when_tuple is None:
@@ -88,27 +163,33 @@ def _fixed_strftime(format, when_tuple=None):
     elif when_tuple[0] < _STRFTIME_MIN_YEAR:
         # Python datetime doesn't support formatting dates before 1900 or 1000, depending on Python version.
         # Since the Gregorian calendar has a cycle of 400 years, flip the date into the future
-        # and adjust the year directly in the format string
-        year = orig_year = when_tuple[0]
-        while year < 1900: year += 400
-        d1 = (year,) + when_tuple[1:]
-        d2 = (year+400,)+ when_tuple[1:]
-        s1 = _underlying_strftime(format, d1)
-        s2 = _underlying_strftime(format, d2)
-        return _repair_year(s1, s2, year, year+400, orig_year)
+        # and put the year directly in the format string
+        year = _shift_year(when_tuple[0])
+        year_format, needs_repair = _substitute_year(format, when_tuple[0], when_tuple[1], when_tuple[2])
+        if not needs_repair:
+            return _underlying_strftime(year_format, (year,) + tuple(when_tuple[1:]))
+        # the format includes the year in a way we can't predict, so render it twice and repair the year in the output
+        s1 = _underlying_strftime(year_format, (year,) + tuple(when_tuple[1:]))
+        s2 = _underlying_strftime(year_format, (year+400,) + tuple(when_tuple[1:]))
+        return _repair_year(s1, s2, year, year+400, when_tuple[0])
     return _underlying_strftime(format, when_tuple)
 
 _has_pre_1900_bug = _has_pre_1000_bug = True
 _STRFTIME_MIN_YEAR = 1900
-try:
-    _underlying_strftime("%Y-%m-%d", (1800,1,1,0,0,0,2,1,0))
-    _has_pre_1900_bug = False
-    _STRFTIME_MIN_YEAR = 1000
-    _underlying_strftime("%Y-%m-%d", (800,1,1,0,0,0,5,1,0))
-    _has_pre_1000_bug = False
+if sys.version_info >= (3, 3) and not sys.platform.startswith('win'):
+    # since Python 3.3 time.strftime accepts any year from 1 on these platforms, so there's no need to probe it at import
+    _has_pre_1900_bug = _has_pre_1000_bug = False
     _STRFTIME_MIN_YEAR = 0
-except ValueError:
-    pass
+else:
+    try:
+        _underlying_strftime("%Y-%m-%d", (1800,1,1,0,0,0,2,1,0))
+        _has_pre_1900_bug = False
+        _STRFTIME_MIN_YEAR = 1000
+        _underlying_strftime("%Y-%m-%d", (800,1,1,0,0,0,5,1,0))
+        _has_pre_1000_bug = False
+        _STRFTIME_MIN_YEAR = 0
+    except ValueError:
+        pass
 
 if _has_pre_1900_bug or _has_pre_1000_bug:
     _original_strftime = _fixed_strftime
@@ -165,6 +246,33 @@ def undo_delay_fast_forward_until_set(event):
     finally:
         _virtual_time_state.release()
 
+def _add_change_listener(listener):
+    """adds a function that will be called with an OffsetChange (while the virtual time state is locked) whenever the offset changes.
+    Listeners should be quick, and unlike notify_on_change events are held by a strong reference until removed"""
+    _virtual_time_state.acquire()
+    try:
+        if listener not in _virtual_time_change_listeners:
+            _virtual_time_change_listeners.append(listener)
+    finally:
+        _virtual_time_state.release()
+
+def _remove_change_listener(listener):
+    """removes a function added with _add_change_listener"""
+    _virtual_time_state.acquire()
+    try:
+        if listener in _virtual_time_change_listeners:
+            _virtual_time_change_listeners.remove(listener)
+    finally:
+        _virtual_time_state.release()
+
+def _dispatch_change(change):
+    """calls the change listeners with the given OffsetChange - must be called with _virtual_time_state held"""
+    for listener in list(_virtual_time_change_listeners):
+        try:
+            listener(change)
+        except Exception:
+            logging.exception("Virtual time change listener %r failed", listener)
+
 def in_skip_time_change():
     """Indicates whether the offset change is a fast_forward or not"""
     _virtual_time_state.acquire()
@@ -177,12 +285,72 @@ def _virtual_time():
     """Overlayed form of time.time() that adds _time_offset"""
     return _original_time() + _time_offset
 
+# whether the local time tuple and strings formatted from it are cached for the current virtual second - see enable_time_cache
+_time_cache_enabled = False
+_current_second = None
+_MAX_CACHED_FORMATS = 64
+
+class _SecondValues(object):
+    """the local time tuple of a single virtual second, and the strings formatted from it"""
+    __slots__ = ('second', 'generation', 'tzname', 'localtime', '_asctime', '_formats')
+    def __init__(self, second, generation, tzname):
+        self.second = second
+        self.generation = generation
+        self.tzname = tzname
+        self.localtime = _original_localtime(second)
+        self._asctime = None
+        self._formats = {}
+
+    def asctime(self):
+        """time.ctime(second) is defined as time.asctime(time.localtime(second)), so this serves both"""
+        if self._asctime is None:
+            self._asctime = _original_asctime(self.localtime)
+        return self._asctime
+
+    def strftime(self, format):
+        result = self._formats.get(format)
+        if result is None:
+            result = _original_strftime(format, self.localtime)
+            if len(self._formats) < _MAX_CACHED_FORMATS:
+                self._formats[format] = result
+        return result
+
+def _current_second_values():
+    """returns the cached values for the current virtual second, replacing them if the second, the offset or the timezone has changed"""
+    global _current_second
+    # read the generation before the offset, so that a concurrent change can only make the new values look stale, not the reverse
+    generation = _offset_generation
+    now = _original_time() + _time_offset
+    second = int(now)
+    if second > now:
+        second -= 1
+    values = _current_second
+    if values is None or values.second != second or values.generation != generation or values.tzname is not time.tzname:
+        values = _current_second = _SecondValues(second, generation, time.tzname)
+    return values
+
+def enable_time_cache():
+    """Caches the results of time.localtime(), time.strftime(format), time.asctime() and time.ctime() for the current virtual second,
+    so that repeated calls within the same second don't repeat the conversion. The cache is discarded when the offset or timezone changes"""
+    global _time_cache_enabled
+    _time_cache_enabled = True
+
+def disable_time_cache():
+    """Stops caching the current virtual second's local time - see enable_time_cache"""
+    global _time_cache_enabled, _current_second
+    _time_cache_enabled = False
+    _current_second = None
+
 def _virtual_asctime(when_tuple=None):
     """Overlayed form of time.asctime() that adds _time_offset"""
+    if when_tuple is None and _time_cache_enabled:
+        return _current_second_values().asctime()
     return _original_asctime(_virtual_localtime() if when_tuple is None else when_tuple)
 
 def _virtual_ctime(when=None):
     """Overlayed form of time.ctime() that adds _time_offset"""
+    if when is None and _time_cache_enabled:
+        return _current_second_values().asctime()
     return _original_ctime(_virtual_time() if when is None else when)
 
 def _virtual_gmtime(when=None):
@@ -191,10 +359,14 @@ def _virtual_gmtime(when=None):
 
 def _virtual_localtime(when=None):
     """Overlayed form of time.localtime() that adds _time_offset"""
+    if when is None and _time_cache_enabled:
+        return _current_second_values().localtime
     return _original_localtime(_virtual_time() if when is None else when)
 
 def _virtual_strftime(format, when_tuple=None):
     """Overlayed form of time.strftime() that adds _time_offset"""
+    if when_tuple is None and _time_cache_enabled:
+        return _current_second_values().strftime(format)
     return _original_strftime(format, _virtual_localtime() if when_tuple is None else when_tuple)
 
 def _virtual_sleep(seconds):
@@ -230,100 +402,117 @@ _original_datetime_module = datetime_module
 _underlying_datetime_type = _original_datetime_module.datetime
 _underlying_date_type = _original_datetime_module.date
 _underlying_time_type = _original_datetime_module.time
+_underlying_datetime_now = _underlying_datetime_type.now
+_underlying_datetime_utcnow = _underlying_datetime_type.utcnow
 
 # this date class doesn't actually adjust dates to reflect the virtual time offset, but does prevent ImportErrors
-# we don't patch this at present
+# virtual_date below is based on it, and stands in for datetime.date in modules that virtual time is scoped to
 class date_no_importerror(_original_datetime_module.date):
-    def __new__(cls, *args, **kwargs):
-        if args and isinstance(args[0], _underlying_date_type):
-            dt = args[0]
-        else:
-            dt = _underlying_date_type.__new__(cls, *args, **kwargs)
-        newargs = list(_safe_datetuple_3(dt))
-        return _underlying_date_type.__new__(cls, *newargs)
+    if _import_lock_errors_possible:
+        def __new__(cls, *args, **kwargs):
+            if args and isinstance(args[0], _underlying_date_type):
+                dt = args[0]
+            else:
+                dt = _underlying_date_type.__new__(cls, *args, **kwargs)
+            newargs = list(_safe_datetuple_3(dt))
+            return _underlying_date_type.__new__(cls, *newargs)
 
-    @classmethod
-    def today(cls):
-        try:
-            return _underlying_date_type.today()
-        except ImportError:
-            now = alt_time_funcs.alt_get_local_datetime()
-            return _underlying_date_type.__new__(cls, now.year, now.month, now.day)
+        @classmethod
+        def today(cls):
+            try:
+                return _underlying_date_type.today()
+            except ImportError:
+                now = alt_time_funcs.alt_get_local_datetime()
+                return _underlying_date_type.__new__(cls, now.year, now.month, now.day)
 
-    def timetuple(self):
-        """Return a time.struct_time such as returned by time.localtime().
+        def timetuple(self):
+            """Return a time.struct_time such as returned by time.localtime().
 
-        d.timetuple() is equivalent to time.struct_time((d.year, d.month, d.day, 0, 0, 0, d.weekday(), yday, -1)),
-        where yday = d.toordinal() - date(d.year, 1, 1).toordinal() + 1 is the day number within the current year starting with 1 for January 1st.
-        """
-        try:
-            return _underlying_date_type.timetuple(self)
-        except ImportError:
-            yday = self.toordinal() - datetime_module.date(self.year, 1, 1).toordinal() + 1
-            return (self.year, self.month, self.day, 0, 0, 0, self.weekday(), yday, -1)
+            d.timetuple() is equivalent to time.struct_time((d.year, d.month, d.day, 0, 0, 0, d.weekday(), yday, -1)),
+            where yday = d.toordinal() - date(d.year, 1, 1).toordinal() + 1 is the day number within the current year starting with 1 for January 1st.
+            """
+            try:
+                return _underlying_date_type.timetuple(self)
+            except ImportError:
+                yday = self.toordinal() - datetime_module.date(self.year, 1, 1).toordinal() + 1
+                return (self.year, self.month, self.day, 0, 0, 0, self.weekday(), yday, -1)
 
-    def strftime(self, format_str):
-        """Adjusted version of datetime's strftime that handles dates before 1900 or 1000, if python's is broken"""
-        # Also handles ImportErrors if the datetime module produces them, falling back to the time.strftime implementation
-        try:
-            return _underlying_date_type.strftime(self, format_str)
-        except ImportError:
-            yday = self.toordinal() - datetime_module.date(self.year, 1, 1).toordinal() + 1
-            format_str = alt_time_funcs.adjust_strftime(self, format_str)
-            return _underlying_strftime(format_str, (self.year, self.month, self.day, 0, 0, 0, self.weekday(), yday, -1))
+        def strftime(self, format_str):
+            """Adjusted version of datetime's strftime that handles dates before 1900 or 1000, if python's is broken"""
+            # Also handles ImportErrors if the datetime module produces them, falling back to the time.strftime implementation
+            try:
+                return _underlying_date_type.strftime(self, format_str)
+            except ImportError:
+                yday = self.toordinal() - datetime_module.date(self.year, 1, 1).toordinal() + 1
+                format_str = alt_time_funcs.adjust_strftime(self, format_str)
+                return _underlying_strftime(format_str, (self.year, self.month, self.day, 0, 0, 0, self.weekday(), yday, -1))
+    else:
+        def __new__(cls, *args, **kwargs):
+            if args and isinstance(args[0], _underlying_date_type):
+                dt = args[0]
+                return _underlying_date_type.__new__(cls, dt.year, dt.month, dt.day)
+            return _underlying_date_type.__new__(cls, *args, **kwargs)
 
 # this time class doesn't actually adjust times to reflect the virtual time offset, but does prevent ImportErrors
 # we don't patch this at present
 class time_no_importerror(_original_datetime_module.time):
-    def strftime(self, format_str):
-        """Adjusted version of datetime's strftime that handles dates before 1900 or 1000, if python's is broken"""
-        # Also handles ImportErrors if the datetime module produces them, falling back to the time.strftime implementation
-        try:
-            return _underlying_time_type.strftime(self, format_str)
-        except ImportError:
-            format_str = alt_time_funcs.adjust_strftime(self, format_str)
-            # copy what datetimemodule.c does to produce a time tuple with standard date
-            return _underlying_strftime(format_str, (1900, 1, 1, self.hour, self.minute, self.second, 0, 1, -1))
+    if _import_lock_errors_possible:
+        def strftime(self, format_str):
+            """Adjusted version of datetime's strftime that handles dates before 1900 or 1000, if python's is broken"""
+            # Also handles ImportErrors if the datetime module produces them, falling back to the time.strftime implementation
+            try:
+                return _underlying_time_type.strftime(self, format_str)
+            except ImportError:
+                format_str = alt_time_funcs.adjust_strftime(self, format_str)
+                # copy what datetimemodule.c does to produce a time tuple with standard date
+                return _underlying_strftime(format_str, (1900, 1, 1, self.hour, self.minute, self.second, 0, 1, -1))
 
-_virtual_datetime_attrs = dict(_underlying_datetime_type.__dict__.items())
 class datetime(_original_datetime_module.datetime):
-    def __new__(cls, *args, **kwargs):
-        if args and isinstance(args[0], _underlying_datetime_type):
-            dt = args[0]
-        else:
-            dt = _underlying_datetime_type.__new__(cls, *args, **kwargs)
-        newargs = list(_safe_timetuple_6(dt))+[dt.microsecond, dt.tzinfo]
-        return _underlying_datetime_type.__new__(cls, *newargs)
-
-    def timetuple(self):
-        """Return a time.struct_time such as returned by time.localtime().
-
-        d.timetuple() is equivalent to time.struct_time((d.year, d.month, d.day, d.hour, d.minute, d.second, d.weekday(), yday, dst)),
-        where yday = d.toordinal() - date(d.year, 1, 1).toordinal() + 1 is the day number within the current year starting with 1 for January 1st.
-        The tm_isdst flag of the result is set according to the dst() method:
-        * tzinfo is None or dst() returns None, tm_isdst is set to -1
-        * else if dst() returns a non-zero value, tm_isdst is set to 1
-        * else tm_isdst is set to 0.
-        """
-        try:
-            return _underlying_datetime_type.timetuple(self)
-        except ImportError:
-            dst = -1 if self.tzinfo is None else (1 if self.tzinfo.dst(self) else 0)
-            yday = self.toordinal() - datetime_module.date(self.year, 1, 1).toordinal() + 1
-            return (self.year, self.month, self.day, self.hour, self.minute, self.second, self.weekday(), yday, dst)
-
-    def utctimetuple(self):
-        """Return UTC time tuple, compatible with time.localtime()."""
-        try:
-            return _underlying_datetime_type.utctimetuple(self)
-        except ImportError:
-            if self.tzinfo is not None:
-                offset = self.tzinfo.dst(self)
-                utc_self = self + datetime_module.timedelta(seconds=offset)
+    if _import_lock_errors_possible:
+        def __new__(cls, *args, **kwargs):
+            if args and isinstance(args[0], _underlying_datetime_type):
+                dt = args[0]
             else:
-                utc_self = self
-            yday = utc_self.toordinal() - datetime_module.date(utc_self.year, 1, 1).toordinal() + 1
-            return (utc_self.year, utc_self.month, utc_self.day, utc_self.hour, utc_self.minute, utc_self.second, utc_self.weekday(), yday, 0)
+                dt = _underlying_datetime_type.__new__(cls, *args, **kwargs)
+            newargs = list(_safe_timetuple_6(dt))+[dt.microsecond, dt.tzinfo]
+            return _underlying_datetime_type.__new__(cls, *newargs)
+
+        def timetuple(self):
+            """Return a time.struct_time such as returned by time.localtime().
+
+            d.timetuple() is equivalent to time.struct_time((d.year, d.month, d.day, d.hour, d.minute, d.second, d.weekday(), yday, dst)),
+            where yday = d.toordinal() - date(d.year, 1, 1).toordinal() + 1 is the day number within the current year starting with 1 for January 1st.
+            The tm_isdst flag of the result is set according to the dst() method:
+            * tzinfo is None or dst() returns None, tm_isdst is set to -1
+            * else if dst() returns a non-zero value, tm_isdst is set to 1
+            * else tm_isdst is set to 0.
+            """
+            try:
+                return _underlying_datetime_type.timetuple(self)
+            except ImportError:
+                dst = -1 if self.tzinfo is None else (1 if self.tzinfo.dst(self) else 0)
+                yday = self.toordinal() - datetime_module.date(self.year, 1, 1).toordinal() + 1
+                return (self.year, self.month, self.day, self.hour, self.minute, self.second, self.weekday(), yday, dst)
+
+        def utctimetuple(self):
+            """Return UTC time tuple, compatible with time.localtime()."""
+            try:
+                return _underlying_datetime_type.utctimetuple(self)
+            except ImportError:
+                if self.tzinfo is not None:
+                    offset = self.tzinfo.dst(self)
+                    utc_self = self + datetime_module.timedelta(seconds=offset)
+                else:
+                    utc_self = self
+                yday = utc_self.toordinal() - datetime_module.date(utc_self.year, 1, 1).toordinal() + 1
+                return (utc_self.year, utc_self.month, utc_self.day, utc_self.hour, utc_self.minute, utc_self.second, utc_self.weekday(), yday, 0)
+    else:
+        # the timetuple methods of the underlying type can't fail, so only a single construction is needed here
+        def __new__(cls, *args, **kwargs):
+            if args and isinstance(args[0], _underlying_datetime_type):
+                dt = args[0]
+                return _underlying_datetime_type.__new__(cls, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond, dt.tzinfo)
+            return _underlying_datetime_type.__new__(cls, *args, **kwargs)
 
     def _fixed_strftime(self, format_str):
         """Adjusted version of datetime's strftime that handles dates before 1900 or 1000, if python's is broken"""
@@ -332,19 +521,25 @@ class datetime(_original_datetime_module.datetime):
         if getattr(self, "year", 2000) < _STRFTIME_MIN_YEAR:
             # Python datetime doesn't support formatting dates before 1900/1000 (depending on Python version).
             # Since the Gregorian calendar has a cycle of 400 years, flip the date into the future
-            # and adjust the year directly in the format string
-            year = self.year
-            while year < 1900: year += 400
-            d1 = self.replace(year=year)
-            d2 = self.replace(year=year+400)
+            # and put the year directly in the format string
+            year = _shift_year(self.year)
+            d1 = _underlying_datetime_type(year, self.month, self.day, self.hour, self.minute, self.second, self.microsecond, self.tzinfo)
+            year_format, needs_repair = _substitute_year(format_str, self.year, self.month, self.day)
+            if not needs_repair:
+                try:
+                    return _underlying_datetime_type.strftime(d1, year_format)
+                except ImportError:
+                    return _underlying_strftime(alt_time_funcs.adjust_strftime(d1, year_format), datetime.timetuple(d1))
+            # the format includes the year in a way we can't predict, so render it twice and repair the year in the output
+            d2 = _underlying_datetime_type(year+400, self.month, self.day, self.hour, self.minute, self.second, self.microsecond, self.tzinfo)
             try:
-                s1 = _underlying_datetime_type.strftime(d1, format_str)
+                s1 = _underlying_datetime_type.strftime(d1, year_format)
             except ImportError:
-                s1 = _underlying_strftime(alt_time_funcs.adjust_strftime(d1, format_str), datetime.timetuple(d1))
+                s1 = _underlying_strftime(alt_time_funcs.adjust_strftime(d1, year_format), datetime.timetuple(d1))
             try:
-                s2 = _underlying_datetime_type.strftime(d2, format_str)
+                s2 = _underlying_datetime_type.strftime(d2, year_format)
             except ImportError:
-                s2 = _underlying_strftime(alt_time_funcs.adjust_strftime(d2, format_str), datetime.timetuple(d2))
+                s2 = _underlying_strftime(alt_time_funcs.adjust_strftime(d2, year_format), datetime.timetuple(d2))
             return _repair_year(s1, s2, year, year+400, self.year)
         try:
             return _underlying_datetime_type.strftime(self, format_str)
@@ -449,27 +644,45 @@ class datetime(_original_datetime_module.datetime):
             return r
 
 class virtual_datetime(datetime):
-    @classmethod
-    def now(cls, tz=None):
-        """Virtualized datetime.datetime.now()"""
-        try:
-            dt = _original_datetime_now(tz=tz)
-        except ImportError:
-            dt = alt_time_funcs.alt_get_local_datetime(tz=tz)
-        dt = dt + _original_datetime_module.timedelta(seconds=_time_offset)
-        newargs = list(_safe_timetuple_6(dt))+[dt.microsecond, dt.tzinfo]
-        return _original_datetime_type.__new__(cls, *newargs)
+    if _import_lock_errors_possible or _datetime_now_uses_time:
+        @classmethod
+        def now(cls, tz=None):
+            """Virtualized datetime.datetime.now()"""
+            try:
+                dt = _original_datetime_now(tz=tz)
+            except ImportError:
+                dt = alt_time_funcs.alt_get_local_datetime(tz=tz)
+            dt = dt + _original_datetime_module.timedelta(seconds=_time_offset)
+            newargs = list(_safe_timetuple_6(dt))+[dt.microsecond, dt.tzinfo]
+            return _original_datetime_type.__new__(cls, *newargs)
 
-    @classmethod
-    def utcnow(cls):
-        """Virtualized datetime.datetime.utcnow()"""
-        try:
-            dt = _original_datetime_utcnow()
-        except ImportError:
-            dt = alt_time_funcs.alt_get_utc_datetime()
-        dt = dt + _original_datetime_module.timedelta(seconds=_time_offset)
-        newargs = list(_safe_timetuple_6(dt))+[dt.microsecond, dt.tzinfo]
-        return _original_datetime_type.__new__(cls, *newargs)
+        @classmethod
+        def utcnow(cls):
+            """Virtualized datetime.datetime.utcnow()"""
+            try:
+                dt = _original_datetime_utcnow()
+            except ImportError:
+                dt = alt_time_funcs.alt_get_utc_datetime()
+            dt = dt + _original_datetime_module.timedelta(seconds=_time_offset)
+            newargs = list(_safe_timetuple_6(dt))+[dt.microsecond, dt.tzinfo]
+            return _original_datetime_type.__new__(cls, *newargs)
+    else:
+        # works on the underlying type throughout, and only constructs an instance of cls at the end
+        @classmethod
+        def now(cls, tz=None):
+            """Virtualized datetime.datetime.now()"""
+            dt = _underlying_datetime_now(tz)
+            if _time_offset:
+                dt = dt + _original_datetime_module.timedelta(seconds=_time_offset)
+            return _underlying_datetime_type.__new__(cls, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond, dt.tzinfo)
+
+        @classmethod
+        def utcnow(cls):
+            """Virtualized datetime.datetime.utcnow()"""
+            dt = _underlying_datetime_utcnow()
+            if _time_offset:
+                dt = dt + _original_datetime_module.timedelta(seconds=_time_offset)
+            return _underlying_datetime_type.__new__(cls, dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond)
 
 _original_datetime_type = datetime
 _original_datetime_now = _original_datetime_type.now
@@ -479,101 +692,194 @@ datetime_module.datetime = datetime
 _virtual_datetime_now = _virtual_datetime_type.now
 _virtual_datetime_utcnow = _virtual_datetime_type.utcnow
 
+class _virtual_date_meta(type):
+    """virtual_date stands in for datetime.date, so every date instance and date subclass should match it"""
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, _underlying_date_type)
+
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, _underlying_date_type)
+
+# the date returned by virtual_date.today(), memoized as (offset generation, time.tzname, virtual time of the next local midnight, date)
+_today_cache = None
+
+def _virtual_date_today(cls):
+    """Virtualized datetime.date.today(), which only converts the time again after local midnight, or a change to the offset or timezone"""
+    global _today_cache
+    # read the generation before the offset, so that a concurrent change can only make the memoized date look stale
+    generation = _offset_generation
+    now = _original_time() + _time_offset
+    cache = _today_cache
+    if cache is not None and cache[0] == generation and cache[1] is time.tzname and now < cache[2] and cls is _virtual_date_type:
+        return cache[3]
+    t = _original_localtime(now)
+    # virtual_date itself hands out plain dates, so that its results pickle and compare like those of datetime.date.today()
+    today = _underlying_date_type(t[0], t[1], t[2]) if cls is _virtual_date_type else _underlying_date_type.__new__(cls, t[0], t[1], t[2])
+    if cls is _virtual_date_type:
+        next_midnight = time.mktime((t[0], t[1], t[2] + 1, 0, 0, 0, 0, 0, -1))
+        _today_cache = (generation, time.tzname, next_midnight, today)
+    return today
+
+# calling the metaclass directly works the same way on Python 2 and 3
+virtual_date = _virtual_date_meta('virtual_date', (date_no_importerror,), {
+    '__doc__': "Stands in for datetime.date where the datetime module isn't patched, with a virtualized and memoized today()",
+    '__module__': __name__,
+    'today': classmethod(_virtual_date_today),
+})
+_virtual_date_type = virtual_date
+
 # NB: This helper function is a copy of j5.Basic.TimeUtils.totalseconds_float, but is here to prevent circular import - changes should be applied to both
 def totalseconds_float(timedelta):
     """Return the total number of seconds represented by a datetime.timedelta object, including fractions of seconds"""
     return timedelta.seconds + (timedelta.days * 24 * 60 * 60) + timedelta.microseconds/1000000.0
 
+_EPOCH_ORDINAL = _underlying_date_type(1970, 1, 1).toordinal()
+
+def _naive_seconds(dt):
+    """returns the seconds since 1970-01-01 00:00:00 of the fields of dt, ignoring any timezone and microseconds"""
+    return (dt.toordinal() - _EPOCH_ORDINAL) * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+
+def _struct_seconds(t):
+    """returns the seconds since 1970-01-01 00:00:00 of the fields of the time tuple t, as calendar.timegm does"""
+    return (_underlying_date_type(t[0], t[1], t[2]).toordinal() - _EPOCH_ORDINAL) * 86400 + t[3] * 3600 + t[4] * 60 + t[5]
+
+# maps each local hour (as hours since the epoch in naive local time) to the local utc offset for that whole hour,
+# or None if it is within an hour of a transition; cleared when time.tzset() changes the timezone
+_local_hour_offsets = {}
+_local_hour_offsets_tzname = None
+_LOCAL_HOUR_OFFSETS_SIZE = 100000
+
+def _local_hour_offset(local_hour):
+    """returns the utc offset of local time for the whole of the given local hour, or None if it isn't unique"""
+    global _local_hour_offsets_tzname
+    if time.tzname is not _local_hour_offsets_tzname:
+        _local_hour_offsets.clear()
+        _local_hour_offsets_tzname = time.tzname
+    try:
+        return _local_hour_offsets[local_hour]
+    except KeyError:
+        pass
+    local_seconds = local_hour * 3600
+    try:
+        t = int(time.mktime(_original_gmtime(local_seconds)[:8] + (-1,)))
+        before = _struct_seconds(_original_localtime(t - 3600)) - (t - 3600)
+        after = _struct_seconds(_original_localtime(t + 7199)) - (t + 7199)
+        offset = before if before == after and local_seconds - before == t else None
+    except (OverflowError, ValueError):
+        offset = None
+    if len(_local_hour_offsets) >= _LOCAL_HOUR_OFFSETS_SIZE:
+        _local_hour_offsets.clear()
+    _local_hour_offsets[local_hour] = offset
+    return offset
+
 def local_datetime_to_time(dt):
-    """converts a naive datetime object to a local time float"""
-    return time.mktime(dt.timetuple()) + dt.microsecond * 0.000001
+    """converts a naive local datetime object to a time.time()-equivalent float"""
+    local_seconds = _naive_seconds(dt)
+    offset = _local_hour_offset(local_seconds // 3600)
+    if offset is None:
+        # near a daylight savings transition, so leave the choice of interpretation to mktime
+        return time.mktime(dt.timetuple()) + dt.microsecond * 0.000001
+    return local_seconds - offset + dt.microsecond * 0.000001
 
 def utc_datetime_to_time(dt):
-    """converts a naive utc datetime object to a local time float"""
-    return time.mktime(dt.utctimetuple()) + dt.microsecond * 0.000001 - (time.altzone if time.daylight else time.timezone)
-
-def set_offset(new_offset, suppress_log=False, is_fast_forward_change=False):
-    """Sets the current time offset to the given value"""
-    global _time_offset
-    global _in_skip_time_change
+    """converts a naive utc datetime object (or an aware datetime) to a time.time()-equivalent float"""
+    if dt.tzinfo is not None:
+        offset = dt.utcoffset()
+        if offset is not None:
+            dt = dt - offset
+    return _naive_seconds(dt) + dt.microsecond * 0.000001
+
+# the tracer that records how long offset changes and fast forward waits take, if tracing has been started - see tracing.py
+_tracer = None
+
+def _traced_wait(event, timeout, name):
+    """event.wait(timeout), recorded as a span of the given name if tracing"""
+    tracer = _tracer
+    if tracer is None:
+        return event.wait(timeout)
+    start = tracer.now()
     try:
-        _virtual_time_state.acquire()
-        try:
+        return event.wait(timeout)
+    finally:
+        tracer.complete(name, start, {"event": repr(event)})
+
+def _change_offset(new_offset, is_fast_forward_change=False, suppress_log=False, relative_to_now=False, skip_time_change=True,
+                   log_message="Virtual time offset adjusted from %r to %r at %r"):
+    """Shared implementation of set_offset, set_time and restore_time. Changes the offset and notifies everything waiting on it
+    in a single pass while holding _virtual_time_state, then does the logging and waiting for callbacks outside the lock.
+    If relative_to_now is set, new_offset is a time.time()-equivalent value rather than an offset"""
+    global _time_offset, _in_skip_time_change, _offset_generation
+    tracer = _tracer
+    if tracer is not None:
+        trace_start = tracer.now()
+    generation = None
+    _virtual_time_state.acquire()
+    try:
+        if skip_time_change:
             _in_skip_time_change = not is_fast_forward_change
-            original_offset = _time_offset
-            _time_offset = new_offset
-            if not suppress_log:
-                logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time offset adjusted from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
+        original_offset = _time_offset
+        if relative_to_now:
+            new_offset = new_offset - _original_time()
+        # the overlays go back in before the offset leaves zero, and come out after it returns there - see enable_adaptive_patching
+        if _adaptive_patching and new_offset:
+            _set_adaptive_raw(False)
+        _time_offset = new_offset
+        if _adaptive_patching and not new_offset:
+            _set_adaptive_raw(True)
+        _offset_generation += 1
+        if _virtual_time_callback_events:
             callback_events = list(_virtual_time_callback_events)
             for event in callback_events:
                 event.clear()
-            _virtual_time_state.notify_all()
+        else:
+            callback_events = ()
+        generation = _offset_generation
+        _virtual_time_state.notify_all()
+        if _virtual_time_notify_events:
             for event in _virtual_time_notify_events:
-                event.set()
-        finally:
-            _virtual_time_state.release()
+                # events that haven't been cleared since the last change don't need setting again, which saves taking their locks
+                if not event.is_set():
+                    event.set()
+        if _virtual_time_change_listeners:
+            _dispatch_change(OffsetChange(_time_offset, original_offset, is_fast_forward_change))
+        new_offset = _time_offset
+    finally:
+        _virtual_time_state.release()
+    try:
+        # logging.log configures logging if nothing else has, so the message is only skipped if logging has been set up to drop it
+        if not suppress_log and (not logging.root.handlers or logging.root.isEnabledFor(TIME_CHANGE_LOG_LEVEL)):
+            logging.log(TIME_CHANGE_LOG_LEVEL, log_message, original_offset, new_offset, _original_datetime_now())
         for event in callback_events:
-            if not event.wait(MAX_CALLBACK_TIME):
+            if not _traced_wait(event, MAX_CALLBACK_TIME, "callback wait"):
                 logging.warning("Virtual time callback was not received in %r seconds at %r", MAX_CALLBACK_TIME, _original_datetime_now())
     finally:
-        _virtual_time_state.acquire()
-        try:
-            _in_skip_time_change = False
-        finally:
-            _virtual_time_state.release()
+        # the lock is only taken again if the flag is still set, and a change that has started since then owns it
+        if skip_time_change and _in_skip_time_change:
+            _virtual_time_state.acquire()
+            try:
+                if generation is None or _offset_generation == generation:
+                    _in_skip_time_change = False
+            finally:
+                _virtual_time_state.release()
+        if tracer is not None:
+            # new_offset is still a time for set_time if the change didn't go through, so the offset in effect is recorded
+            tracer.complete("fast_forward step" if is_fast_forward_change else "set_offset", trace_start, {"offset": _time_offset})
+
+def set_offset(new_offset, suppress_log=False, is_fast_forward_change=False):
+    """Sets the current time offset to the given value"""
+    _change_offset(new_offset, is_fast_forward_change=is_fast_forward_change, suppress_log=suppress_log)
 
 def get_offset():
     global _time_offset
     return _time_offset
 
-def set_time(new_time, is_fast_forward_change=False):
+def set_time(new_time, is_fast_forward_change=False, suppress_log=False):
     """Sets the current time to the given time.time()-equivalent value"""
-    global _time_offset
-    global _in_skip_time_change
-    try:
-        _virtual_time_state.acquire()
-        try:
-            _in_skip_time_change = not is_fast_forward_change
-            original_offset = _time_offset
-            _time_offset = new_time - _original_time()
-            logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time offset adjusted from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
-            callback_events = list(_virtual_time_callback_events)
-            for event in callback_events:
-                event.clear()
-            _virtual_time_state.notify_all()
-            for event in _virtual_time_notify_events:
-                event.set()
-        finally:
-            _virtual_time_state.release()
-        for event in callback_events:
-            if not event.wait(MAX_CALLBACK_TIME):
-                logging.warning("Virtual time callback was not received in %r seconds at %r", MAX_CALLBACK_TIME, _original_datetime_now())
-    finally:
-        _virtual_time_state.acquire()
-        try:
-            _in_skip_time_change = False
-        finally:
-            _virtual_time_state.release()
+    _change_offset(new_time, is_fast_forward_change=is_fast_forward_change, suppress_log=suppress_log, relative_to_now=True)
 
 def restore_time():
     """Reverts to real time operation"""
-    global _time_offset
-    _virtual_time_state.acquire()
-    try:
-        original_offset = _time_offset
-        _time_offset = 0
-        logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time offset restored from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
-        callback_events = list(_virtual_time_callback_events)
-        for event in callback_events:
-            event.clear()
-        _virtual_time_state.notify_all()
-        for event in _virtual_time_notify_events:
-            event.set()
-    finally:
-        _virtual_time_state.release()
-    for event in callback_events:
-        if not event.wait(MAX_CALLBACK_TIME):
-            logging.warning("Virtual time callback was not received in %r seconds at %r", MAX_CALLBACK_TIME, _original_datetime_now())
+    _change_offset(0, skip_time_change=False, log_message="Virtual time offset restored from %r to %r at %r")
 
 def set_local_datetime(dt):
     """Sets the current time using the given naive local datetime object"""
@@ -583,59 +889,241 @@ def set_utc_datetime(dt):
     """Sets the current time using the given naive utc datetime object"""
     set_time(utc_datetime_to_time(dt))
 
-def fast_forward_time(delta=None, target=None, step_size=1.0, step_wait=0.01, log_every=3600):
-    """Moves through time to the target time or by the given delta amount, at the specified step pace, with small waits at each step. By default will log at delay events or every hour"""
-    if (delta is None and target is None) or (delta is not None and target is not None):
-        raise ValueError("Must specify exactly one of delta and target")
+def _get_fast_forward_delay_events():
+    """returns a snapshot of the delay events, only taking the lock if there are any"""
+    if not _fast_forward_delay_events:
+        return ()
     _virtual_time_state.acquire()
     try:
-        original_offset = _time_offset
-        if target is not None:
-            delta = target - original_offset - _original_time()
-        logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time commencing fastforward from %r to %r at %r", original_offset, original_offset + delta, _original_datetime_now())
+        return list(_fast_forward_delay_events)
     finally:
         _virtual_time_state.release()
-    _original_sleep(step_wait)
-    if delta < 0:
-        step_size = -step_size
-    steps, part = divmod(delta, step_size)
-    last_log = -1
-    for step in range(1, int(steps)+1):
-        _virtual_time_state.acquire()
+
+class FastForwardHandle(object):
+    """Runs a fast forward through time, either synchronously or on a worker thread, and allows it to be
+    monitored, paused, resumed, cancelled and re-paced while it is in progress"""
+    def __init__(self, delta=None, target=None, step_size=1.0, step_wait=0.01, log_every=3600, controller=None, control_interval=1.0):
+        if (delta is None and target is None) or (delta is not None and target is not None):
+            raise ValueError("Must specify exactly one of delta and target")
+        self.delta = delta
+        self.target = target
+        self.step_size = step_size
+        self.step_wait = step_wait
+        self.log_every = log_every
+        self.controller = controller
+        self.control_interval = control_interval
+        self.start_offset = None
+        self.end_offset = None
+        self.current_offset = None
+        self.steps_done = 0
+        self.remaining_steps = None
+        self.cancelled = False
+        self.error = None
+        self.thread = None
+        self._new_step_size = None
+        self._resume_event = threading.Event()
+        self._resume_event.set()
+        self._done_event = threading.Event()
+        self._started_at = None
+        self._paused_at = None
+        self._paused_duration = 0.0
+
+    def start(self):
+        """Starts the fast forward on a daemon worker thread, returning this handle"""
+        if self.thread is not None:
+            raise ValueError("This fast forward has already been started")
+        self.thread = threading.Thread(target=self._run_in_thread, name="virtualtime_fast_forward")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _run_in_thread(self):
         try:
-            delay_events = list(_fast_forward_delay_events)
-        finally:
-            _virtual_time_state.release()
+            self.run()
+        except Exception as e:
+            self.error = e
+            logging.exception("Virtual time fastforward failed at offset %r", _time_offset)
+
+    def pause(self):
+        """Stops the fast forward before its next step, until resume() or cancel() is called"""
+        if self._resume_event.is_set():
+            self._paused_at = _original_time()
+            self._resume_event.clear()
+
+    def resume(self):
+        """Continues a paused fast forward"""
+        if not self._resume_event.is_set():
+            if self._paused_at is not None:
+                self._paused_duration += _original_time() - self._paused_at
+                self._paused_at = None
+            self._resume_event.set()
+
+    def cancel(self):
+        """Stops the fast forward before its next step, leaving the offset where it has reached"""
+        self.cancelled = True
+        self.resume()
+
+    @property
+    def paused(self):
+        return not self._resume_event.is_set()
+
+    def set_step_size(self, step_size):
+        """Changes the (positive) step size used for the remaining steps of the fast forward"""
+        if step_size <= 0:
+            raise ValueError("step_size must be positive")
+        self._new_step_size = step_size
+
+    def done(self):
+        return self._done_event.is_set()
+
+    def join(self, timeout=None):
+        """Waits for the fast forward to finish, returning whether it has"""
+        return self._done_event.wait(timeout)
+
+    @property
+    def elapsed(self):
+        """The wall clock time spent actively fast forwarding, excluding time spent paused"""
+        if self._started_at is None:
+            return 0.0
+        paused_duration = self._paused_duration
+        if self._paused_at is not None:
+            paused_duration += _original_time() - self._paused_at
+        return _original_time() - self._started_at - paused_duration
+
+    @property
+    def steps_per_second(self):
+        elapsed = self.elapsed
+        return self.steps_done / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        """Estimated wall clock seconds until the fast forward completes, at the current throughput (None if unknown)"""
+        if self.done():
+            return 0.0
+        steps_per_second = self.steps_per_second
+        if self.remaining_steps is None or not steps_per_second:
+            return None
+        return self.remaining_steps / steps_per_second
+
+    def _wait_for_delay_events(self, step, last_log):
+        delay_events = _get_fast_forward_delay_events()
         message_logged = (last_log != step-1)
         for delay_event in delay_events:
             delay_time = MAX_DELAY_TIME
-            if not message_logged and delay_time >= step_wait:
+            if not message_logged and delay_time >= self.step_wait:
                 # try a minimal wait, and log if a larger delay is happening
-                if delay_event.wait(step_wait):
+                if _traced_wait(delay_event, self.step_wait, "delay_event wait"):
                     continue
                 else:
                     logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time fastforward offset at %r waiting for delay_event at %r", _time_offset, _original_datetime_now())
                     message_logged, last_log = True, step
-                    delay_time -= step_wait
-            if not delay_event.wait(delay_time):
+                    delay_time -= self.step_wait
+            if not _traced_wait(delay_event, delay_time, "delay_event wait"):
                 logging.warning("A delay_event %r was not set despite waiting %0.2f seconds - continuing to travel through time...", delay_event, MAX_DELAY_TIME)
-        set_offset(original_offset + step*step_size, suppress_log=True, is_fast_forward_change=True)
-        if log_every and step - last_log == log_every:
-            logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time fastforward offset at %r at %r", _time_offset, _original_datetime_now())
-            last_log = step
-        _original_sleep(step_wait)
-    if part != 0:
+        return last_log
+
+    def _control(self):
+        """Calls the controller if it is due, and picks up any change in step size"""
+        if self.controller is not None and _original_time() - self._last_control >= self.control_interval:
+            self._last_control = _original_time()
+            self.controller(self)
+
+    def _sleep_step_wait(self):
+        tracer = _tracer
+        if tracer is None:
+            _original_sleep(self.step_wait)
+        else:
+            start = tracer.now()
+            _original_sleep(self.step_wait)
+            tracer.complete("step_wait", start)
+
+    def run(self):
+        """Runs the fast forward synchronously in the calling thread"""
+        tracer = _tracer
+        if tracer is not None:
+            trace_start = tracer.now()
+        try:
+            self._run()
+        finally:
+            self._done_event.set()
+            if tracer is not None:
+                tracer.complete("fast_forward", trace_start, {"start_offset": self.start_offset, "end_offset": self.end_offset, "steps": self.steps_done})
+
+    def _run(self):
         _virtual_time_state.acquire()
         try:
-            delay_events = list(_fast_forward_delay_events)
+            original_offset = _time_offset
+            delta = self.delta
+            if self.target is not None:
+                delta = self.target - original_offset - _original_time()
+            logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time commencing fastforward from %r to %r at %r", original_offset, original_offset + delta, _original_datetime_now())
         finally:
             _virtual_time_state.release()
-        for delay_event in delay_events:
-            if not delay_event.wait(MAX_DELAY_TIME):
-                logging.warning("A delay_event %r was not set despite waiting %0.2f seconds - continuing to travel through time...", delay_event, MAX_DELAY_TIME)
-        set_offset(original_offset + delta, suppress_log=True, is_fast_forward_change=True)
-        _original_sleep(step_wait)
-    logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time completed fastforward from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
+        self.start_offset = self.current_offset = original_offset
+        self.end_offset = original_offset + delta
+        self._started_at = self._last_control = _original_time()
+        self._sleep_step_wait()
+        # offsets are calculated from an anchor rather than accumulated, so that float errors don't build up;
+        # the anchor moves whenever the step size is changed
+        anchor_offset, anchor_step = original_offset, 0
+        step_size = -self.step_size if delta < 0 else self.step_size
+        steps, part = divmod(delta, step_size)
+        steps = int(steps)
+        self.remaining_steps = steps + (1 if part != 0 else 0)
+        last_log = -1
+        step = 0
+        while step - anchor_step < steps:
+            self._resume_event.wait()
+            if self.cancelled:
+                break
+            if self._new_step_size is not None:
+                self.step_size, self._new_step_size = self._new_step_size, None
+                anchor_offset, anchor_step = self.current_offset, step
+                step_size = -self.step_size if delta < 0 else self.step_size
+                steps, part = divmod(self.end_offset - anchor_offset, step_size)
+                steps = int(steps)
+                self.remaining_steps = steps + (1 if part != 0 else 0)
+                continue
+            step += 1
+            last_log = self._wait_for_delay_events(step, last_log)
+            self.current_offset = anchor_offset + (step - anchor_step)*step_size
+            set_offset(self.current_offset, suppress_log=True, is_fast_forward_change=True)
+            self.steps_done, self.remaining_steps = step, self.remaining_steps - 1
+            if self.log_every and step - last_log == self.log_every:
+                logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time fastforward offset at %r at %r", _time_offset, _original_datetime_now())
+                last_log = step
+            self._sleep_step_wait()
+            self._control()
+        if part != 0:
+            self._resume_event.wait()
+        if part != 0 and not self.cancelled:
+            for delay_event in _get_fast_forward_delay_events():
+                if not _traced_wait(delay_event, MAX_DELAY_TIME, "delay_event wait"):
+                    logging.warning("A delay_event %r was not set despite waiting %0.2f seconds - continuing to travel through time...", delay_event, MAX_DELAY_TIME)
+            self.current_offset = self.end_offset
+            set_offset(self.current_offset, suppress_log=True, is_fast_forward_change=True)
+            self.steps_done, self.remaining_steps = step + 1, 0
+            self._sleep_step_wait()
+        _virtual_time_state.acquire()
+        try:
+            if _virtual_time_change_listeners:
+                _dispatch_change(OffsetChange(_time_offset, original_offset, True, True))
+        finally:
+            _virtual_time_state.release()
+        if self.cancelled:
+            logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time cancelled fastforward from %r to %r at %r at %r", original_offset, self.end_offset, _time_offset, _original_datetime_now())
+        else:
+            logging.log(TIME_CHANGE_LOG_LEVEL, "Virtual time completed fastforward from %r to %r at %r", original_offset, _time_offset, _original_datetime_now())
+
+def fast_forward_time(delta=None, target=None, step_size=1.0, step_wait=0.01, log_every=3600):
+    """Moves through time to the target time or by the given delta amount, at the specified step pace, with small waits at each step. By default will log at delay events or every hour"""
+    FastForwardHandle(delta=delta, target=target, step_size=step_size, step_wait=step_wait, log_every=log_every).run()
+
+def start_fast_forward_time(delta=None, target=None, step_size=1.0, step_wait=0.01, log_every=3600, controller=None, control_interval=1.0):
+    """Starts fast_forward_time on a background thread, returning a FastForwardHandle that can be used to monitor, pause, resume or cancel it.
+    If given, controller(handle) is called at most every control_interval seconds between steps, and may adjust the step size or pause/cancel"""
+    return FastForwardHandle(delta=delta, target=target, step_size=step_size, step_wait=step_wait, log_every=log_every,
+                             controller=controller, control_interval=control_interval).start()
 
 def fast_forward_timedelta(delta, step_size=1.0, step_wait=0.01):
     """Moves through time by the given datetime.timedelta amount, at the specified step pace, with small waits at each step"""
@@ -666,35 +1154,190 @@ def fast_forward_utc_datetime(target, step_size=1.0, step_wait=0.01):
 
 # Functions to patch and unpatch date/time modules
 
+class PatchTarget(object):
+    """A clock entry point that virtual time replaces: the attribute of owner (a module or class), which is original
+    while virtual time is disabled and virtual while it is enabled. group names the patch function that handles it.
+    adaptive targets only differ from the original by the offset, so adaptive patching can leave the original in place while it is zero"""
+    def __init__(self, name, owner, attribute, original, virtual, group=None, adaptive=False):
+        self.name = name
+        self.owner = owner
+        self.attribute = attribute
+        self.original = original
+        self.virtual = virtual
+        self.group = group
+        self.adaptive = adaptive
+        self.patched = False
+
+    def __repr__(self):
+        return "<PatchTarget %s (%s)>" % (self.name, "virtual" if self.patched else "orig")
+
+    def patch(self):
+        setattr(self.owner, self.attribute, self.original if self.adaptive and _adaptive_raw else self.virtual)
+
+    def unpatch(self):
+        setattr(self.owner, self.attribute, self.original)
+
+    def state(self):
+        """Examines the owner rather than trusting the patched flag, returning 'orig', 'virtual' or 'unexpected'.
+        The original standing in for the virtual function under adaptive patching counts as 'virtual', as does a wrapper
+        that names the virtual function in its _virtual_stand_in_for attribute (like the journal's sampling time.time())"""
+        current = getattr(self.owner, self.attribute)
+        if getattr(current, '_virtual_stand_in_for', None) is self.virtual:
+            return "virtual" if self.patched else "unexpected"
+        if current == self.original:
+            return "virtual" if self.patched and self.adaptive and _adaptive_raw else "orig"
+        return "virtual" if current == self.virtual else "unexpected"
+
+# all the targets, in the order they are patched, by name; and how many of them are currently patched
+_patch_targets = collections.OrderedDict()
+_patched_count = 0
+
+def _set_patched(target, patched):
+    """patches or unpatches target, keeping count of the patched targets - must be called with _virtual_time_state held"""
+    global _patched_count
+    if patched:
+        target.patch()
+    else:
+        target.unpatch()
+    if patched != target.patched:
+        target.patched = patched
+        _patched_count += 1 if patched else -1
+
+# whether adaptive patching is on, and whether the originals are currently standing in for the adaptive targets' virtual functions
+_adaptive_patching = False
+_adaptive_raw = False
+
+def _set_adaptive_raw(raw):
+    """puts the originals or the virtual functions of the patched adaptive targets in place - must be called with _virtual_time_state held"""
+    global _adaptive_raw
+    if raw != _adaptive_raw:
+        _adaptive_raw = raw
+        for target in list(_patch_targets.values()):
+            if target.adaptive and target.patched:
+                target.patch()
+
+def enable_adaptive_patching():
+    """While virtual time is enabled and the offset is zero, leaves the original time module functions in place, so that
+    they don't pay for the overlays when they would give the same results. The overlays are put back before the offset
+    is next changed from zero. time.sleep stays virtual throughout, and enabled() reports the same as without this.
+    Code that keeps its own reference to time.time and the like while the originals are in place will keep using them,
+    so this is only suitable where the functions are looked up on the module as they are called"""
+    global _adaptive_patching
+    _virtual_time_state.acquire()
+    try:
+        _adaptive_patching = True
+        _set_adaptive_raw(_time_offset == 0)
+    finally:
+        _virtual_time_state.release()
+
+def disable_adaptive_patching():
+    """Puts the overlays back in place regardless of the offset - see enable_adaptive_patching"""
+    global _adaptive_patching
+    _virtual_time_state.acquire()
+    try:
+        _adaptive_patching = False
+        _set_adaptive_raw(False)
+    finally:
+        _virtual_time_state.release()
+
+# functions called with True or False (while the virtual time state is locked) after enable() or disable() has patched the targets
+_patch_listeners = []
+
+def _add_patch_listener(listener):
+    """adds a function that will be called with whether virtual time is now enabled, each time enable() or disable() is called"""
+    _virtual_time_state.acquire()
+    try:
+        if listener not in _patch_listeners:
+            _patch_listeners.append(listener)
+    finally:
+        _virtual_time_state.release()
+
+def _remove_patch_listener(listener):
+    """removes a function added with _add_patch_listener"""
+    _virtual_time_state.acquire()
+    try:
+        if listener in _patch_listeners:
+            _patch_listeners.remove(listener)
+    finally:
+        _virtual_time_state.release()
+
+def _patch_group(group, patched):
+    _virtual_time_state.acquire()
+    try:
+        for target in list(_patch_targets.values()):
+            if group is None or target.group == group:
+                _set_patched(target, patched)
+    finally:
+        _virtual_time_state.release()
+
+def register_patch_target(name, owner, attribute, virtual, original=None, group=None, adaptive=False):
+    """Declares another clock entry point to be replaced by virtual, so that it is patched and unpatched along with
+    the time and datetime modules. original defaults to the current value of the attribute. If virtual time is
+    enabled, the target is patched straight away. adaptive should only be set if virtual is the same as original
+    while the offset is zero. Returns the PatchTarget"""
+    _virtual_time_state.acquire()
+    try:
+        if name in _patch_targets:
+            raise ValueError("Patch target %s has already been registered" % name)
+        if original is None:
+            original = getattr(owner, attribute)
+        target = PatchTarget(name, owner, attribute, original, virtual, group, adaptive)
+        fully_enabled = _patch_targets and _patched_count == len(_patch_targets)
+        _patch_targets[name] = target
+        if fully_enabled:
+            _set_patched(target, True)
+        return target
+    finally:
+        _virtual_time_state.release()
+
+def unregister_patch_target(name):
+    """Removes a target added with register_patch_target, restoring its original if it is patched"""
+    _virtual_time_state.acquire()
+    try:
+        target = _patch_targets[name]
+        if target.patched:
+            _set_patched(target, False)
+        del _patch_targets[name]
+    finally:
+        _virtual_time_state.release()
+
+# time.sleep isn't adaptive, as sleepers need to wake up when the offset changes. Nor are the datetime targets: the virtual
+# datetime.now is no slower than the original, which has to construct an instance of the datetime subclass.
+# datetime.date isn't replaced, as date.today() already reads the patched time.time, and swapping the type would stop
+# plain dates from pickling
+for _target in [
+    ("time.time",      time,  "time",      _original_time,      _virtual_time,      True),
+    ("time.asctime",   time,  "asctime",   _original_asctime,   _virtual_asctime,   True),
+    ("time.ctime",     time,  "ctime",     _original_ctime,     _virtual_ctime,     True),
+    ("time.gmtime",    time,  "gmtime",    _original_gmtime,    _virtual_gmtime,    True),
+    ("time.localtime", time,  "localtime", _original_localtime, _virtual_localtime, True),
+    ("time.strftime",  time,  "strftime",  _original_strftime,  _virtual_strftime,  True),
+    ("time.sleep",     time,  "sleep",     _original_sleep,     _virtual_sleep,     False),
+]:
+    _patch_targets[_target[0]] = PatchTarget(*_target[:5], group="time", adaptive=_target[5])
+# the datetime class is patched in place, so these are set on it even while datetime_module.datetime is swapped out
+for _target in [
+    ("datetime.datetime.now",    _original_datetime_type, "now",    _original_datetime_now,    _virtual_datetime_now,    False),
+    ("datetime.datetime.utcnow", _original_datetime_type, "utcnow", _original_datetime_utcnow, _virtual_datetime_utcnow, False),
+]:
+    _patch_targets[_target[0]] = PatchTarget(*_target[:5], group="datetime", adaptive=_target[5])
+del _target
+
 def patch_time_module():
     """Patches the time module to work on virtual time"""
-    time.time = _virtual_time
-    time.asctime = _virtual_asctime
-    time.ctime = _virtual_ctime
-    time.gmtime = _virtual_gmtime
-    time.localtime = _virtual_localtime
-    time.strftime = _virtual_strftime
-    time.sleep = _virtual_sleep
+    _patch_group("time", True)
 
 def unpatch_time_module():
     """Restores the time module to use original functions"""
-    time.time = _original_time
-    time.asctime = _original_asctime
-    time.ctime = _original_ctime
-    time.gmtime = _original_gmtime
-    time.localtime = _original_localtime
-    time.strftime = _original_strftime
-    time.sleep = _original_sleep
+    _patch_group("time", False)
 
 def patch_datetime_module():
     """Patches the datetime module to work on virtual time"""
-    _original_datetime_module.datetime.now = _virtual_datetime_now
-    _original_datetime_module.datetime.utcnow = _virtual_datetime_utcnow
+    _patch_group("datetime", True)
 
 def unpatch_datetime_module():
     """Restores the datetime module to work on real time"""
-    _original_datetime_module.datetime.now = _original_datetime_now
-    _original_datetime_module.datetime.utcnow = _original_datetime_utcnow
+    _patch_group("datetime", False)
 
 raw_time = _original_time
 raw_datetime = _underlying_datetime_type
@@ -707,19 +1350,8 @@ def is_datetime_instance(value):
     """
     return isinstance(value, raw_datetime)
 
-def enabled():
-    """Checks whether virtual time has been enabled by examing modules - returns a ValueError if in an inconsistent state"""
-    check_functions = [
-        ("time.time",         time.time,      _original_time,      _virtual_time),
-        ("time.asctime",      time.asctime,   _original_asctime,   _virtual_asctime),
-        ("time.ctime",        time.ctime,     _original_ctime,     _virtual_ctime),
-        ("time.gmtime",       time.gmtime,    _original_gmtime,    _virtual_gmtime),
-        ("time.localtime",    time.localtime, _original_localtime, _virtual_localtime),
-        ("time.strftime",     time.strftime,  _original_strftime,  _virtual_strftime),
-        ("time.sleep",        time.sleep,     _original_sleep,     _virtual_sleep),
-        ("datetime.datetime.now",    _original_datetime_module.datetime.now,    _original_datetime_now,    _virtual_datetime_now),
-        ("datetime.datetime.utcnow", _original_datetime_module.datetime.utcnow, _original_datetime_utcnow, _virtual_datetime_utcnow),
-    ]
+def _verify_enabled():
+    """Examines the patched modules themselves, to catch anything that has patched them behind virtualtime's back"""
     constant_functions = [
         ("datetime.datetime", _original_datetime_module.datetime, _original_datetime_type),
     ]
@@ -732,8 +1364,8 @@ def enabled():
         if check_function != correct_function:
             raise ValueError("%s should be %s but has been patched as %s" % (check_name, check_function, correct_function))
     check_results = {}
-    for check_name, check_function, orig_function, virtual_function in check_functions:
-        check_results[check_name] = "orig" if check_function == orig_function else ("virtual" if check_function == virtual_function else "unexpected")
+    for check_name, target in list(_patch_targets.items()):
+        check_results[check_name] = target.state()
     combined_results = set(check_results.values())
     if "unexpected" in combined_results:
         logging.critical("Unexpected functions in virtual time patching: %s", ", ".join(check_name for check_name, check_status in check_results.items() if check_status == 'unexpected'))
@@ -745,6 +1377,19 @@ def enabled():
         raise ValueError("Unexpected functions in virtual time patching")
     return state == 'virtual'
 
+def enabled(verify=False):
+    """Checks whether virtual time has been enabled - returns a ValueError if in an inconsistent state.
+    This uses the record of which targets virtualtime has patched; pass verify=True to examine the modules instead"""
+    if verify:
+        return _verify_enabled()
+    patched_count = _patched_count
+    if patched_count == 0:
+        return False
+    if patched_count == len(_patch_targets):
+        return True
+    logging.critical("Inconsistent state of virtual time patching: %r", list(_patch_targets.values()))
+    raise ValueError("Inconsistent state of virtual time patching")
+
 def enable():
     """Enables virtual time (actually increments the number of times it's been enabled)"""
     global __virtual_time_enabled
@@ -752,8 +1397,9 @@ def enable():
     try:
         __virtual_time_enabled = True
         logging.info("Virtual Time enabled %d times; patching modules", __virtual_time_enabled)
-        patch_time_module()
-        patch_datetime_module()
+        _patch_group(None, True)
+        for listener in list(_patch_listeners):
+            listener(True)
     finally:
         _virtual_time_state.release()
 
@@ -764,7 +1410,28 @@ def disable():
     try:
         __virtual_time_enabled = False
         logging.info("Virtual Time disabled %d times; unpatching modules", __virtual_time_enabled)
-        unpatch_time_module()
-        unpatch_datetime_module()
+        _patch_group(None, False)
+        for listener in list(_patch_listeners):
+            listener(False)
     finally:
         _virtual_time_state.release()
+
+from .subscriptions import subscribe, unsubscribe
+from .bulk import format_times, format_datetimes, iter_format_times, iter_format_datetimes
+from .bulk import local_datetimes_to_times, utc_datetimes_to_times
+from .log_formatter import VirtualTimeFormatter
+from .vectorized import patch_pandas, unpatch_pandas, datetime64_now
+from .coarse import coarse_time, coarse_now
+from .scanner import find_stale_references, rebind_stale_references
+from .scoped import enable_for, disable_for
+from .journal import JournalRecorder, replay_journal
+from .tracing import start_tracing, stop_tracing
+from . import persistence
+if sys.version_info >= (3, 4):
+    from . import import_hook
+    from .import_hook import register_datetime_sensitive_package
+    import_hook.install()
+if sys.version_info.major >= 3:
+    from .async_changes import changes
+# restores the virtual clock state saved by a previous process, if VIRTUALTIME_STATE_FILE is set
+persistence._load_from_environment()
@@ -1,8 +1,11 @@
 """These functions are fallbacks in case we hit the occasional import lock error in datetime functions, and for tests"""
 
 import sys
+import collections
 import datetime
 import re
+import threading
+import time
 
 if sys.platform.startswith('win'):
     try:
@@ -19,30 +22,65 @@ if sys.platform.startswith('win'):
         return datetime.datetime(t[0], t[1], t[3], t[4], t[5], t[6], t[7] * 1000)
 
 elif sys.platform.startswith('linux'):
+    # the clock is read without going through datetime, using clock_gettime (served from the vDSO) where Python provides it,
+    # or else gettimeofday through ctypes. ctypes itself is imported now, as these fallbacks are used when imports are failing,
+    # but loading libc and defining timeval are deferred until a fallback is first needed
+    _gmtime = time.gmtime
+    _localtime = time.localtime
     try:
         import ctypes
-        libc = ctypes.CDLL("libc.so.6")
-        class timeval(ctypes.Structure):
-            _fields_ = [("seconds", ctypes.c_long),("microseconds", ctypes.c_long)]
-    except (ImportError, OSError):
+    except ImportError:
         ctypes = None
-        libc = None
-        timeval = None
+    _libc = None
+    _timevals = threading.local()
 
-    def alt_get_local_datetime():
-        t = timeval()
-        if libc.gettimeofday(ctypes.byref(t), None) == 0:
-            return datetime.datetime.fromtimestamp(float(t.seconds) + (t.microseconds / 1000000.), None)
-        raise ValueError("Error retrieving time")
+    def _load_libc():
+        """returns (libc, timeval), loading them on first use"""
+        global _libc
+        if _libc is None:
+            class timeval(ctypes.Structure):
+                _fields_ = [("seconds", ctypes.c_long),("microseconds", ctypes.c_long)]
+            _libc = (ctypes.CDLL("libc.so.6"), timeval)
+        return _libc
+
+    def _gettimeofday_realtime():
+        """returns the current real time as integer (seconds, microseconds) since the epoch, using gettimeofday through ctypes"""
+        libc, timeval = _load_libc()
+        # each thread reuses its own buffer, rather than allocating one per call
+        t = getattr(_timevals, 'timeval', None)
+        if t is None:
+            t = _timevals.timeval = timeval()
+        if libc.gettimeofday(ctypes.byref(t), None) != 0:
+            raise ValueError("Error retrieving time")
+        return t.seconds, t.microseconds
+
+    if hasattr(time, 'clock_gettime_ns'):
+        _clock_gettime_ns = time.clock_gettime_ns
+        _CLOCK_REALTIME = time.CLOCK_REALTIME
+        def _realtime():
+            """returns the current real time as integer (seconds, microseconds) since the epoch"""
+            return divmod(_clock_gettime_ns(_CLOCK_REALTIME) // 1000, 1000000)
+    elif hasattr(time, 'clock_gettime'):
+        _clock_gettime = time.clock_gettime
+        _CLOCK_REALTIME = time.CLOCK_REALTIME
+        def _realtime():
+            """returns the current real time as integer (seconds, microseconds) since the epoch"""
+            return divmod(int(round(_clock_gettime(_CLOCK_REALTIME) * 1000000)), 1000000)
+    else:
+        _realtime = _gettimeofday_realtime
+
+    def alt_get_local_datetime(tz=None):
+        seconds, microseconds = _realtime()
+        if tz is not None:
+            t = _gmtime(seconds)
+            return tz.fromutc(datetime.datetime(t[0], t[1], t[2], t[3], t[4], min(t[5], 59), microseconds, tzinfo=tz))
+        t = _localtime(seconds)
+        return datetime.datetime(t[0], t[1], t[2], t[3], t[4], min(t[5], 59), microseconds)
 
     def alt_get_utc_datetime():
-        t = timeval()
-        if libc.gettimeofday(ctypes.byref(t), None) == 0:
-            libc.tzset()
-            utc_offset = (ctypes.c_int32).in_dll(libc, 'timezone').value
-            return datetime.datetime.fromtimestamp(float(t.seconds) + (t.microseconds / 1000000.) + utc_offset,
-                                                   None)
-        raise ValueError("Error retrieving time")
+        seconds, microseconds = _realtime()
+        t = _gmtime(seconds)
+        return datetime.datetime(t[0], t[1], t[2], t[3], t[4], min(t[5], 59), microseconds)
 else:
     def alt_get_local_datetime():
         raise NotImplementedError()
@@ -50,32 +88,86 @@ else:
     def alt_get_utc_datetime():
         raise NotImplementedError()
 
+class FormatCache(object):
+    """A small thread-safe least-recently-used cache of the results of parsing format strings"""
+    def __init__(self, parse, maxsize=128):
+        self.parse = parse
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._move_to_end = getattr(self._cache, 'move_to_end', None)
+
+    def get(self, format_str):
+        if self._move_to_end is not None:
+            # the C implementation of OrderedDict makes hits atomic, so they don't need the lock
+            try:
+                result = self._cache[format_str]
+                self._move_to_end(format_str)
+                return result
+            except KeyError:
+                pass
+        with self._lock:
+            try:
+                result = self._cache.pop(format_str)
+            except KeyError:
+                result = self.parse(format_str)
+                if len(self._cache) >= self.maxsize:
+                    self._cache.popitem(last=False)
+            self._cache[format_str] = result
+            return result
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
 # searching for this will eliminate escaped percent-format signs
 format_re = re.compile('%.')
+# the same, with any GNU flags, field width and E or O modifier separated out, as in %-d, %_5Y or %Ey
+directive_re = re.compile('%([-_^#0]*)([0-9]*)([EO]?)(.)', re.DOTALL)
+_ADJUSTED_DIRECTIVES = frozenset(['%f', '%z', '%Z'])
+
+def _parse_adjust_format(format_str):
+    """splits format_str into a tuple of (literal, directive) pieces around the directives that adjust_strftime fills in,
+    or returns None if there are none"""
+    pieces, start = [], 0
+    for m in format_re.finditer(format_str):
+        if m.group(0) in _ADJUSTED_DIRECTIVES:
+            pieces.append((format_str[start:m.start()], m.group(0)))
+            start = m.end()
+    if not pieces:
+        return None
+    pieces.append((format_str[start:], ''))
+    return tuple(pieces)
+
+_adjust_format_cache = FormatCache(_parse_adjust_format)
+
+def _format_utcoffset(dt):
+    tzinfo = getattr(dt, 'tzinfo', None)
+    try:
+        offset_td = tzinfo.utcoffset(dt) if tzinfo else None
+    except NotImplementedError:
+        offset_td = None
+    if offset_td is None:
+        return ''
+    offset = offset_td.days*24*3600 + offset_td.seconds
+    offset_sign, offset = ('+' if offset >= 0 else '-'), abs(offset)
+    minutes, seconds = divmod(offset, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '%c%02d%02d' % (offset_sign, hours, minutes)
 
 def adjust_strftime(dt, format_str):
-    format_chars = list(format_re.finditer(format_str))
-    for m in reversed(format_chars):
-        text = m.group(0)
-        if text == '%f':
-            format_str = format_str[:m.start()] + ('%06d' % getattr(dt, 'microsecond', 0)) + format_str[m.end():]
-        elif text == '%z':
-            tzinfo = getattr(dt, 'tzinfo', None)
-            try:
-                offset_td = tzinfo.utcoffset(dt) if tzinfo else None
-            except NotImplementedError:
-                offset_td = None
-            if offset_td is not None:
-                offset = offset_td.days*24*3600 + offset_td.seconds
-                offset_sign, offset = ('+' if offset >= 0 else '-'), abs(offset)
-                minutes, seconds = divmod(offset, 60)
-                hours, minutes = divmod(minutes, 60)
-                offset_str = '%c%02d%02d' % (offset_sign, hours, minutes)
-            else:
-                offset_str = ''
-            format_str = format_str[:m.start()] + offset_str + format_str[m.end():]
-        elif text == '%Z':
+    """fills in the datetime-specific %f, %z and %Z directives in format_str, so that it can be passed to time.strftime"""
+    pieces = _adjust_format_cache.get(format_str)
+    if pieces is None:
+        return format_str
+    parts = []
+    for literal, directive in pieces:
+        parts.append(literal)
+        if directive == '%f':
+            parts.append('%06d' % getattr(dt, 'microsecond', 0))
+        elif directive == '%z':
+            parts.append(_format_utcoffset(dt))
+        elif directive == '%Z':
             tzinfo = getattr(dt, 'tzinfo', None)
-            tzname = '' if tzinfo is None else tzinfo.tzname(dt)
-            format_str = format_str[:m.start()] + tzname + format_str[m.end():]
-    return format_str
+            parts.append('' if tzinfo is None else tzinfo.tzname(dt))
+    return ''.join(parts)
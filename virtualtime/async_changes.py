@@ -0,0 +1,80 @@
+"""Delivers virtual time offset changes into an asyncio event loop, so that coroutines can react to time jumps with
+    async for change in virtualtime.changes():
+without a helper thread blocking on a notify_on_change event"""
+
+import collections
+import weakref
+import virtualtime
+
+DEFAULT_MAX_BUFFERED = 100
+
+class OffsetChanges(object):
+    """An asynchronous iterator of OffsetChange objects, buffering at most maxsize changes.
+    If the consumer falls behind, the oldest buffered changes are dropped so that the latest offset is always delivered"""
+    def __init__(self, maxsize=DEFAULT_MAX_BUFFERED, loop=None):
+        if loop is None:
+            # imported here rather than at module level, so that importing virtualtime doesn't pay for importing asyncio
+            import asyncio
+            loop = asyncio.get_running_loop() if hasattr(asyncio, 'get_running_loop') else asyncio.get_event_loop()
+        self.loop = loop
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.closed = False
+        self._buffer = collections.deque(maxlen=maxsize)
+        self._waiter = None
+        self._wakeup_pending = False
+        self_ref = weakref.ref(self)
+        def listener(change):
+            changes = self_ref()
+            if changes is None:
+                virtualtime._remove_change_listener(listener)
+            else:
+                changes._on_change(change)
+        self._listener = listener
+        virtualtime._add_change_listener(listener)
+
+    def _on_change(self, change):
+        """called in the thread changing the offset, with the virtual time state locked"""
+        if len(self._buffer) == self.maxsize:
+            self.dropped += 1
+        self._buffer.append(change)
+        # only schedule a wakeup for the first of a burst of changes, rather than one per change
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self.loop.call_soon_threadsafe(self._wakeup)
+
+    def _wakeup(self):
+        """called in the event loop when changes have been buffered"""
+        self._wakeup_pending = False
+        # the consumer may already have taken the buffered changes directly, in which case it keeps waiting
+        if self._waiter is not None and self._buffer:
+            waiter, self._waiter = self._waiter, None
+            if not waiter.done():
+                waiter.set_result(self._buffer.popleft())
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self.loop.create_future()
+        if self._buffer:
+            future.set_result(self._buffer.popleft())
+        elif self.closed:
+            future.set_exception(StopAsyncIteration())
+        else:
+            self._waiter = future
+        return future
+
+    def close(self):
+        """Stops listening for changes, ending the iteration once buffered changes have been consumed"""
+        if not self.closed:
+            self.closed = True
+            virtualtime._remove_change_listener(self._listener)
+            waiter, self._waiter = self._waiter, None
+            if waiter is not None and not waiter.done():
+                waiter.set_exception(StopAsyncIteration())
+
+def changes(maxsize=DEFAULT_MAX_BUFFERED, loop=None):
+    """Returns an asynchronous iterator of OffsetChange objects for changes to the virtual time offset from now on,
+    delivered into loop (by default the current event loop). The change's is_fast_forward_change indicates whether it is a fast forward step"""
+    return OffsetChanges(maxsize=maxsize, loop=loop)
@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+
+"""Micro-benchmarks for the hot paths in virtualtime. Run with
+    python -m virtualtime.benchmarks [benchmark_name ...]
+to run all or some of them; each prints the number of operations per second"""
+
+import collections
+import sys
+import threading
+import time
+import timeit
+import virtualtime
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(function):
+    """Registers a benchmark function, which should return a list of (description, operations per second) results"""
+    BENCHMARKS[function.__name__] = function
+    return function
+
+def rate(statement, number, setup=None, repeat=3):
+    """Returns the best rate in operations per second of calling statement number times"""
+    timer = timeit.Timer(statement, setup) if setup else timeit.Timer(statement)
+    return number / min(timer.repeat(repeat=repeat, number=number))
+
+@benchmark
+def bench_set_offset(number=20000):
+    results = []
+    for subscriber_count in (0, 10, 1000):
+        events = [threading.Event() for n in range(subscriber_count)]
+        for event in events:
+            virtualtime.notify_on_change(event)
+        try:
+            offsets = iter(range(sys.maxsize))
+            per_second = rate(lambda: virtualtime.set_offset(next(offsets), suppress_log=True), number // max(1, subscriber_count // 10))
+        finally:
+            for event in events:
+                virtualtime.undo_notify_on_change(event)
+            virtualtime.set_offset(0, suppress_log=True)
+        results.append(("set_offset with %d subscribers" % subscriber_count, per_second))
+    return results
+
+def _legacy_fixed_strftime(format, when_tuple):
+    """the previous pre-1900 time.strftime fallback, which rendered the format twice and repaired the year, for comparison"""
+    year = orig_year = when_tuple[0]
+    while year < 1900: year += 400
+    s1 = virtualtime._underlying_strftime(format, (year,) + tuple(when_tuple[1:]))
+    s2 = virtualtime._underlying_strftime(format, (year+400,) + tuple(when_tuple[1:]))
+    return virtualtime._repair_year(s1, s2, year, year+400, orig_year)
+
+def _legacy_datetime_fixed_strftime(dt, format_str):
+    """the previous pre-1900 datetime.strftime fallback, for comparison"""
+    year = dt.year
+    while year < 1900: year += 400
+    s1 = virtualtime._underlying_datetime_type.strftime(dt.replace(year=year), format_str)
+    s2 = virtualtime._underlying_datetime_type.strftime(dt.replace(year=year+400), format_str)
+    return virtualtime._repair_year(s1, s2, year, year+400, dt.year)
+
+@benchmark
+def bench_enabled(number=200000):
+    results = []
+    for state in (False, True):
+        if state:
+            virtualtime.enable()
+        try:
+            results.append(("enabled(), %s" % ("enabled" if state else "disabled"), rate(virtualtime.enabled, number)))
+            results.append(("enabled(verify=True), %s" % ("enabled" if state else "disabled"), rate(lambda: virtualtime.enabled(verify=True), number)))
+        finally:
+            if state:
+                virtualtime.disable()
+    return results
+
+@benchmark
+def bench_stale_reference_scan(module_count=2000, number=20):
+    import types
+    from virtualtime import scanner
+    modules = []
+    for n in range(module_count):
+        module = types.ModuleType("bench_scanner_module_%d" % n)
+        module.__dict__.update(("name_%d" % m, m) for m in range(50))
+        module.time = virtualtime._original_time
+        sys.modules[module.__name__] = module
+        modules.append(module)
+    try:
+        return [
+            ("full scan of %d modules" % len(sys.modules), rate(lambda: scanner.find_stale_references(full=True), number)),
+            ("rescan of %d modules" % len(sys.modules), rate(scanner.find_stale_references, number)),
+        ]
+    finally:
+        for module in modules:
+            del sys.modules[module.__name__]
+
+@benchmark
+def bench_scoped(number=1000000):
+    import types
+    module = types.ModuleType("bench_scoped_module")
+    module.time = time
+    sys.modules[module.__name__] = module
+    try:
+        results = [("time.time(), unpatched", rate(time.time, number))]
+        virtualtime.enable_for(module.__name__)
+        try:
+            results.append(("time.time(), outside scoped module", rate(time.time, number)))
+            results.append(("time.time(), inside scoped module", rate(module.time.time, number)))
+        finally:
+            virtualtime.disable_for(module.__name__)
+        virtualtime.enable()
+        try:
+            results.append(("time.time(), patched globally", rate(time.time, number)))
+        finally:
+            virtualtime.disable()
+        return results
+    finally:
+        del sys.modules[module.__name__]
+
+@benchmark
+def bench_adaptive_patching(number=1000000):
+    results = []
+    was_enabled = virtualtime.enabled()
+    if not was_enabled:
+        virtualtime.enable()
+    try:
+        for adaptive in (False, True):
+            if adaptive:
+                virtualtime.enable_adaptive_patching()
+            try:
+                description = "adaptive" if adaptive else "patched"
+                results.append(("time.time(), %s, zero offset" % description, rate(time.time, number)))
+                results.append(("time.localtime(), %s, zero offset" % description, rate(time.localtime, number // 4)))
+                results.append(("time.strftime(format), %s, zero offset" % description, rate(lambda: time.strftime("%Y-%m-%d %H:%M:%S"), number // 4)))
+            finally:
+                virtualtime.disable_adaptive_patching()
+    finally:
+        if not was_enabled:
+            virtualtime.disable()
+    return results
+
+@benchmark
+def bench_journal(number=20000):
+    import os
+    import tempfile
+    from virtualtime import journal
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "bench.vtj")
+    results = []
+    try:
+        offsets = iter(range(sys.maxsize))
+        results.append(("set_offset, not recording", rate(lambda: virtualtime.set_offset(next(offsets), suppress_log=True), number)))
+        with journal.JournalRecorder(path):
+            results.append(("set_offset, recording", rate(lambda: virtualtime.set_offset(next(offsets), suppress_log=True), number)))
+    finally:
+        virtualtime.set_offset(0, suppress_log=True)
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+@benchmark
+def bench_tracing(number=20000):
+    import os
+    import tempfile
+    from virtualtime import tracing
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "trace.json")
+    results = []
+    try:
+        offsets = iter(range(sys.maxsize))
+        results.append(("set_offset, not tracing", rate(lambda: virtualtime.set_offset(next(offsets), suppress_log=True), number)))
+        tracing.start_tracing(path)
+        try:
+            results.append(("set_offset, tracing", rate(lambda: virtualtime.set_offset(next(offsets), suppress_log=True), number)))
+        finally:
+            tracing.stop_tracing()
+    finally:
+        virtualtime.set_offset(0, suppress_log=True)
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+@benchmark
+def bench_persistence(number=20000):
+    import os
+    import tempfile
+    from virtualtime import persistence
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "state.json")
+    fast_forward = lambda: virtualtime.fast_forward_time(delta=number, step_size=1, step_wait=0, log_every=0)
+    results = []
+    try:
+        results.append(("fast forward steps, not persisting", rate(fast_forward, 1) * number))
+        virtualtime.set_offset(0, suppress_log=True)
+        persistence.enable_persistence(path)
+        try:
+            results.append(("fast forward steps, persisting", rate(fast_forward, 1) * number))
+        finally:
+            persistence.disable_persistence()
+    finally:
+        virtualtime.set_offset(0, suppress_log=True)
+        os.remove(path)
+        os.rmdir(directory)
+    return results
+
+@benchmark
+def bench_pre_1900_strftime(number=50000):
+    format_str = "%Y-%m-%d %H:%M:%S"
+    dt = virtualtime.datetime(1812, 9, 10, 12, 7, 30)
+    when_tuple = tuple(dt.timetuple())
+    original_min_year = virtualtime._STRFTIME_MIN_YEAR
+    # force the fallbacks to be used even if this Python can format early years itself
+    virtualtime._STRFTIME_MIN_YEAR = 1900
+    try:
+        return [
+            ("time.strftime pre-1900, double render", rate(lambda: _legacy_fixed_strftime(format_str, when_tuple), number)),
+            ("time.strftime pre-1900, single render", rate(lambda: virtualtime._fixed_strftime(format_str, when_tuple), number)),
+            ("datetime.strftime pre-1900, double render", rate(lambda: _legacy_datetime_fixed_strftime(dt, format_str), number)),
+            ("datetime.strftime pre-1900, single render", rate(lambda: virtualtime.datetime._fixed_strftime(dt, format_str), number)),
+        ]
+    finally:
+        virtualtime._STRFTIME_MIN_YEAR = original_min_year
+
+def _legacy_adjust_strftime(dt, format_str):
+    """the previous alt_time_funcs.adjust_strftime, which re-parsed the format on every call, for comparison"""
+    format_chars = list(virtualtime.alt_time_funcs.format_re.finditer(format_str))
+    for m in reversed(format_chars):
+        text = m.group(0)
+        if text == '%f':
+            format_str = format_str[:m.start()] + ('%06d' % getattr(dt, 'microsecond', 0)) + format_str[m.end():]
+        elif text == '%z':
+            format_str = format_str[:m.start()] + virtualtime.alt_time_funcs._format_utcoffset(dt) + format_str[m.end():]
+        elif text == '%Z':
+            tzinfo = getattr(dt, 'tzinfo', None)
+            tzname = '' if tzinfo is None else tzinfo.tzname(dt)
+            format_str = format_str[:m.start()] + tzname + format_str[m.end():]
+    return format_str
+
+@benchmark
+def bench_adjust_strftime(number=100000):
+    dt = virtualtime.datetime(2020, 2, 20, 20, 20, 20, 2020)
+    results = []
+    for format_str in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M:%S.%f %z %Z"):
+        results.append(("adjust_strftime %r, parsed every call" % format_str, rate(lambda: _legacy_adjust_strftime(dt, format_str), number)))
+        results.append(("adjust_strftime %r, cached template" % format_str, rate(lambda: virtualtime.alt_time_funcs.adjust_strftime(dt, format_str), number)))
+    return results
+
+@benchmark
+def bench_datetime_methods(number=200000):
+    dt_type = virtualtime._original_datetime_module.datetime
+    dt = dt_type(2020, 2, 20, 20, 20, 20, 2020)
+    raw = virtualtime.raw_datetime(2020, 2, 20, 20, 20, 20, 2020)
+    results = [
+        ("datetime(...)", rate(lambda: dt_type(2020, 2, 20, 20, 20, 20, 2020), number)),
+        ("datetime(raw_datetime)", rate(lambda: dt_type(raw), number)),
+        ("datetime.timetuple()", rate(dt.timetuple, number)),
+        ("datetime.now(), unpatched", rate(dt_type.now, number)),
+        ("date.today(), unpatched", rate(virtualtime._underlying_date_type.today, number)),
+    ]
+    was_enabled = virtualtime.enabled()
+    if not was_enabled:
+        virtualtime.enable()
+    try:
+        virtualtime.set_offset(3600, suppress_log=True)
+        results.append(("datetime.now(), patched", rate(dt_type.now, number)))
+        results.append(("datetime.utcnow(), patched", rate(dt_type.utcnow, number)))
+        results.append(("date.today(), patched", rate(virtualtime._original_datetime_module.date.today, number)))
+        results.append(("virtual_date.today(), patched", rate(virtualtime.virtual_date.today, number)))
+    finally:
+        virtualtime.set_offset(0, suppress_log=True)
+        if not was_enabled:
+            virtualtime.disable()
+    return results
+
+@benchmark
+def bench_coarse_clock(number=1000000):
+    from virtualtime import coarse
+    results = []
+    was_enabled = virtualtime.enabled()
+    if not was_enabled:
+        virtualtime.enable()
+    try:
+        virtualtime.set_offset(3600, suppress_log=True)
+        results.append(("time.time(), patched", rate(time.time, number)))
+        results.append(("coarse_time()", rate(coarse.coarse_time, number)))
+        results.append(("datetime.now(), patched", rate(virtualtime._original_datetime_module.datetime.now, number // 4)))
+        results.append(("coarse_now()", rate(coarse.coarse_now, number)))
+    finally:
+        coarse.stop_coarse_clock()
+        virtualtime.set_offset(0, suppress_log=True)
+        if not was_enabled:
+            virtualtime.disable()
+    return results
+
+def _legacy_alt_get_utc_datetime():
+    """the previous Linux fallback, which read the clock and timezone through ctypes on every call, for comparison"""
+    import ctypes
+    libc, timeval = virtualtime.alt_time_funcs._load_libc()
+    t = timeval()
+    if libc.gettimeofday(ctypes.byref(t), None) == 0:
+        libc.tzset()
+        utc_offset = (ctypes.c_int32).in_dll(libc, 'timezone').value
+        return virtualtime._original_datetime_module.datetime.fromtimestamp(float(t.seconds) + (t.microseconds / 1000000.) + utc_offset, None)
+    raise ValueError("Error retrieving time")
+
+@benchmark
+def bench_fallback_clock(number=100000):
+    alt_time_funcs = virtualtime.alt_time_funcs
+    if not hasattr(alt_time_funcs, '_load_libc'):
+        return []
+    return [
+        ("alt_get_utc_datetime, ctypes gettimeofday and tzset", rate(_legacy_alt_get_utc_datetime, number)),
+        ("alt_get_utc_datetime", rate(alt_time_funcs.alt_get_utc_datetime, number)),
+        ("alt_get_local_datetime", rate(alt_time_funcs.alt_get_local_datetime, number)),
+    ]
+
+def _import_numpy():
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        return None
+
+@benchmark
+def bench_bulk_strftime(count=200000):
+    from virtualtime import bulk
+    format_str = "%Y-%m-%d %H:%M:%S"
+    start = virtualtime._original_time()
+    # ten values per second, as in a typical high-frequency log or measurement column
+    times = [start + n * 0.1 for n in range(count)]
+    datetimes = [virtualtime._underlying_datetime_type.fromtimestamp(t) for t in times]
+    results = [
+        ("time.strftime per value", rate(lambda: [time.strftime(format_str, time.localtime(t)) for t in times], 1, repeat=1) * count),
+        ("format_times", rate(lambda: bulk.format_times(format_str, times), 1, repeat=1) * count),
+        ("datetime.strftime per value", rate(lambda: [dt.strftime(format_str) for dt in datetimes], 1, repeat=1) * count),
+        ("format_datetimes", rate(lambda: bulk.format_datetimes(format_str, datetimes), 1, repeat=1) * count),
+    ]
+    numpy = _import_numpy()
+    if numpy is not None:
+        array = numpy.array(times)
+        results.append(("format_times on a NumPy array", rate(lambda: bulk.format_times(format_str, array), 1, repeat=1) * count))
+    return results
+
+@benchmark
+def bench_datetime_to_time(count=100000):
+    from virtualtime import bulk
+    start = virtualtime._underlying_datetime_type(2014, 3, 1)
+    # every minute through a daylight savings transition in most timezones
+    datetimes = [start + virtualtime._original_datetime_module.timedelta(minutes=n) for n in range(count)]
+    results = [
+        ("time.mktime per value", rate(lambda: [time.mktime(dt.timetuple()) + dt.microsecond * 0.000001 for dt in datetimes], 1, repeat=1) * count),
+        ("local_datetimes_to_times", rate(lambda: bulk.local_datetimes_to_times(datetimes), 1, repeat=1) * count),
+        ("utc_datetimes_to_times", rate(lambda: bulk.utc_datetimes_to_times(datetimes), 1, repeat=1) * count),
+    ]
+    numpy = _import_numpy()
+    if numpy is not None:
+        array = numpy.array(datetimes, dtype='datetime64[us]')
+        results.append(("local_datetimes_to_times on a NumPy array", rate(lambda: bulk.local_datetimes_to_times(array), 1, repeat=1) * count))
+    return results
+
+@benchmark
+def bench_time_cache(number=200000):
+    results = []
+    was_enabled = virtualtime.enabled()
+    if not was_enabled:
+        virtualtime.enable()
+    try:
+        for cached in (False, True):
+            if cached:
+                virtualtime.enable_time_cache()
+            label = "cached" if cached else "uncached"
+            results.append(("time.localtime(), %s" % label, rate(time.localtime, number)))
+            results.append(("time.strftime('%%Y-%%m-%%d %%H:%%M:%%S'), %s" % label, rate(lambda: time.strftime("%Y-%m-%d %H:%M:%S"), number)))
+            results.append(("time.ctime(), %s" % label, rate(time.ctime, number)))
+    finally:
+        virtualtime.disable_time_cache()
+        if not was_enabled:
+            virtualtime.disable()
+    return results
+
+@benchmark
+def bench_log_formatter(number=100000):
+    import logging
+    from virtualtime.log_formatter import VirtualTimeFormatter
+    record = logging.LogRecord("benchmark", logging.INFO, __file__, 1, "message", (), None)
+    results = []
+    was_enabled = virtualtime.enabled()
+    if not was_enabled:
+        virtualtime.enable()
+    try:
+        for formatter in (logging.Formatter("%(asctime)s %(message)s"), VirtualTimeFormatter("%(asctime)s %(message)s")):
+            results.append(("%s.format" % type(formatter).__name__, rate(lambda: formatter.format(record), number)))
+    finally:
+        if not was_enabled:
+            virtualtime.disable()
+    return results
+
+# the most time "import virtualtime" should take on its own, checked by test_virtualtime.TestImportCost
+IMPORT_TIME_BUDGET = 0.15
+
+def _import_seconds(statement, repeat=5):
+    """returns the best wall clock time of running statement in a fresh interpreter"""
+    import subprocess
+    code = "import time; start = time.time(); %s; print(time.time() - start)" % statement
+    return min(float(subprocess.check_output([sys.executable, "-c", code])) for n in range(repeat))
+
+@benchmark
+def bench_import_startup():
+    try:
+        import importlib.util
+        pandas_installed = importlib.util.find_spec('pandas') is not None
+    except ImportError:
+        import imp
+        try:
+            pandas_installed = imp.find_module('pandas') is not None
+        except ImportError:
+            pandas_installed = False
+    results = [
+        # setting sys.modules['pandas'] to None makes it unimportable, as if it weren't installed
+        ("import virtualtime, pandas not installed", 1 / _import_seconds("import sys; sys.modules['pandas'] = None; import virtualtime")),
+    ]
+    if pandas_installed:
+        results.append(("import virtualtime, pandas installed", 1 / _import_seconds("import virtualtime")))
+        results.append(("import virtualtime then pandas", 1 / _import_seconds("import virtualtime, pandas")))
+    return results
+
+def main(argv):
+    names = argv or list(BENCHMARKS)
+    for name in names:
+        for description, per_second in BENCHMARKS[name]():
+            print("%-60s %14.0f /s" % (description, per_second))
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
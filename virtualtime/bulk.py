@@ -0,0 +1,163 @@
+"""Bulk formatting and conversion of sequences (or NumPy arrays) of timestamps and datetimes.
+
+Formatting a large column of values through time.strftime or datetime.strftime pays for the virtual time overlays
+and the libc conversion on every value. These functions render each distinct second once, and reuse the result for
+every other value in that second, only filling in microseconds (%f) per value. The pre-1900 and pre-1000 handling of
+virtualtime's strftime is preserved. The iter_ variants yield results in chunks, so very large inputs can be streamed.
+
+The conversions from datetimes to epoch times use exact arithmetic for UTC, and the cached offset of each local hour
+for local time, only falling back to time.mktime for values near a daylight savings transition."""
+
+import math
+import sys
+import virtualtime
+from virtualtime import alt_time_funcs
+
+# NumPy is only used if it has already been imported elsewhere, since values can't be NumPy arrays otherwise
+numpy = None
+
+# bounds the number of rendered seconds kept while formatting, so that memory use stays flat for huge inputs
+MAX_CACHED_SECONDS = 65536
+# the number of NumPy array elements converted and rendered at a time when streaming
+NUMPY_CHUNK_SIZE = 65536
+
+def _parse_microsecond_format(format_str):
+    """splits format_str around %f directives (respecting escaped %%), returning a tuple of the segments"""
+    segments, start = [], 0
+    for m in alt_time_funcs.format_re.finditer(format_str):
+        if m.group(0) == '%f':
+            segments.append(format_str[start:m.start()])
+            start = m.end()
+    segments.append(format_str[start:])
+    return tuple(segments)
+
+_microsecond_format_cache = alt_time_funcs.FormatCache(_parse_microsecond_format)
+
+class _SecondFormatter(object):
+    """renders a format for whole seconds, caching the rendered segments around %f for each distinct second"""
+    def __init__(self, format_str, render):
+        self.segments = _microsecond_format_cache.get(format_str)
+        self.render = render
+        self.cache = {}
+        self.last_key = self.last_value = None
+
+    def rendered(self, key, value):
+        """returns the rendered segments for the second identified by key, calling render(segment, value) if it isn't cached"""
+        if key == self.last_key:
+            return self.last_value
+        rendered = self.cache.get(key)
+        if rendered is None:
+            rendered = tuple(self.render(segment, value) for segment in self.segments)
+            if len(self.cache) >= MAX_CACHED_SECONDS:
+                self.cache.clear()
+            self.cache[key] = rendered
+        self.last_key, self.last_value = key, rendered
+        return rendered
+
+    def format(self, key, value, microsecond):
+        rendered = self.rendered(key, value)
+        if len(rendered) == 1:
+            return rendered[0]
+        return ('%06d' % microsecond).join(rendered)
+
+def _time_renderer(utc):
+    convert = virtualtime._original_gmtime if utc else virtualtime._original_localtime
+    strftime = virtualtime._original_strftime
+    return lambda segment, second: strftime(segment, convert(second))
+
+def _split_time(t):
+    """splits an epoch time into whole seconds and microseconds"""
+    second = int(math.floor(t))
+    microsecond = int(round((t - second) * 1000000))
+    if microsecond >= 1000000:
+        second, microsecond = second + 1, microsecond - 1000000
+    return second, microsecond
+
+def _is_numpy_array(values):
+    global numpy
+    if numpy is None:
+        numpy = sys.modules.get('numpy')
+        if numpy is None:
+            return False
+    return isinstance(values, numpy.ndarray)
+
+def _numpy_epoch_microseconds(values):
+    """converts a NumPy array of epoch seconds or datetime64 values to int64 microseconds since the epoch"""
+    if values.dtype.kind == 'M':
+        return values.astype('datetime64[us]').astype('int64')
+    return numpy.round(numpy.asarray(values, dtype='float64') * 1000000).astype('int64')
+
+def _iter_format_numpy(formatter, values):
+    """renders a NumPy array a chunk at a time, rendering each distinct second in a chunk once"""
+    for start in range(0, len(values), NUMPY_CHUNK_SIZE):
+        seconds, microseconds = numpy.divmod(_numpy_epoch_microseconds(values[start:start + NUMPY_CHUNK_SIZE]), 1000000)
+        unique_seconds, inverse = numpy.unique(seconds, return_inverse=True)
+        rendered = [formatter.rendered(second, second) for second in unique_seconds.tolist()]
+        if len(formatter.segments) == 1:
+            for index in inverse.tolist():
+                yield rendered[index][0]
+        else:
+            for index, microsecond in zip(inverse.tolist(), microseconds.tolist()):
+                yield ('%06d' % microsecond).join(rendered[index])
+
+def iter_format_times(format_str, times, utc=False):
+    """Yields format_str rendered as time.strftime would for each of the given epoch times, with %f giving microseconds.
+    Times are converted to local time unless utc is set. times may also be a NumPy array of numbers or datetime64 values;
+    datetime64 values are naive, so are always rendered as UTC"""
+    if _is_numpy_array(times):
+        formatter = _SecondFormatter(format_str, _time_renderer(utc or times.dtype.kind == 'M'))
+        for text in _iter_format_numpy(formatter, times):
+            yield text
+        return
+    formatter = _SecondFormatter(format_str, _time_renderer(utc))
+    for t in times:
+        second, microsecond = _split_time(t)
+        yield formatter.format(second, second, microsecond)
+
+def format_times(format_str, times, utc=False):
+    """Returns a list of format_str rendered for each of the given epoch times - see iter_format_times"""
+    return list(iter_format_times(format_str, times, utc=utc))
+
+def _datetime_renderer():
+    strftime = virtualtime.datetime.strftime
+    return lambda segment, dt: strftime(dt, segment)
+
+def iter_format_datetimes(format_str, datetimes):
+    """Yields format_str rendered as datetime.strftime would for each of the given datetimes (which may be timezone-aware).
+    datetimes may also be a NumPy array of datetime64 values"""
+    if _is_numpy_array(datetimes):
+        for text in iter_format_times(format_str, datetimes, utc=True):
+            yield text
+        return
+    formatter = _SecondFormatter(format_str, _datetime_renderer())
+    for dt in datetimes:
+        # fold tells apart the two occurrences of a wall clock second in the hour that is repeated when daylight savings ends
+        key = (dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.tzinfo, getattr(dt, 'fold', 0))
+        yield formatter.format(key, dt, dt.microsecond)
+
+def format_datetimes(format_str, datetimes):
+    """Returns a list of format_str rendered for each of the given datetimes - see iter_format_datetimes"""
+    return list(iter_format_datetimes(format_str, datetimes))
+
+def local_datetimes_to_times(datetimes):
+    """Converts naive local datetimes to time.time()-equivalent floats, as virtualtime.local_datetime_to_time does.
+    If datetimes is a NumPy array of datetime64 values, a float64 array is returned"""
+    if _is_numpy_array(datetimes):
+        local_microseconds = _numpy_epoch_microseconds(datetimes)
+        local_seconds = local_microseconds // 1000000
+        unique_hours, inverse = numpy.unique(local_seconds // 3600, return_inverse=True)
+        hour_offsets = [virtualtime._local_hour_offset(hour) for hour in unique_hours.tolist()]
+        offsets = numpy.array([numpy.nan if offset is None else offset for offset in hour_offsets], dtype='float64')[inverse]
+        result = local_microseconds / 1000000.0 - offsets
+        # values near daylight savings transitions don't have a unique offset, so are converted individually
+        for index in numpy.flatnonzero(numpy.isnan(offsets)).tolist():
+            result[index] = virtualtime.local_datetime_to_time(datetimes[index].astype('datetime64[us]').item())
+        return result
+    return [virtualtime.local_datetime_to_time(dt) for dt in datetimes]
+
+def utc_datetimes_to_times(datetimes):
+    """Converts naive utc datetimes (or aware datetimes) to time.time()-equivalent floats, as virtualtime.utc_datetime_to_time does.
+    If datetimes is a NumPy array of datetime64 values, a float64 array is returned"""
+    if _is_numpy_array(datetimes):
+        return _numpy_epoch_microseconds(datetimes) / 1000000.0
+    return [virtualtime.utc_datetime_to_time(dt) for dt in datetimes]
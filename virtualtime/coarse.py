@@ -0,0 +1,121 @@
+"""A coarse virtual clock for callers that read the time at very high rates but only need it to a few milliseconds.
+
+coarse_time() and coarse_now() return a virtual timestamp cached by a ticker thread, which refreshes it every
+resolution seconds, so the hot path doesn't read the OS clock or add the offset. Changes to the virtual time offset
+update the cached timestamp immediately, so coarse readers never see time from before a set_offset or fast forward
+step. Between ticks the coarse clock runs behind the real virtual time by at most the resolution."""
+
+import threading
+import time
+import virtualtime
+
+DEFAULT_RESOLUTION = 0.01
+
+_resolution = DEFAULT_RESOLUTION
+# the cached virtual time, or None if the ticker isn't running
+_coarse_time = None
+# the datetime for the cached virtual time, as (coarse time, time.tzname, datetime)
+_coarse_datetime = None
+_ticker_stop = None
+# guards starting and stopping the ticker. Anything that needs the virtual time state too takes that first, and the
+# ticker itself never takes it, so the two locks are always taken in the same order
+_ticker_lock = threading.Lock()
+
+def _on_change(change):
+    """called with the virtual time state locked whenever the offset changes"""
+    global _coarse_time
+    if _coarse_time is not None:
+        _coarse_time = virtualtime._original_time() + change.offset
+
+def _tick(stop, resolution):
+    global _coarse_time
+    while not stop.wait(resolution):
+        while True:
+            generation = virtualtime._offset_generation
+            t = virtualtime._original_time() + virtualtime._time_offset
+            with _ticker_lock:
+                # checked under the lock, so that a stopped ticker can't bring back a cached time after stop_coarse_clock
+                if stop.is_set():
+                    return
+                _coarse_time = t
+            # the generation moves before _on_change runs, so if it hasn't moved, any change since the offset was read
+            # will still update the cached time itself; otherwise the time may be from the old offset, and is read again
+            if virtualtime._offset_generation == generation:
+                break
+
+def _start():
+    """starts a new ticker, stopping any existing one - must be called with the virtual time state held (and _on_change
+    added as a change listener), and then _ticker_lock"""
+    global _coarse_time, _ticker_stop
+    if _ticker_stop is not None:
+        _ticker_stop.set()
+    _ticker_stop = threading.Event()
+    _coarse_time = virtualtime._original_time() + virtualtime._time_offset
+    ticker = threading.Thread(target=_tick, args=(_ticker_stop, _resolution), name="virtualtime_coarse_clock")
+    ticker.daemon = True
+    ticker.start()
+    return _coarse_time
+
+def start_coarse_clock(resolution=None):
+    """Starts (or restarts) the ticker thread that refreshes the coarse clock every resolution seconds.
+    It is started automatically with the current resolution when the coarse clock is first read"""
+    global _resolution
+    virtualtime._virtual_time_state.acquire()
+    try:
+        virtualtime._add_change_listener(_on_change)
+        with _ticker_lock:
+            if resolution is not None:
+                _resolution = resolution
+            return _start()
+    finally:
+        virtualtime._virtual_time_state.release()
+
+def stop_coarse_clock():
+    """Stops the ticker thread; the coarse clock will start it again if it is read"""
+    global _coarse_time, _coarse_datetime, _ticker_stop
+    virtualtime._virtual_time_state.acquire()
+    try:
+        virtualtime._remove_change_listener(_on_change)
+        with _ticker_lock:
+            if _ticker_stop is not None:
+                _ticker_stop.set()
+                _ticker_stop = None
+            _coarse_time = _coarse_datetime = None
+    finally:
+        virtualtime._virtual_time_state.release()
+
+def get_coarse_resolution():
+    """Returns the number of seconds between ticks of the coarse clock"""
+    return _resolution
+
+def _start_if_stopped():
+    """starts the ticker unless another thread has just done so, returning the coarse time"""
+    virtualtime._virtual_time_state.acquire()
+    try:
+        if _coarse_time is not None:
+            return _coarse_time
+        virtualtime._add_change_listener(_on_change)
+        with _ticker_lock:
+            return _start()
+    finally:
+        virtualtime._virtual_time_state.release()
+
+def coarse_time():
+    """Returns the virtual time.time() as of the last tick of the coarse clock"""
+    t = _coarse_time
+    if t is None:
+        return _start_if_stopped()
+    return t
+
+def coarse_now():
+    """Returns the virtual datetime.now() as of the last tick of the coarse clock"""
+    global _coarse_datetime
+    t = _coarse_time
+    if t is None:
+        t = _start_if_stopped()
+    cached = _coarse_datetime
+    if cached is not None and cached[0] == t and cached[1] is time.tzname:
+        return cached[2]
+    dt = virtualtime._virtual_datetime_type.fromtimestamp(t)
+    _coarse_datetime = (t, time.tzname, dt)
+    return dt
@@ -0,0 +1,131 @@
+"""Imports datetime-sensitive packages such as pandas with the original datetime.datetime type in place.
+
+virtualtime replaces datetime.datetime with a subclass when it is imported. Some compiled packages (notably pandas)
+capture and check the datetime type when they are loaded, and break if they see the subclass. Rather than importing
+them all eagerly when virtualtime is imported, this installs a meta path hook that wraps the loaders of the registered
+packages (and their submodules).
+
+Python modules of those packages are executed with builtins whose __import__ hands them a proxy of the datetime
+module with the original datetime type in place, so only the loading module sees it, and the rest of the process is
+unaffected. Extension modules import datetime through the C API, which can't be redirected per module, so while one
+is created or executed datetime.datetime itself is the original type, and it is swapped back as soon as no extension
+module of those packages is being loaded."""
+
+import sys
+import threading
+import virtualtime
+from virtualtime.scoped import ProxyModule
+from importlib.machinery import ExtensionFileLoader
+import builtins
+
+# top-level packages that must see the original datetime.datetime type while they are loaded
+_datetime_sensitive_packages = set(['pandas'])
+# the number of extension modules being initialized with the original type in place, and the lock that guards it.
+# The lock is only held while swapping the type, never while a module is loading, so that concurrent imports can't deadlock
+_loading_depth = 0
+_loading_lock = threading.Lock()
+
+def _is_datetime_sensitive(fullname):
+    return fullname.partition('.')[0] in _datetime_sensitive_packages
+
+# the datetime module as the Python modules of datetime-sensitive packages see it
+_datetime_proxy = ProxyModule(virtualtime._original_datetime_module, {'datetime': virtualtime._underlying_datetime_type})
+
+def _import_original_datetime(name, globals=None, locals=None, fromlist=(), level=0):
+    """__import__ for datetime-sensitive modules, which gives them the datetime proxy in place of the datetime module"""
+    module = builtins.__import__(name, globals, locals, fromlist, level)
+    if module is virtualtime._original_datetime_module:
+        return _datetime_proxy
+    return module
+
+def _original_datetime_builtins():
+    """returns a copy of the builtins with __import__ replaced by _import_original_datetime"""
+    module_builtins = dict(builtins.__dict__)
+    module_builtins['__import__'] = _import_original_datetime
+    return module_builtins
+
+class _original_datetime_restored(object):
+    """context manager that puts the original datetime.datetime type in the datetime module while an extension module is
+    initialized, and puts the virtual type back once no other initialization needs it - unless it has been replaced since"""
+    def __enter__(self):
+        global _loading_depth
+        with _loading_lock:
+            if _loading_depth == 0:
+                virtualtime._original_datetime_module.datetime = virtualtime._underlying_datetime_type
+            _loading_depth += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _loading_depth
+        with _loading_lock:
+            _loading_depth -= 1
+            datetime_module = virtualtime._original_datetime_module
+            if _loading_depth == 0 and datetime_module.datetime is virtualtime._underlying_datetime_type:
+                datetime_module.datetime = virtualtime._original_datetime_type
+
+class DatetimeSensitiveLoader(object):
+    """Wraps another loader, so that the module sees the original datetime.datetime type while it is created and executed"""
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        # delegates is_package, get_resource_reader and friends to the wrapped loader
+        return getattr(self.loader, name)
+
+    def create_module(self, spec):
+        # extension modules are initialized here rather than in exec_module
+        create_module = getattr(self.loader, 'create_module', None)
+        if create_module is None:
+            return None
+        with _original_datetime_restored():
+            return create_module(spec)
+
+    def exec_module(self, module):
+        if isinstance(self.loader, ExtensionFileLoader):
+            # extension modules using multi-phase initialization run their code here
+            with _original_datetime_restored():
+                self.loader.exec_module(module)
+        else:
+            # functions defined by the module keep these builtins, so imports of datetime they make later get the proxy too
+            module.__dict__.setdefault('__builtins__', _original_datetime_builtins())
+            self.loader.exec_module(module)
+
+class DatetimeSensitiveFinder(object):
+    """Meta path finder that finds registered packages using the rest of sys.meta_path, and wraps their loaders"""
+    def __init__(self):
+        self._finding = threading.local()
+
+    def find_spec(self, fullname, path, target=None):
+        if not _is_datetime_sensitive(fullname) or getattr(self._finding, 'active', False):
+            return None
+        self._finding.active = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._finding.active = False
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module') and not isinstance(spec.loader, DatetimeSensitiveLoader):
+            spec.loader = DatetimeSensitiveLoader(spec.loader)
+        return spec
+
+_finder = DatetimeSensitiveFinder()
+
+def install():
+    """Adds the finder to the start of sys.meta_path, if it isn't already there"""
+    if _finder not in sys.meta_path:
+        sys.meta_path.insert(0, _finder)
+
+def uninstall():
+    """Removes the finder from sys.meta_path"""
+    if _finder in sys.meta_path:
+        sys.meta_path.remove(_finder)
+
+def register_datetime_sensitive_package(name):
+    """Makes sure the given top-level package is loaded with the original datetime.datetime type in place.
+    Has no effect on modules that have already been imported"""
+    _datetime_sensitive_packages.add(name.partition('.')[0])
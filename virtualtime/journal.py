@@ -0,0 +1,207 @@
+"""Records the changes to the virtual time offset in a compact binary journal, and replays them.
+
+A JournalRecorder appends an entry for every set_offset, set_time and restore_time, every fast forward step, and the
+completion of each fast forward. It can also record every nth read of time.time(). Entries are fixed-size records of
+(kind, real time, offset), written straight into a memory-mapped file that grows as needed, so recording costs little
+more than packing the record. Entries are written as they happen, so a journal can be read after a crash, up to the
+last record that reached the file.
+
+replay_journal() re-applies the recorded changes at the same (or a scaled) real interval, setting the virtual time at
+each change to the virtual time it was set to when recorded, so a failing run can be reproduced on the same virtual
+schedule."""
+
+import collections
+import mmap
+import struct
+import threading
+import virtualtime
+
+MAGIC = b'VTJOURN1'
+# each entry is the kind, the real time.time() at which it was recorded, and the virtual time offset in effect
+_RECORD = struct.Struct('<Bdd')
+INITIAL_CAPACITY = 4096
+
+# the kinds of entry; zero marks the end of the records in a journal that wasn't closed
+START = 1
+OFFSET_CHANGE = 2
+FAST_FORWARD_STEP = 3
+FAST_FORWARD_COMPLETE = 4
+TIME_READ = 5
+
+JournalEntry = collections.namedtuple('JournalEntry', ['kind', 'real_time', 'offset'])
+
+class JournalRecorder(object):
+    """Records the virtual time offset changes to the journal file at path while started.
+    If sample_reads is set, every sample_reads-th call to time.time() through the time module is recorded too, while the
+    virtual version is in place there (not while adaptive patching has the original in place, nor for references that
+    were copied out of the module or scoped proxies). The patch target itself is left alone: the recorder puts its own
+    wrapper in the time module, and puts it back whenever patching or an offset change replaces it"""
+    def __init__(self, path, sample_reads=0, capacity=INITIAL_CAPACITY):
+        self.path = path
+        self.sample_reads = sample_reads
+        self.capacity = capacity
+        self.count = 0
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()
+        self._reads = 0
+        self._sampler = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _map_file(self):
+        size = len(MAGIC) + self.capacity * _RECORD.size
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _append(self, kind, real_time, offset):
+        with self._lock:
+            if self._map is None:
+                return
+            if self.count == self.capacity:
+                self._map.close()
+                self.capacity *= 2
+                self._map_file()
+            _RECORD.pack_into(self._map, len(MAGIC) + self.count * _RECORD.size, kind, real_time, offset)
+            self.count += 1
+
+    def _on_change(self, change):
+        if self._sampler is not None:
+            self._install_sampler()
+        if change.is_fast_forward_complete:
+            kind = FAST_FORWARD_COMPLETE
+        elif change.is_fast_forward_change:
+            kind = FAST_FORWARD_STEP
+        else:
+            kind = OFFSET_CHANGE
+        self._append(kind, virtualtime._original_time(), change.offset)
+
+    def _build_sampler(self):
+        """returns the time.time() the recorder puts in the time module: the virtual version, recording every
+        sample_reads-th call"""
+        original_time = virtualtime._original_time
+        append = self._append
+        def sampled_time():
+            offset = virtualtime._time_offset
+            t = original_time()
+            # the count isn't locked, as it only decides which reads are sampled
+            self._reads += 1
+            if self._reads >= self.sample_reads:
+                self._reads = 0
+                append(TIME_READ, t, offset)
+            return t + offset
+        # lets enabled(verify=True) recognise it as the virtual time.time()
+        sampled_time._virtual_stand_in_for = virtualtime._patch_targets['time.time'].virtual
+        return sampled_time
+
+    def _install_sampler(self):
+        """puts the sampler in the time module if the virtual time.time() is there - must be called with _virtual_time_state held"""
+        target = virtualtime._patch_targets['time.time']
+        if getattr(target.owner, target.attribute) is target.virtual:
+            setattr(target.owner, target.attribute, self._sampler)
+
+    def _on_patch(self, patched):
+        if patched:
+            self._install_sampler()
+
+    def start(self):
+        """Creates the journal file, records the current offset, and starts recording changes"""
+        self._file = open(self.path, 'w+b')
+        try:
+            self._file.write(MAGIC)
+            self._file.flush()
+            self._map_file()
+        except Exception:
+            self._file.close()
+            self._file = None
+            raise
+        self.count = 0
+        virtualtime._virtual_time_state.acquire()
+        try:
+            self._append(START, virtualtime._original_time(), virtualtime._time_offset)
+            virtualtime._add_change_listener(self._on_change)
+            if self.sample_reads:
+                self._sampler = self._build_sampler()
+                virtualtime._add_patch_listener(self._on_patch)
+                self._install_sampler()
+        finally:
+            virtualtime._virtual_time_state.release()
+        return self
+
+    def stop(self):
+        """Stops recording, and truncates the journal file to the records written"""
+        virtualtime._virtual_time_state.acquire()
+        try:
+            virtualtime._remove_change_listener(self._on_change)
+            if self._sampler is not None:
+                virtualtime._remove_patch_listener(self._on_patch)
+                target = virtualtime._patch_targets['time.time']
+                if getattr(target.owner, target.attribute) is self._sampler:
+                    setattr(target.owner, target.attribute, target.virtual)
+                self._sampler = None
+        finally:
+            virtualtime._virtual_time_state.release()
+        with self._lock:
+            if self._map is None:
+                return
+            self._map.flush()
+            self._map.close()
+            self._map = None
+        self._file.truncate(len(MAGIC) + self.count * _RECORD.size)
+        self._file.close()
+        self._file = None
+
+def read_journal(path):
+    """Returns the list of JournalEntry records in the journal file at path"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a virtual time journal" % path)
+    entries = []
+    for position in range(len(MAGIC), len(data) - _RECORD.size + 1, _RECORD.size):
+        entry = JournalEntry(*_RECORD.unpack_from(data, position))
+        if entry.kind == 0:
+            break
+        entries.append(entry)
+    return entries
+
+def replay_journal(path, speed=1.0, cancel_event=None):
+    """Re-applies the changes recorded in the journal at path, waiting between them for the recorded real interval divided
+    by speed, and setting the virtual time at each to what it was when recorded. Time reads are skipped. Stops early if
+    cancel_event is set; returns the number of changes applied"""
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    entries = [entry for entry in read_journal(path) if entry.kind != TIME_READ]
+    if not entries:
+        return 0
+    first_real_time, replay_start = entries[0].real_time, virtualtime._original_time()
+    fast_forward_start_offset = None
+    applied = 0
+    for entry in entries:
+        wait = replay_start + (entry.real_time - first_real_time) / speed - virtualtime._original_time()
+        if wait > 0 and cancel_event.wait(wait):
+            break
+        if cancel_event.is_set():
+            break
+        if entry.kind == FAST_FORWARD_COMPLETE:
+            virtualtime._virtual_time_state.acquire()
+            try:
+                if virtualtime._virtual_time_change_listeners:
+                    previous_offset = virtualtime._time_offset if fast_forward_start_offset is None else fast_forward_start_offset
+                    virtualtime._dispatch_change(virtualtime.OffsetChange(virtualtime._time_offset, previous_offset, True, True))
+            finally:
+                virtualtime._virtual_time_state.release()
+            fast_forward_start_offset = None
+        else:
+            is_fast_forward_change = entry.kind == FAST_FORWARD_STEP
+            if is_fast_forward_change and fast_forward_start_offset is None:
+                fast_forward_start_offset = virtualtime._time_offset
+            virtualtime.set_time(entry.real_time + entry.offset, is_fast_forward_change=is_fast_forward_change,
+                                 suppress_log=is_fast_forward_change)
+        applied += 1
+    return applied
@@ -0,0 +1,47 @@
+"""A logging.Formatter that formats each second's timestamp once, rather than converting and formatting it for every record.
+
+With virtualtime enabled, logging.Formatter.formatTime runs the overlaid time.strftime for every record, which is a
+noticeable share of the cost of logging at high volumes. VirtualTimeFormatter keeps the formatted timestamp of recent
+seconds, and discards it when the virtual time offset or the timezone changes, so timestamps stay correct across
+set_offset jumps and fast forwards."""
+
+import logging
+import threading
+import time
+import virtualtime
+
+# records usually arrive in order, so only a few recent seconds need to be kept
+MAX_CACHED_SECONDS = 8
+
+class VirtualTimeFormatter(logging.Formatter):
+    """Drop-in replacement for logging.Formatter that caches the formatted time of each second"""
+    default_time_format = getattr(logging.Formatter, 'default_time_format', "%Y-%m-%d %H:%M:%S")
+    default_msec_format = getattr(logging.Formatter, 'default_msec_format', "%s,%03d")
+
+    def __init__(self, *args, **kwargs):
+        logging.Formatter.__init__(self, *args, **kwargs)
+        self._cache = {}
+        self._tzname = time.tzname
+        self._offset_changed = threading.Event()
+        virtualtime.notify_on_change(self._offset_changed)
+
+    def formatTime(self, record, datefmt=None):
+        """Returns the creation time of the record as formatted text, as logging.Formatter.formatTime does"""
+        if self._offset_changed.is_set() or self._tzname is not time.tzname:
+            self._offset_changed.clear()
+            self._tzname = time.tzname
+            self._cache.clear()
+        second = int(record.created)
+        if second > record.created:
+            second -= 1
+        key = (second, datefmt)
+        s = self._cache.get(key)
+        if s is None:
+            ct = self.converter(second)
+            s = time.strftime(datefmt or self.default_time_format, ct)
+            if len(self._cache) >= MAX_CACHED_SECONDS:
+                self._cache.clear()
+            self._cache[key] = s
+        if not datefmt and self.default_msec_format:
+            s = self.default_msec_format % (s, record.msecs)
+        return s
@@ -0,0 +1,202 @@
+"""Keeps the virtual clock state in a file, so that it survives the process being restarted.
+
+When the VIRTUALTIME_STATE_FILE environment variable names a file, virtualtime loads the offset, the offset generation
+and the mode (whether virtual time and adaptive patching were enabled) from it when it is imported, and keeps the file
+up to date from then on. Otherwise persistence can be started with enable_persistence(path). The file is rewritten
+atomically (by replacing it with a temporary file that has been synced to disk), so a process starting up never reads
+a partial state. If the file can't be understood anyway, importing virtualtime logs a warning and starts afresh.
+
+Writes happen on a background thread, so changing the offset never waits for the file. During a fast forward the steps
+are coalesced, and the state is written at most every FAST_FORWARD_WRITE_INTERVAL seconds until the fast forward
+completes, so persistence doesn't hold back the step rate. flush_state() waits for the latest state to be written."""
+
+import logging
+import math
+import numbers
+import os
+import threading
+import virtualtime
+
+ENVIRONMENT_VARIABLE = 'VIRTUALTIME_STATE_FILE'
+FAST_FORWARD_WRITE_INTERVAL = 1.0
+
+_replace = getattr(os, 'replace', os.rename)
+
+def _write_state(path, state):
+    import json
+    temporary_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary_path, 'w') as f:
+        json.dump(state, f)
+        # the data must be on disk before the rename is, or a crash can leave an empty or truncated file in place
+        f.flush()
+        os.fsync(f.fileno())
+    _replace(temporary_path, path)
+
+def read_state(path):
+    """Returns the state saved in the file at path as a dictionary with offset, generation, enabled and adaptive, or None if there is no file"""
+    import json
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError):
+        if os.path.exists(path):
+            raise
+        return None
+
+def _check_state(path, state):
+    """raises ValueError unless state has an offset, generation, enabled and adaptive of the types load_state expects"""
+    def is_number(value, kind):
+        return isinstance(value, kind) and not isinstance(value, bool) and not math.isnan(value) and not math.isinf(value)
+    if not isinstance(state, dict):
+        raise ValueError("%s does not hold a virtual time state" % path)
+    if not is_number(state.get("offset"), numbers.Real) or not is_number(state.get("generation"), numbers.Integral):
+        raise ValueError("%s has an invalid offset or generation: %r, %r" % (path, state.get("offset"), state.get("generation")))
+    if not isinstance(state.get("enabled"), bool) or not isinstance(state.get("adaptive", False), bool):
+        raise ValueError("%s has an invalid mode: %r, %r" % (path, state.get("enabled"), state.get("adaptive")))
+
+def load_state(path):
+    """Restores the offset, generation and mode saved in the file at path, if it exists, returning whether it did.
+    Raises ValueError, without changing anything, if the file doesn't hold a valid state"""
+    state = read_state(path)
+    if state is None:
+        return False
+    _check_state(path, state)
+    virtualtime._change_offset(state["offset"], suppress_log=True)
+    virtualtime._virtual_time_state.acquire()
+    try:
+        # the generation carries on from where the previous process left it, rather than from the change just made
+        virtualtime._offset_generation = max(virtualtime._offset_generation, state["generation"])
+    finally:
+        virtualtime._virtual_time_state.release()
+    if state.get("adaptive"):
+        virtualtime.enable_adaptive_patching()
+    if state["enabled"]:
+        virtualtime.enable()
+    logging.info("Virtual time state loaded from %s: offset %r, generation %r", path, state["offset"], state["generation"])
+    return True
+
+class _StateWriter(object):
+    """Writes the latest state it has been given to the file on a background thread"""
+    def __init__(self, path):
+        self.path = path
+        self._condition = threading.Condition()
+        self._pending = None
+        self._coalesce = False
+        self._writing = False
+        self._stopped = False
+        self._last_write = 0
+        self._thread = threading.Thread(target=self._run, name="virtualtime_state_writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def update(self, state, coalesce=False):
+        """Queues the state to be written, replacing any state not yet written. Coalesced states may wait for the write interval"""
+        with self._condition:
+            self._pending = state
+            self._coalesce = coalesce
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped and self._pending is None:
+                        return
+                    if self._pending is not None:
+                        wait = self._last_write + FAST_FORWARD_WRITE_INTERVAL - virtualtime._original_time() if self._coalesce else 0
+                        if wait <= 0 or self._stopped:
+                            break
+                        self._condition.wait(wait)
+                    else:
+                        self._condition.wait()
+                state, self._pending = self._pending, None
+                self._writing = True
+            try:
+                _write_state(self.path, state)
+            except Exception:
+                logging.exception("Could not write virtual time state to %s", self.path)
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._last_write = virtualtime._original_time()
+                    self._condition.notify_all()
+
+    def flush(self, timeout=None):
+        """Writes any pending state straight away, waiting until it has been written; returns whether it has"""
+        deadline = None if timeout is None else virtualtime._original_time() + timeout
+        with self._condition:
+            self._coalesce = False
+            self._condition.notify_all()
+            while self._pending is not None or self._writing:
+                remaining = None if deadline is None else deadline - virtualtime._original_time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._thread.join()
+
+_writer = None
+
+def _current_state():
+    # called with the virtual time state locked
+    return {"offset": virtualtime._time_offset, "generation": virtualtime._offset_generation,
+            "enabled": virtualtime._patched_count > 0, "adaptive": virtualtime._adaptive_patching}
+
+def _on_change(change):
+    writer = _writer
+    if writer is not None:
+        writer.update(_current_state(), coalesce=change.is_fast_forward_change and not change.is_fast_forward_complete)
+
+def _on_patch(patched):
+    writer = _writer
+    if writer is not None:
+        writer.update(_current_state())
+
+def enable_persistence(path=None):
+    """Saves the virtual clock state to the file at path (by default, the one named by VIRTUALTIME_STATE_FILE) whenever it changes"""
+    global _writer
+    path = path or os.environ[ENVIRONMENT_VARIABLE]
+    disable_persistence()
+    virtualtime._virtual_time_state.acquire()
+    try:
+        _writer = _StateWriter(path)
+        virtualtime._add_change_listener(_on_change)
+        virtualtime._add_patch_listener(_on_patch)
+        _writer.update(_current_state())
+    finally:
+        virtualtime._virtual_time_state.release()
+
+def disable_persistence():
+    """Writes the latest state, and stops saving changes to it"""
+    global _writer
+    virtualtime._virtual_time_state.acquire()
+    try:
+        writer, _writer = _writer, None
+        virtualtime._remove_change_listener(_on_change)
+        virtualtime._remove_patch_listener(_on_patch)
+    finally:
+        virtualtime._virtual_time_state.release()
+    if writer is not None:
+        writer.stop()
+
+def flush_state(timeout=None):
+    """Waits for the latest state to be written to the file, returning whether it has been (or persistence isn't enabled)"""
+    writer = _writer
+    return writer.flush(timeout) if writer is not None else True
+
+def _load_from_environment():
+    """Loads the state from the file named by VIRTUALTIME_STATE_FILE, if set, and keeps it up to date"""
+    path = os.environ.get(ENVIRONMENT_VARIABLE)
+    if path:
+        try:
+            load_state(path)
+        except (ValueError, KeyError, TypeError) as e:
+            logging.warning("Could not load virtual time state from %s, starting afresh: %s", path, e)
+        enable_persistence(path)
+        import atexit
+        atexit.register(disable_persistence)
@@ -0,0 +1,231 @@
+"""Finds and rebinds references to the patched clock functions that were copied out of their modules.
+
+Patching replaces attributes of the time and datetime modules, so code that did `from time import time, sleep`, or
+saved datetime.datetime.now in a global, a class attribute or a default argument, keeps the real function and ignores
+virtual time. The scanner looks for the originals (and virtual versions) of all the registered patch targets in the
+globals of every module in sys.modules, in the attributes of classes defined there, and in the default arguments of
+their functions and methods. It can report the references that don't match the current state, or rebind them.
+
+The places where references were found are kept in an index by module, and a module is only scanned again if it is
+new, or its globals have been added to or removed from. Rescanning a large application therefore only revisits the
+references it already knows about, so it is cheap enough to run on every enable() and disable(), which install() does.
+A global that is later reassigned to a clock function without changing the size of its module won't be noticed until
+a full scan. Modules that deliberately keep the real clock (for example with `from virtualtime import raw_time`) can
+be left alone with exclude_module().
+
+The standard library is never scanned: modules like logging, sched, _strptime and sqlite3 keep the real clock
+functions and types on purpose (or only use them as defaults that the patched modules already cover). Targets whose
+values are classes are skipped too, as rebinding a class changes what isinstance() and pickle see."""
+
+import logging
+import os
+import sys
+import types
+import virtualtime
+
+# threading must keep the original _time and _sleep on Python 2, and the patched modules are handled by patching itself.
+# The rest of the standard library is recognised by where it is loaded from, but these are named in case that fails
+_excluded_modules = set(['threading', 'time', 'datetime', '_datetime', '_strptime', 'sqlite3', 'logging', 'sched', 'virtualtime'])
+
+# the directory the standard library is loaded from, which holds site-packages (and dist-packages) too
+_stdlib_dir = os.path.dirname(os.path.abspath(os.__file__)) + os.sep
+_third_party_dirs = ('site-packages', 'dist-packages')
+
+# module name: (module, number of globals, list of references), as of the last scan; and the patch targets it was built for
+_index = {}
+_indexed_targets = ()
+
+class Reference(object):
+    """A place outside the patched modules that holds one of the patch targets' original or virtual functions.
+    kind is 'global', 'class' (an attribute of owner, which is a class), 'default' or 'kwdefault' (of owner, which is a function)"""
+    __slots__ = ('module_name', 'kind', 'owner', 'key')
+
+    def __init__(self, module_name, kind, owner, key):
+        self.module_name = module_name
+        self.kind = kind
+        self.owner = owner
+        self.key = key
+
+    def __repr__(self):
+        return "<Reference %s>" % self.description
+
+    @property
+    def description(self):
+        if self.kind == 'global':
+            return "%s.%s" % (self.module_name, self.key)
+        if self.kind == 'class':
+            return "%s.%s.%s" % (self.module_name, self.owner.__name__, self.key)
+        return "default argument %s of %s.%s" % (self.key, self.module_name, getattr(self.owner, '__qualname__', self.owner.__name__))
+
+    def get(self):
+        if self.kind == 'global':
+            return self.owner.get(self.key)
+        if self.kind == 'class':
+            value = self.owner.__dict__.get(self.key)
+            return value.__func__ if isinstance(value, staticmethod) else value
+        if self.kind == 'default':
+            defaults = self.owner.__defaults__ or ()
+            return defaults[self.key] if self.key < len(defaults) else None
+        return (self.owner.__kwdefaults__ or {}).get(self.key)
+
+    def set(self, value):
+        if self.kind == 'global':
+            self.owner[self.key] = value
+        elif self.kind == 'class':
+            if isinstance(self.owner.__dict__.get(self.key), staticmethod):
+                value = staticmethod(value)
+            setattr(self.owner, self.key, value)
+        elif self.kind == 'default':
+            defaults = list(self.owner.__defaults__)
+            defaults[self.key] = value
+            self.owner.__defaults__ = tuple(defaults)
+        else:
+            self.owner.__kwdefaults__[self.key] = value
+
+def exclude_module(name):
+    """Stops the scanner from looking at or rebinding anything in the given module or package"""
+    _excluded_modules.add(name)
+
+def include_module(name):
+    """Undoes exclude_module"""
+    _excluded_modules.discard(name)
+
+def _is_excluded(module_name):
+    while module_name:
+        if module_name in _excluded_modules:
+            return True
+        module_name = module_name.rpartition('.')[0]
+    return False
+
+def _is_stdlib(module_name, module):
+    """returns whether the module is built into the interpreter or loaded from the standard library"""
+    path = getattr(module, '__file__', None)
+    if not path:
+        return module_name in sys.builtin_module_names
+    path = os.path.abspath(path)
+    if not path.startswith(_stdlib_dir):
+        return False
+    return not any(part in _third_party_dirs for part in path[len(_stdlib_dir):].split(os.sep))
+
+def _target_values():
+    """returns a dictionary from the original and virtual functions of all the patch targets to the target, and the set of their types.
+    Targets whose values are classes are left out"""
+    values = {}
+    for target in virtualtime._patch_targets.values():
+        if isinstance(target.original, type) or isinstance(target.virtual, type):
+            continue
+        values[target.original] = target
+        values[target.virtual] = target
+    return values, set(type(value) for value in values)
+
+def _lookup(value, values, value_types):
+    # checking the type first avoids hashing (and comparing) arbitrary objects
+    if type(value) not in value_types:
+        return None
+    try:
+        return values.get(value)
+    except TypeError:
+        return None
+
+def _scan_function(module_name, function, values, value_types, references):
+    for n, value in enumerate(getattr(function, '__defaults__', None) or ()):
+        if _lookup(value, values, value_types) is not None:
+            references.append(Reference(module_name, 'default', function, n))
+    for key, value in (getattr(function, '__kwdefaults__', None) or {}).items():
+        if _lookup(value, values, value_types) is not None:
+            references.append(Reference(module_name, 'kwdefault', function, key))
+
+def _scan_class(module_name, cls, values, value_types, references):
+    for key, value in list(cls.__dict__.items()):
+        if isinstance(value, staticmethod):
+            value = value.__func__
+        elif isinstance(value, classmethod):
+            _scan_function(module_name, value.__func__, values, value_types, references)
+            continue
+        if _lookup(value, values, value_types) is not None:
+            references.append(Reference(module_name, 'class', cls, key))
+        elif isinstance(value, types.FunctionType):
+            _scan_function(module_name, value, values, value_types, references)
+
+def _scan_module(module_name, namespace, values, value_types):
+    references = []
+    for key, value in list(namespace.items()):
+        if _lookup(value, values, value_types) is not None:
+            references.append(Reference(module_name, 'global', namespace, key))
+        elif isinstance(value, types.FunctionType):
+            if getattr(value, '__module__', None) == module_name:
+                _scan_function(module_name, value, values, value_types, references)
+        elif isinstance(value, type):
+            if getattr(value, '__module__', None) == module_name:
+                _scan_class(module_name, value, values, value_types, references)
+    return references
+
+def _scan(full=False):
+    """Updates the index, scanning new and changed modules (or every module, if full is set), and returns a list of
+    (reference, target) pairs for all the references to patch target functions that were found"""
+    global _index, _indexed_targets
+    values, value_types = _target_values()
+    targets = tuple(virtualtime._patch_targets.values())
+    if targets != _indexed_targets:
+        full, _indexed_targets = True, targets
+    index, found = {}, []
+    for module_name, module in list(sys.modules.items()):
+        if module is None or _is_excluded(module_name):
+            continue
+        namespace = getattr(module, '__dict__', None)
+        if not isinstance(namespace, dict):
+            continue
+        entry = _index.get(module_name)
+        if full or entry is None or entry[0] is not module or entry[1] != len(namespace):
+            references = [] if _is_stdlib(module_name, module) else _scan_module(module_name, namespace, values, value_types)
+            entry = (module, len(namespace), references)
+        index[module_name] = entry
+        for reference in entry[2]:
+            target = _lookup(reference.get(), values, value_types)
+            if target is not None:
+                found.append((reference, target))
+    _index = index
+    return found
+
+def find_stale_references(full=False):
+    """Returns a list of (reference, target) pairs for the references that hold the original function of a patched
+    target, or the virtual function of an unpatched one"""
+    virtualtime._virtual_time_state.acquire()
+    try:
+        stale = []
+        for reference, target in _scan(full):
+            wanted = target.virtual if target.patched else target.original
+            if reference.get() != wanted:
+                stale.append((reference, target))
+        return stale
+    finally:
+        virtualtime._virtual_time_state.release()
+
+def rebind_stale_references(full=False):
+    """Rebinds all the stale references to match the state of their targets, returning the list of (reference, target) pairs changed"""
+    virtualtime._virtual_time_state.acquire()
+    try:
+        stale = find_stale_references(full)
+        for reference, target in stale:
+            reference.set(target.virtual if target.patched else target.original)
+        return stale
+    finally:
+        virtualtime._virtual_time_state.release()
+
+def _report_stale_references(patched):
+    for reference, target in find_stale_references():
+        logging.warning("%s holds the %s %s while virtual time is %s", reference.description, "real" if patched else "virtual", target.name, "enabled" if patched else "disabled")
+
+def _rebind_stale_references(patched):
+    rebind_stale_references()
+
+def install(rebind=True):
+    """Scans for stale references each time virtual time is enabled or disabled, and rebinds them, or else logs a
+    warning for each"""
+    uninstall()
+    virtualtime._add_patch_listener(_rebind_stale_references if rebind else _report_stale_references)
+
+def uninstall():
+    """Stops scanning when virtual time is enabled or disabled"""
+    virtualtime._remove_patch_listener(_rebind_stale_references)
+    virtualtime._remove_patch_listener(_report_stale_references)
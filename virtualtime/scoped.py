@@ -0,0 +1,196 @@
+"""Virtual time for selected packages only, leaving the rest of the process on the real clock.
+
+enable() patches the time and datetime modules for everyone, so every library pays for the Python-level overlay
+functions, including hot paths that never need virtual time. enable_for() instead rebinds the module-level
+references of the chosen packages and modules: imported time and datetime modules are replaced with proxy modules
+whose clock functions are the virtual ones, and names imported from them (from time import time, from datetime import
+datetime) are replaced with the virtual versions. Everything outside the scoped packages keeps the raw functions.
+
+Modules of a scoped package that are imported later are scoped once they have been loaded (on Python 3.4 and later),
+so values computed from the clock while such a module is being imported still come from the real clock. References
+held inside functions and objects, rather than in module globals, classes and default arguments, are not changed."""
+
+import sys
+import threading
+import types
+import virtualtime
+from virtualtime import scanner
+
+# the packages and modules that use virtual time, and the references that have been rebound in each loaded module
+_scoped_packages = set()
+_rebound = {}
+_scope_lock = threading.RLock()
+
+class ProxyModule(types.ModuleType):
+    """A stand-in for a module, with some attributes replaced, that passes everything else through to the module"""
+    def __init__(self, module, replacements):
+        types.ModuleType.__init__(self, module.__name__, module.__doc__)
+        self.__dict__.update(replacements)
+        self.__dict__['_proxied_module'] = module
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['_proxied_module'], name)
+
+    def __repr__(self):
+        return "<virtual time proxy for %r>" % self.__dict__['_proxied_module']
+
+class _scoped_datetime_meta(type):
+    """the datetime type of scoped modules stands in for datetime.datetime, so every datetime instance and subclass should match it"""
+    def __instancecheck__(cls, instance):
+        return isinstance(instance, virtualtime._underlying_datetime_type)
+
+    def __subclasscheck__(cls, subclass):
+        return issubclass(subclass, virtualtime._underlying_datetime_type)
+
+def _scoped_datetime_new(cls, *args, **kwargs):
+    # the constructors (and fromtimestamp, strptime and the like, which call them) make instances of the real type
+    return virtualtime._original_datetime_type(*args, **kwargs)
+
+def _scoped_datetime_now(cls, tz=None):
+    """Virtualized datetime.datetime.now(), returning an instance of the real datetime type"""
+    return virtualtime._virtual_datetime_type.now.__func__(virtualtime._original_datetime_type, tz)
+
+def _scoped_datetime_today(cls):
+    """Virtualized datetime.datetime.today(), returning an instance of the real datetime type"""
+    return virtualtime._virtual_datetime_type.now.__func__(virtualtime._original_datetime_type)
+
+def _scoped_datetime_utcnow(cls):
+    """Virtualized datetime.datetime.utcnow(), returning an instance of the real datetime type"""
+    return virtualtime._virtual_datetime_type.utcnow.__func__(virtualtime._original_datetime_type)
+
+# calling the metaclass directly works the same way on Python 2 and 3
+_scoped_datetime_type = _scoped_datetime_meta('datetime', (virtualtime._original_datetime_type,), {
+    '__doc__': "Stands in for datetime.datetime in scoped modules, with a virtualized now(), today() and utcnow()",
+    '__module__': virtualtime._original_datetime_type.__module__,
+    '__new__': _scoped_datetime_new,
+    'now': classmethod(_scoped_datetime_now),
+    'today': classmethod(_scoped_datetime_today),
+    'utcnow': classmethod(_scoped_datetime_utcnow),
+})
+
+# (patch targets, {id(module): proxy}) for the targets the proxies were built from
+_proxies = ((), {})
+
+def _get_proxies():
+    """returns a dictionary from the ids of modules with patch targets to proxy modules with the virtual functions in place"""
+    global _proxies
+    targets = tuple(virtualtime._patch_targets.values())
+    if _proxies[0] != targets:
+        replacements = {}
+        for target in targets:
+            if isinstance(target.owner, types.ModuleType):
+                replacements.setdefault(target.owner, {})[target.attribute] = target.virtual
+        datetime_module = virtualtime._original_datetime_module
+        replacements.setdefault(datetime_module, {})['datetime'] = _scoped_datetime_type
+        # datetime.date.today() follows time.time, which isn't patched outside enable(), so scoped modules need virtual_date
+        replacements[datetime_module]['date'] = virtualtime._virtual_date_type
+        _proxies = (targets, dict((id(module), ProxyModule(module, module_replacements)) for module, module_replacements in replacements.items()))
+    return _proxies[1]
+
+def _is_scoped(module_name):
+    while module_name:
+        if module_name in _scoped_packages:
+            return True
+        module_name = module_name.rpartition('.')[0]
+    return False
+
+def _scope_module(module_name, module):
+    """rebinds the references in the module to virtual versions, recording what they were"""
+    namespace = getattr(module, '__dict__', None)
+    if not isinstance(namespace, dict) or module_name in _rebound:
+        return
+    proxies = _get_proxies()
+    values, value_types = scanner._target_values()
+    rebound = []
+    for key, value in list(namespace.items()):
+        if isinstance(value, types.ModuleType) and id(value) in proxies:
+            rebound.append((scanner.Reference(module_name, 'global', namespace, key), value, proxies[id(value)]))
+        elif value is virtualtime._original_datetime_type:
+            rebound.append((scanner.Reference(module_name, 'global', namespace, key), value, _scoped_datetime_type))
+        elif value is virtualtime._underlying_date_type:
+            rebound.append((scanner.Reference(module_name, 'global', namespace, key), value, virtualtime._virtual_date_type))
+    for reference in scanner._scan_module(module_name, namespace, values, value_types):
+        value = reference.get()
+        target = scanner._lookup(value, values, value_types)
+        if target is not None and value == target.original:
+            rebound.append((reference, value, target.virtual))
+    for reference, original, replacement in rebound:
+        reference.set(replacement)
+    _rebound[module_name] = rebound
+
+def _unscope_module(module_name):
+    """puts back the references that _scope_module replaced, unless they have been changed since"""
+    for reference, original, replacement in _rebound.pop(module_name, ()):
+        if reference.get() is replacement:
+            reference.set(original)
+
+def enable_for(*names):
+    """Makes the given packages and modules (and their submodules, including any imported later) use virtual time,
+    without patching the time and datetime modules for the rest of the process"""
+    with _scope_lock:
+        for name in names:
+            _scoped_packages.add(name)
+            # the scanner mustn't put the real functions back when virtual time is disabled
+            scanner.exclude_module(name)
+        for module_name, module in list(sys.modules.items()):
+            if module is not None and _is_scoped(module_name):
+                _scope_module(module_name, module)
+        if _finder is not None and _finder not in sys.meta_path:
+            sys.meta_path.insert(0, _finder)
+
+def disable_for(*names):
+    """Puts the real clock functions back in the given packages and modules, which must have been passed to enable_for"""
+    with _scope_lock:
+        for name in names:
+            _scoped_packages.discard(name)
+            scanner.include_module(name)
+        for module_name in list(_rebound):
+            if not _is_scoped(module_name):
+                _unscope_module(module_name)
+        if not _scoped_packages and _finder in sys.meta_path:
+            sys.meta_path.remove(_finder)
+
+def enabled_for(module_name):
+    """Returns whether the given module is in a package that virtual time has been enabled for"""
+    return _is_scoped(module_name)
+
+class ScopedLoader(object):
+    """Wraps another loader, scoping the module once it has been executed"""
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        with _scope_lock:
+            if _is_scoped(module.__name__):
+                _scope_module(module.__name__, module)
+
+class ScopedFinder(object):
+    """Meta path finder that finds modules of scoped packages using the rest of sys.meta_path, and wraps their loaders"""
+    def __init__(self):
+        self._finding = threading.local()
+
+    def find_spec(self, fullname, path, target=None):
+        if not _is_scoped(fullname) or getattr(self._finding, 'active', False):
+            return None
+        self._finding.active = True
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+                spec = finder.find_spec(fullname, path, target)
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._finding.active = False
+        if spec.loader is not None and hasattr(spec.loader, 'exec_module') and not isinstance(spec.loader, ScopedLoader):
+            spec.loader = ScopedLoader(spec.loader)
+        return spec
+
+# loaders only have exec_module from Python 3.4, so before that only modules that have already been imported are scoped
+_finder = ScopedFinder() if sys.version_info >= (3, 4) else None
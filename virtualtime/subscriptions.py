@@ -0,0 +1,240 @@
+"""Runs plain callables on a bounded pool of worker threads when the virtual time offset changes.
+
+This is a lighter alternative to notify_on_change for large numbers of consumers, as it doesn't need a thread
+parked on an event per consumer. Each subscriber is called with an OffsetChange, in the order the changes happened,
+and never concurrently with itself. Exceptions raised by a subscriber are logged and don't affect other subscribers.
+Subscribers may also be coroutine functions, which are run to completion before the next change is delivered.
+
+During long fast forwards, subscribers that only need the latest value can coalesce changes, and can ask to only see
+fast forward steps at most every min_interval virtual seconds; they are still sent the final offset when it completes.
+Subscribers that don't coalesce keep at most max_pending undelivered changes, dropping the oldest if they fall behind."""
+
+import collections
+import logging
+import threading
+import types
+import virtualtime
+
+DEFAULT_MAX_WORKERS = 4
+# worker threads exit after being idle for this long, and are restarted when needed
+WORKER_IDLE_TIMEOUT = 5.0
+# the maximum number of changes a worker delivers to one subscriber before giving other subscribers a turn
+MAX_BATCH = 16
+# the number of undelivered changes kept for a subscriber that doesn't coalesce, before the oldest are dropped
+DEFAULT_MAX_PENDING = 10000
+
+# coroutines are recognised by type, so that asyncio (which is slow to import) is only imported when one first needs running
+_coroutine_type = getattr(types, 'CoroutineType', None)
+
+def _is_coroutine(value):
+    return _coroutine_type is not None and isinstance(value, _coroutine_type)
+
+class Subscription(object):
+    """A callable registered to be run on change; if coalesce is set, only the latest pending change is delivered"""
+    def __init__(self, pool, callback, coalesce=False, loop=None, min_interval=None, fast_forward_complete=False, max_pending=DEFAULT_MAX_PENDING):
+        self.pool = pool
+        self.callback = callback
+        self.coalesce = coalesce
+        self.loop = loop
+        self.min_interval = min_interval
+        self.fast_forward_complete = fast_forward_complete
+        self.max_pending = max_pending
+        self.errors = 0
+        self.dropped = 0
+        self._pending = collections.deque(maxlen=max_pending)
+        self._scheduled = False
+        self._last_offset = None
+
+    def __repr__(self):
+        return "Subscription(%r, coalesce=%r, min_interval=%r)" % (self.callback, self.coalesce, self.min_interval)
+
+    def _wants(self, change):
+        """filters out fast forward steps within min_interval of the last change, and unneeded fast forward completions"""
+        if change.is_fast_forward_complete:
+            return self.fast_forward_complete or change.offset != self._last_offset
+        if self.min_interval and change.is_fast_forward_change and self._last_offset is not None:
+            return abs(change.offset - self._last_offset) >= self.min_interval
+        return True
+
+    def cancel(self):
+        """Stops delivering changes to this subscriber (changes already being delivered will complete)"""
+        self.pool.remove(self)
+
+    def _offer(self, change):
+        """queues the change, returning True if the subscription needs to be scheduled - must be called with the pool lock held"""
+        if not self._wants(change):
+            return False
+        self._last_offset = change.offset
+        if self.coalesce:
+            self._pending.clear()
+        elif len(self._pending) == self.max_pending:
+            self.dropped += 1
+        self._pending.append(change)
+        if self._scheduled:
+            return False
+        self._scheduled = True
+        return True
+
+    def _deliver(self, change):
+        try:
+            result = self.callback(change)
+            if _is_coroutine(result):
+                _run_coroutine(result, self.loop)
+        except Exception:
+            self.errors += 1
+            logging.exception("Virtual time subscriber %r failed handling %r", self.callback, change)
+
+_thread_state = threading.local()
+
+def _run_coroutine(coroutine, loop=None):
+    """runs the coroutine to completion, either on the given event loop or on a private loop for this worker thread,
+    which is closed when the worker exits"""
+    import asyncio
+    if loop is not None:
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+    worker_loop = getattr(_thread_state, 'loop', None)
+    if worker_loop is None:
+        worker_loop = _thread_state.loop = asyncio.new_event_loop()
+    return worker_loop.run_until_complete(coroutine)
+
+def _close_worker_loop():
+    """closes the private event loop of this worker thread, if it created one"""
+    worker_loop = getattr(_thread_state, 'loop', None)
+    if worker_loop is not None:
+        _thread_state.loop = None
+        worker_loop.close()
+
+class SubscriberPool(object):
+    """Delivers offset changes to subscriptions using at most max_workers threads"""
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.subscriptions = []
+        self._lock = threading.Lock()
+        self._work_available = threading.Condition(self._lock)
+        self._work_done = threading.Condition(self._lock)
+        self._ready = collections.deque()
+        self._worker_count = 0
+        self._idle_workers = 0
+        self._busy_workers = 0
+
+    def add(self, subscription):
+        self._lock.acquire()
+        try:
+            self.subscriptions.append(subscription)
+        finally:
+            self._lock.release()
+
+    def remove(self, subscription):
+        self._lock.acquire()
+        try:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+            subscription._pending.clear()
+        finally:
+            self._lock.release()
+
+    def submit(self, change):
+        """queues the change for every subscription, and wakes or starts workers to deliver it"""
+        self._lock.acquire()
+        try:
+            for subscription in self.subscriptions:
+                if subscription._offer(change):
+                    self._ready.append(subscription)
+            if self._ready:
+                self._work_available.notify(len(self._ready))
+                while self._worker_count < self.max_workers and self._worker_count - self._idle_workers < len(self._ready):
+                    self._start_worker()
+        finally:
+            self._lock.release()
+
+    def _start_worker(self):
+        self._worker_count += 1
+        worker = threading.Thread(target=self._work, name="virtualtime_subscriber_%d" % self._worker_count)
+        worker.daemon = True
+        worker.start()
+
+    def _work(self):
+        try:
+            self._deliver_ready()
+        finally:
+            _close_worker_loop()
+
+    def _deliver_ready(self):
+        self._lock.acquire()
+        try:
+            while True:
+                if not self._ready:
+                    self._idle_workers += 1
+                    self._work_available.wait(WORKER_IDLE_TIMEOUT)
+                    self._idle_workers -= 1
+                    if not self._ready:
+                        self._worker_count -= 1
+                        return
+                subscription = self._ready.popleft()
+                self._busy_workers += 1
+                for _ in range(MAX_BATCH):
+                    if not subscription._pending:
+                        break
+                    change = subscription._pending.popleft()
+                    self._lock.release()
+                    try:
+                        subscription._deliver(change)
+                    finally:
+                        self._lock.acquire()
+                if subscription._pending:
+                    self._ready.append(subscription)
+                else:
+                    subscription._scheduled = False
+                self._busy_workers -= 1
+                self._work_done.notify_all()
+        finally:
+            self._lock.release()
+
+    def join(self, timeout=None):
+        """Waits until all queued changes have been delivered, returning whether they have"""
+        deadline = None if timeout is None else virtualtime._original_time() + timeout
+        self._lock.acquire()
+        try:
+            while self._ready or self._busy_workers:
+                remaining = None if deadline is None else deadline - virtualtime._original_time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._work_done.wait(remaining)
+            return True
+        finally:
+            self._lock.release()
+
+_default_pool = None
+_default_pool_lock = threading.Lock()
+
+def get_pool():
+    """Returns the shared pool used by subscribe, creating it and listening for changes on first use"""
+    global _default_pool
+    with _default_pool_lock:
+        if _default_pool is None:
+            _default_pool = SubscriberPool()
+            virtualtime._add_change_listener(_default_pool.submit)
+        return _default_pool
+
+def set_max_workers(max_workers):
+    """Sets the number of worker threads the shared pool may use"""
+    get_pool().max_workers = max_workers
+
+def subscribe(callback, coalesce=False, loop=None, min_interval=None, fast_forward_complete=False, max_pending=DEFAULT_MAX_PENDING):
+    """Calls callback(change) on a worker thread with an OffsetChange whenever the virtual time offset changes, returning a Subscription.
+    If coalesce is set, changes that happen while the callback is still busy are collapsed into the latest one; otherwise
+    at most max_pending changes are queued, and the oldest are dropped (and counted in the subscription's dropped).
+    If min_interval is given, fast forward steps are only delivered once the offset has moved that many virtual seconds,
+    though the final offset is always delivered. If fast_forward_complete is set, an extra change with is_fast_forward_complete
+    is delivered at the end of every fast forward.
+    If callback is a coroutine function, it is run on loop if given, or else on a private loop in the worker thread.
+    Unlike notify_on_change, the callback is held by a strong reference until unsubscribe is called"""
+    pool = get_pool()
+    subscription = Subscription(pool, callback, coalesce=coalesce, loop=loop, min_interval=min_interval, fast_forward_complete=fast_forward_complete,
+                                max_pending=max_pending)
+    pool.add(subscription)
+    return subscription
+
+def unsubscribe(subscription):
+    """Stops calling the given subscription's callback on change"""
+    subscription.cancel()
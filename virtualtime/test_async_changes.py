@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+import virtualtime
+import threading
+import sys
+
+if sys.version_info >= (3, 7):
+    import asyncio
+
+    class TestAsyncChanges(object):
+        def teardown_method(self, method):
+            virtualtime.restore_time()
+
+        def test_changes(self):
+            """Changes made in another thread are delivered into the event loop in order"""
+            async def consume():
+                received = []
+                changes = virtualtime.changes()
+                thread = threading.Thread(target=virtualtime.fast_forward_time, args=(3,), kwargs={'step_wait': 0})
+                thread.start()
+                async for change in changes:
+                    received.append(change)
+                    if change.is_fast_forward_complete:
+                        break
+                changes.close()
+                thread.join()
+                return received
+            received = asyncio.run(asyncio.wait_for(consume(), 5))
+            assert [change.offset for change in received] == [1, 2, 3, 3]
+            assert all(change.is_fast_forward_change for change in received)
+
+        def test_drop_to_latest(self):
+            """A consumer that falls behind only sees the latest changes"""
+            async def consume():
+                changes = virtualtime.changes(maxsize=2)
+                for offset in range(1, 11):
+                    virtualtime.set_offset(offset, suppress_log=True)
+                changes.close()
+                return [change.offset async for change in changes], changes.dropped
+            offsets, dropped = asyncio.run(asyncio.wait_for(consume(), 5))
+            assert offsets == [9, 10]
+            assert dropped == 8
+
+        def test_close(self):
+            async def consume():
+                changes = virtualtime.changes()
+                asyncio.get_running_loop().call_later(0.05, changes.close)
+                return [change async for change in changes]
+            assert asyncio.run(asyncio.wait_for(consume(), 5)) == []
+            assert not [listener for listener in virtualtime._virtual_time_change_listeners if 'OffsetChanges' in repr(listener)]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import bulk
+import datetime
+import time
+import pytz
+import calendar
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+class TestBulkFormatting(object):
+    def test_format_times(self):
+        """Bulk formatting matches formatting each time individually, including repeated seconds and early years"""
+        base = time.mktime((2014, 3, 9, 1, 59, 58, 0, 0, -1))
+        times = [base + n * 0.25 for n in range(20)] + [base, -5000000000.5, 0, 1.999999]
+        format_str = "%Y-%m-%d %H:%M:%S %Z"
+        expected = [time.strftime(format_str, time.localtime(t)) for t in times]
+        assert virtualtime.format_times(format_str, times) == expected
+        expected_utc = [time.strftime(format_str, time.gmtime(t)) for t in times]
+        assert virtualtime.format_times(format_str, times, utc=True) == expected_utc
+
+    def test_format_times_microseconds(self):
+        assert virtualtime.format_times("%S.%f|%%f", [0.25, 1.5, 1.9999999, -0.5], utc=True) == \
+               ["00.250000|%f", "01.500000|%f", "02.000000|%f", "59.500000|%f"]
+
+    def test_format_datetimes(self):
+        london = pytz.timezone('Europe/London')
+        datetimes = [datetime.datetime(2020, 2, 20, 20, 20, 20, n * 1000) for n in range(5)]
+        datetimes += [london.localize(datetime.datetime(2020, 8, 20, 20, 20, 20, 5)), london.localize(datetime.datetime(2020, 2, 20, 20, 20, 20, 5))]
+        datetimes += [datetime.datetime(1812, 9, 10, 12, 7, 30), datetime.datetime(12, 9, 10, 12, 7, 30, 12)]
+        format_str = "%Y-%m-%d %H:%M:%S.%f %z %Z"
+        assert virtualtime.format_datetimes(format_str, datetimes) == [dt.strftime(format_str) for dt in datetimes]
+
+    if zoneinfo is not None:
+        def test_format_datetimes_ambiguous_hour(self):
+            """The two occurrences of a second in the repeated hour are formatted with their own offsets"""
+            chicago = zoneinfo.ZoneInfo('America/Chicago')
+            datetimes = [datetime.datetime(2020, 11, 1, 1, 30, tzinfo=chicago, fold=fold) for fold in (0, 1, 0)]
+            assert virtualtime.format_datetimes("%H:%M %z %Z", datetimes) == ["01:30 -0500 CDT", "01:30 -0600 CST", "01:30 -0500 CDT"]
+
+    def test_streaming(self):
+        formatted = virtualtime.iter_format_times("%H:%M:%S", (n for n in range(10 ** 9)), utc=True)
+        assert next(formatted) == "00:00:00"
+        assert next(formatted) == "00:00:01"
+
+    def test_cache_bound(self):
+        original_max = bulk.MAX_CACHED_SECONDS
+        bulk.MAX_CACHED_SECONDS = 3
+        try:
+            times = list(range(10)) * 2
+            assert virtualtime.format_times("%S", times, utc=True) == ["%02d" % (t,) for t in times]
+        finally:
+            bulk.MAX_CACHED_SECONDS = original_max
+
+    if numpy is not None:
+        def test_numpy(self):
+            times = numpy.array([0.25, 0.5, 86400.75, 86400.75])
+            assert virtualtime.format_times("%Y-%m-%d %H:%M:%S.%f", times, utc=True) == \
+                   ["1970-01-01 00:00:00.250000", "1970-01-01 00:00:00.500000", "1970-01-02 00:00:00.750000", "1970-01-02 00:00:00.750000"]
+            datetimes = numpy.array(['1812-09-10T12:07:30.5', '2020-02-20T20:20:20'], dtype='datetime64[us]')
+            assert virtualtime.format_datetimes("%Y-%m-%d %H:%M:%S.%f", datetimes) == ["1812-09-10 12:07:30.500000", "2020-02-20 20:20:20.000000"]
+
+class TestBulkConversion(object):
+    def setup_method(self, method):  # This is a wrapper of setUp for py.test (py.test and nose take different method setup methods)
+        self.setUp()
+
+    def setUp(self):
+        self.original_tz = os.environ.get('TZ')
+        os.environ['TZ'] = 'America/Chicago'
+        time.tzset()
+
+    def teardown_method(self, method):  # This is a wrapper of tearDown for py.test (py.test and nose take different method setup methods)
+        self.tearDown()
+
+    def tearDown(self):
+        if self.original_tz is None:
+            del os.environ['TZ']
+        else:
+            os.environ['TZ'] = self.original_tz
+        time.tzset()
+
+    def transition_datetimes(self):
+        """every 10 minutes across the spring and autumn daylight savings transitions, and some early dates"""
+        datetimes = []
+        for start in (datetime.datetime(2014, 3, 8, 22, 0, 0, 250000), datetime.datetime(2014, 11, 1, 22, 0, 0, 500000)):
+            datetimes.extend(start + datetime.timedelta(minutes=10 * n) for n in range(36))
+        return datetimes + [datetime.datetime(1850, 6, 1, 12, 30), datetime.datetime(2014, 7, 1, 12, 30)]
+
+    def test_local_datetimes_to_times(self):
+        """Cached local offsets give the same results as mktime, including around daylight savings transitions"""
+        datetimes = self.transition_datetimes()
+        expected = [time.mktime(dt.timetuple()) + dt.microsecond * 0.000001 for dt in datetimes]
+        assert virtualtime.local_datetimes_to_times(datetimes) == expected
+        assert [virtualtime.local_datetime_to_time(dt) for dt in datetimes] == expected
+
+    def test_utc_datetimes_to_times(self):
+        """UTC conversion doesn't depend on the current daylight savings state"""
+        datetimes = self.transition_datetimes()
+        expected = [calendar.timegm(dt.timetuple()) + dt.microsecond * 0.000001 for dt in datetimes]
+        assert virtualtime.utc_datetimes_to_times(datetimes) == expected
+        aware = pytz.timezone('Africa/Johannesburg').localize(datetime.datetime(2014, 7, 1, 14, 30))
+        assert virtualtime.utc_datetime_to_time(aware) == calendar.timegm((2014, 7, 1, 12, 30, 0))
+
+    def test_timezone_change(self):
+        dt = datetime.datetime(2014, 7, 1, 12, 30)
+        chicago = virtualtime.local_datetime_to_time(dt)
+        os.environ['TZ'] = 'Asia/Tokyo'
+        time.tzset()
+        assert virtualtime.local_datetime_to_time(dt) == chicago - 14 * 3600
+
+    if numpy is not None:
+        def test_numpy(self):
+            datetimes = self.transition_datetimes()
+            array = numpy.array(datetimes, dtype='datetime64[us]')
+            assert virtualtime.local_datetimes_to_times(array).tolist() == virtualtime.local_datetimes_to_times(datetimes)
+            assert virtualtime.utc_datetimes_to_times(array).tolist() == virtualtime.utc_datetimes_to_times(datetimes)
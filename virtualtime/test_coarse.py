@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import coarse
+import threading
+import time
+
+class TestCoarseClock(object):
+    def teardown_method(self, method):
+        coarse.stop_coarse_clock()
+        virtualtime.restore_time()
+
+    def test_coarse_time(self):
+        resolution = coarse.get_coarse_resolution()
+        for n in range(5):
+            real = virtualtime._virtual_time()
+            assert real - resolution - 0.05 <= virtualtime.coarse_time() <= virtualtime._virtual_time()
+            time.sleep(resolution)
+
+    def test_ticks(self):
+        coarse.start_coarse_clock(0.01)
+        first = virtualtime.coarse_time()
+        assert virtualtime.coarse_time() == first
+        time.sleep(0.1)
+        assert virtualtime.coarse_time() > first
+
+    def test_offset_change(self):
+        """Offset changes are seen immediately, without waiting for a tick"""
+        coarse.start_coarse_clock(60)
+        before = virtualtime.coarse_time()
+        virtualtime.set_offset(3600, suppress_log=True)
+        assert virtualtime.coarse_time() - before >= 3600
+        assert abs(virtualtime.coarse_now() - virtualtime.virtual_datetime.now()).total_seconds() < 0.1
+
+    def test_coarse_now(self):
+        now = virtualtime.coarse_now()
+        assert virtualtime.coarse_now() is now
+        assert abs((virtualtime.virtual_datetime.now() - now).total_seconds()) < 0.1
+
+    def test_stop(self):
+        virtualtime.coarse_time()
+        assert coarse._on_change in virtualtime._virtual_time_change_listeners
+        coarse.stop_coarse_clock()
+        assert coarse._on_change not in virtualtime._virtual_time_change_listeners
+        assert coarse._coarse_time is None
+
+    def test_ticks_without_state_lock(self):
+        """The ticker keeps the clock moving while something else holds the virtual time state"""
+        coarse.start_coarse_clock(0.01)
+        first = virtualtime.coarse_time()
+        virtualtime._virtual_time_state.acquire()
+        try:
+            time.sleep(0.1)
+            assert virtualtime.coarse_time() > first
+        finally:
+            virtualtime._virtual_time_state.release()
+
+    def test_read_from_change_listener(self):
+        """Change listeners can start the coarse clock while other threads restart it"""
+        stop = threading.Event()
+        def restart():
+            while not stop.is_set():
+                coarse.start_coarse_clock(0.001)
+        def listener(change):
+            coarse.stop_coarse_clock()
+            assert coarse.coarse_time() >= virtualtime._original_time() + change.offset - 1
+        virtualtime._add_change_listener(listener)
+        thread = threading.Thread(target=restart)
+        thread.daemon = True
+        thread.start()
+        try:
+            for n in range(200):
+                virtualtime.set_offset(n, suppress_log=True)
+        finally:
+            stop.set()
+            thread.join(5)
+            virtualtime._remove_change_listener(listener)
+        assert not thread.is_alive()
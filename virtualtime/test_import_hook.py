@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+import virtualtime
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+if sys.version_info >= (3, 4):
+    from virtualtime import import_hook
+
+    PACKAGE_INIT = "import datetime\nloaded_with = datetime.datetime\nfrom . import eager\n"
+    SUBMODULE = ("import datetime, sys\nloaded_with = datetime.datetime\nglobal_type = sys.modules['datetime'].datetime\n"
+                 "def imported_later():\n    from datetime import datetime\n    return datetime\n")
+    # each of these imports the other, so that two threads importing one each need each other's module locks
+    CIRCULAR_FIRST = "import time\ntime.sleep(0.2)\nimport vt_sensitive_package.second\n"
+    CIRCULAR_SECOND = "import time\ntime.sleep(0.2)\nimport vt_sensitive_package.first\n"
+
+    class TestImportHook(object):
+        def setup_method(self, method):
+            self.path = tempfile.mkdtemp()
+            package_dir = os.path.join(self.path, 'vt_sensitive_package')
+            os.mkdir(package_dir)
+            for name, source in (('__init__', PACKAGE_INIT), ('eager', SUBMODULE), ('lazy', SUBMODULE),
+                                 ('first', CIRCULAR_FIRST), ('second', CIRCULAR_SECOND)):
+                with open(os.path.join(package_dir, name + '.py'), 'w') as f:
+                    f.write(source)
+            sys.path.insert(0, self.path)
+
+        def teardown_method(self, method):
+            sys.path.remove(self.path)
+            for name in list(sys.modules):
+                if name.partition('.')[0] == 'vt_sensitive_package':
+                    del sys.modules[name]
+            import_hook._datetime_sensitive_packages.discard('vt_sensitive_package')
+            shutil.rmtree(self.path)
+
+        def test_unregistered(self):
+            import vt_sensitive_package
+            assert vt_sensitive_package.loaded_with is virtualtime.datetime
+
+        def test_registered(self):
+            """Registered packages and their submodules, including ones imported later, see the original datetime type"""
+            virtualtime.register_datetime_sensitive_package('vt_sensitive_package')
+            import vt_sensitive_package
+            assert vt_sensitive_package.loaded_with is virtualtime._underlying_datetime_type
+            assert vt_sensitive_package.eager.loaded_with is virtualtime._underlying_datetime_type
+            assert datetime.datetime is virtualtime.datetime
+            import vt_sensitive_package.lazy
+            assert vt_sensitive_package.lazy.loaded_with is virtualtime._underlying_datetime_type
+            assert datetime.datetime is virtualtime.datetime
+            assert isinstance(vt_sensitive_package.__loader__, import_hook.DatetimeSensitiveLoader)
+            assert vt_sensitive_package.__loader__.is_package('vt_sensitive_package')
+
+        def test_only_loading_module(self):
+            """The original type is only handed to the modules of registered packages, including for later imports"""
+            virtualtime.register_datetime_sensitive_package('vt_sensitive_package')
+            import vt_sensitive_package.lazy
+            assert vt_sensitive_package.lazy.global_type is virtualtime.datetime
+            assert vt_sensitive_package.lazy.imported_later() is virtualtime._underlying_datetime_type
+            assert datetime.datetime is virtualtime.datetime
+            assert import_hook._loading_depth == 0
+
+        def test_concurrent_imports(self):
+            """Registered modules that import each other can be imported from different threads at once"""
+            virtualtime.register_datetime_sensitive_package('vt_sensitive_package')
+            import importlib
+            import threading
+            errors = []
+            def import_module(name):
+                try:
+                    importlib.import_module(name)
+                except Exception as e:
+                    errors.append(e)
+            threads = [threading.Thread(target=import_module, args=(name,)) for name in ('vt_sensitive_package.first', 'vt_sensitive_package.second')]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            assert not any(thread.is_alive() for thread in threads)
+            assert errors == []
+            assert 'vt_sensitive_package.first' in sys.modules and 'vt_sensitive_package.second' in sys.modules
+
+        def test_swap_not_undone(self):
+            """Finishing an extension module load doesn't put back a datetime type that has been replaced meanwhile"""
+            datetime_module = virtualtime._original_datetime_module
+            replacement = type('replacement_datetime', (virtualtime._underlying_datetime_type,), {})
+            try:
+                with import_hook._original_datetime_restored():
+                    assert datetime_module.datetime is virtualtime._underlying_datetime_type
+                    datetime_module.datetime = replacement
+                assert datetime_module.datetime is replacement
+            finally:
+                datetime_module.datetime = virtualtime._original_datetime_type
+            with import_hook._original_datetime_restored():
+                with import_hook._original_datetime_restored():
+                    pass
+                assert datetime_module.datetime is virtualtime._underlying_datetime_type
+            assert datetime_module.datetime is virtualtime._original_datetime_type
+
+        def test_failed_import(self):
+            """The virtual datetime type is put back even if the package fails to load"""
+            with open(os.path.join(self.path, 'vt_sensitive_package', 'broken.py'), 'w') as f:
+                f.write("raise ValueError('broken')\n")
+            virtualtime.register_datetime_sensitive_package('vt_sensitive_package')
+            try:
+                import vt_sensitive_package.broken
+            except ValueError:
+                pass
+            else:
+                assert False, "Expected the import to fail"
+            assert datetime.datetime is virtualtime.datetime
+            assert import_hook._loading_depth == 0
+
+        def test_virtualtime_import_without_pandas(self):
+            """Importing virtualtime doesn't import pandas"""
+            from virtualtime.test_virtualtime import outside
+            assert outside("'pandas' in sys.modules", "virtualtime") is False
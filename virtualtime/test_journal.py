@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import journal
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+class TestJournal(object):
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "session.vtj")
+        virtualtime.enable()
+
+    def teardown_method(self, method):
+        virtualtime.restore_time()
+        virtualtime.disable()
+        shutil.rmtree(self.directory)
+
+    def test_record(self):
+        with journal.JournalRecorder(self.path):
+            virtualtime.set_offset(3600)
+            virtualtime.set_time(virtualtime._original_time() + 7200)
+            virtualtime.fast_forward_time(delta=3, step_size=1, step_wait=0)
+            virtualtime.restore_time()
+        entries = journal.read_journal(self.path)
+        assert [entry.kind for entry in entries] == [journal.START, journal.OFFSET_CHANGE, journal.OFFSET_CHANGE] + \
+            [journal.FAST_FORWARD_STEP] * 3 + [journal.FAST_FORWARD_COMPLETE, journal.OFFSET_CHANGE]
+        assert entries[0].offset == 0
+        assert entries[1].offset == 3600
+        assert abs(entries[2].offset - 7200) < 1
+        assert abs(entries[-2].offset - entries[2].offset - 3) < 0.001
+        assert entries[-1].offset == 0
+        assert all(earlier.real_time <= later.real_time for earlier, later in zip(entries, entries[1:]))
+        assert os.path.getsize(self.path) == len(journal.MAGIC) + len(entries) * journal._RECORD.size
+
+    def test_growth(self):
+        with journal.JournalRecorder(self.path, capacity=4) as recorder:
+            for n in range(1, 21):
+                virtualtime.set_offset(n, suppress_log=True)
+        assert recorder.capacity == 32
+        assert [entry.offset for entry in journal.read_journal(self.path)] == list(range(21))
+
+    def test_unfinished(self):
+        """Entries can be read before the recorder has been stopped"""
+        recorder = journal.JournalRecorder(self.path).start()
+        try:
+            virtualtime.set_offset(60, suppress_log=True)
+            assert [entry.offset for entry in journal.read_journal(self.path)] == [0, 60]
+        finally:
+            recorder.stop()
+
+    def test_sampled_reads(self):
+        with journal.JournalRecorder(self.path, sample_reads=10):
+            assert virtualtime.enabled(verify=True)
+            # the patch target is left alone, so the scanner and scoped proxies still see the plain virtual function
+            assert virtualtime._patch_targets['time.time'].virtual is virtualtime._virtual_time
+            assert time.time is not virtualtime._virtual_time
+            virtualtime.set_offset(100, suppress_log=True)
+            for n in range(25):
+                t = time.time()
+            assert abs(t - virtualtime._original_time() - 100) < 1
+            # disabling takes the sampler out, and enabling puts it back
+            virtualtime.disable()
+            assert time.time is virtualtime._original_time
+            virtualtime.enable()
+            assert virtualtime.enabled(verify=True)
+            assert time.time is not virtualtime._virtual_time
+        assert time.time is virtualtime._virtual_time
+        reads = [entry for entry in journal.read_journal(self.path) if entry.kind == journal.TIME_READ]
+        assert len(reads) == 2
+        assert all(entry.offset == 100 for entry in reads)
+
+    def test_replay(self):
+        with journal.JournalRecorder(self.path):
+            virtualtime.set_offset(3600, suppress_log=True)
+            time.sleep(0.2)
+            virtualtime.fast_forward_time(delta=2, step_size=1, step_wait=0)
+            virtualtime.restore_time()
+        entries = journal.read_journal(self.path)
+        virtual_times, changes = [], []
+        def listener(change):
+            virtual_times.append(virtualtime._virtual_time())
+            changes.append(change)
+        virtualtime._add_change_listener(listener)
+        try:
+            start = virtualtime._original_time()
+            assert journal.replay_journal(self.path, speed=2) == len(entries)
+            elapsed = virtualtime._original_time() - start
+        finally:
+            virtualtime._remove_change_listener(listener)
+        assert 0.1 <= elapsed < 1
+        recorded = [entry.real_time + entry.offset for entry in entries if entry.kind != journal.FAST_FORWARD_COMPLETE]
+        replayed = [t for t, change in zip(virtual_times, changes) if not change.is_fast_forward_complete]
+        # the start and first change are replayed at the virtual times they were made
+        assert len(replayed) == len(recorded)
+        assert all(abs(r - v) < 0.05 for r, v in zip(recorded, replayed))
+        assert [change.is_fast_forward_change for change in changes] == [False, False, True, True, True, False]
+        assert changes[-2].is_fast_forward_complete
+
+    def test_cancel(self):
+        with journal.JournalRecorder(self.path):
+            time.sleep(0.5)
+            virtualtime.set_offset(60, suppress_log=True)
+        cancel_event = threading.Event()
+        timer = threading.Timer(0.05, cancel_event.set)
+        timer.start()
+        assert journal.replay_journal(self.path, cancel_event=cancel_event) == 1
+
+    def test_start_failure(self):
+        """The journal file is closed if it can't be mapped"""
+        recorder = journal.JournalRecorder(self.path)
+        files = []
+        def failing_map_file():
+            files.append(recorder._file)
+            raise mmap.error("no mapping")
+        recorder._map_file = failing_map_file
+        try:
+            recorder.start()
+        except mmap.error:
+            pass
+        else:
+            assert False, "start() should have failed"
+        assert files[0].closed
+        assert recorder._file is None
+        assert recorder._on_change not in virtualtime._virtual_time_change_listeners
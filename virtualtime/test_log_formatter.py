@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime.log_formatter import VirtualTimeFormatter
+import logging
+import os
+import time
+
+def make_record(created):
+    record = logging.LogRecord("test", logging.INFO, __file__, 1, "message", (), None)
+    record.created = created
+    record.msecs = (created - int(created)) * 1000
+    return record
+
+class TestVirtualTimeFormatter(object):
+    def teardown_method(self, method):
+        virtualtime.restore_time()
+
+    def test_matches_standard_formatter(self):
+        standard, cached = logging.Formatter(), VirtualTimeFormatter()
+        for created in (1400000000.25, 1400000000.75, 1400000001.5, 1400000000.125):
+            record = make_record(created)
+            assert cached.formatTime(record) == standard.formatTime(record)
+            assert cached.formatTime(record, "%H:%M:%S %Z") == standard.formatTime(record, "%H:%M:%S %Z")
+        fmt = "%(asctime)s %(levelname)s %(message)s"
+        record = make_record(1400000000.5)
+        assert VirtualTimeFormatter(fmt).format(record) == logging.Formatter(fmt).format(record)
+
+    def test_offset_change(self):
+        """The cache is discarded when the offset changes"""
+        formatter = VirtualTimeFormatter()
+        record = make_record(1400000000.5)
+        formatter.formatTime(record)
+        assert formatter._cache
+        virtualtime.set_offset(3600, suppress_log=True)
+        assert formatter._offset_changed.is_set()
+        assert formatter.formatTime(make_record(1400003600.5)) == logging.Formatter().formatTime(make_record(1400003600.5))
+        assert list(formatter._cache) == [(1400003600, None)]
+
+    def test_timezone_change(self):
+        original_tz = os.environ.get('TZ')
+        formatter = VirtualTimeFormatter("%(asctime)s")
+        record = make_record(1400000000.5)
+        try:
+            os.environ['TZ'] = 'UTC'
+            time.tzset()
+            assert formatter.formatTime(record, "%H:%M %Z") == "16:53 UTC"
+            os.environ['TZ'] = 'Asia/Kolkata'
+            time.tzset()
+            assert formatter.formatTime(record, "%H:%M %Z") == "22:23 IST"
+        finally:
+            if original_tz is None:
+                os.environ.pop('TZ', None)
+            else:
+                os.environ['TZ'] = original_tz
+            time.tzset()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import persistence
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+class TestPersistence(object):
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "state.json")
+
+    def teardown_method(self, method):
+        persistence.disable_persistence()
+        virtualtime.restore_time()
+        virtualtime.disable()
+        shutil.rmtree(self.directory)
+
+    def test_save(self):
+        persistence.enable_persistence(self.path)
+        virtualtime.set_offset(3600, suppress_log=True)
+        assert persistence.flush_state(5)
+        state = persistence.read_state(self.path)
+        assert state["offset"] == 3600
+        assert state["generation"] == virtualtime._offset_generation
+        assert state["enabled"] is False
+        virtualtime.enable()
+        assert persistence.flush_state(5)
+        assert persistence.read_state(self.path)["enabled"] is True
+        # only the state file is left behind
+        assert os.listdir(self.directory) == ["state.json"]
+
+    def test_disable_writes_latest(self):
+        persistence.enable_persistence(self.path)
+        virtualtime.set_offset(60, suppress_log=True)
+        persistence.disable_persistence()
+        assert persistence.read_state(self.path)["offset"] == 60
+        virtualtime.set_offset(120, suppress_log=True)
+        assert persistence.read_state(self.path)["offset"] == 60
+
+    def test_fast_forward_coalesced(self):
+        """Fast forward steps are written at most every FAST_FORWARD_WRITE_INTERVAL, and the final offset is always written"""
+        writes = []
+        original_write_state, original_interval = persistence._write_state, persistence.FAST_FORWARD_WRITE_INTERVAL
+        def write_state(path, state):
+            writes.append(state)
+            original_write_state(path, state)
+        persistence._write_state, persistence.FAST_FORWARD_WRITE_INTERVAL = write_state, 60
+        try:
+            persistence.enable_persistence(self.path)
+            assert persistence.flush_state(5)
+            del writes[:]
+            virtualtime.fast_forward_time(delta=100, step_size=1, step_wait=0)
+            assert persistence.flush_state(5)
+        finally:
+            persistence._write_state, persistence.FAST_FORWARD_WRITE_INTERVAL = original_write_state, original_interval
+        assert len(writes) <= 3
+        assert writes[-1]["offset"] == 100
+        assert persistence.read_state(self.path)["offset"] == 100
+
+    def test_missing(self):
+        assert persistence.read_state(self.path) is None
+        assert not persistence.load_state(self.path)
+
+    def test_corrupt(self):
+        """A truncated state file doesn't stop virtualtime being imported, and is replaced with a fresh state"""
+        with open(self.path, 'w') as f:
+            f.write('{"offset": 72')
+        environment = dict(os.environ, VIRTUALTIME_STATE_FILE=self.path, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output([sys.executable, "-c", "import virtualtime; print(virtualtime.get_offset())"], env=environment)
+        assert output.decode().split() == ["0"]
+        assert persistence.read_state(self.path)["offset"] == 0
+
+    def test_malformed(self):
+        """States with the wrong types are treated as corrupt, rather than being partly applied"""
+        environment = dict(os.environ, VIRTUALTIME_STATE_FILE=self.path, PYTHONPATH=os.pathsep.join(sys.path))
+        for state in ('[]', '{"offset": 5, "generation": null, "enabled": true, "adaptive": false}',
+                      '{"offset": "x", "generation": 1, "enabled": true, "adaptive": false}',
+                      '{"offset": 5, "generation": 1, "enabled": "yes", "adaptive": false}'):
+            with open(self.path, 'w') as f:
+                f.write(state)
+            output = subprocess.check_output([sys.executable, "-c",
+                "import virtualtime, time; time.time(); print('%r %r' % (virtualtime.get_offset(), virtualtime.enabled()))"], env=environment)
+            assert output.decode().split() == ["0", "False"], state
+            assert persistence.read_state(self.path)["offset"] == 0
+        with open(self.path, 'w') as f:
+            f.write('{"offset": "x", "generation": 1, "enabled": true, "adaptive": false}')
+        try:
+            persistence.load_state(self.path)
+        except ValueError:
+            pass
+        else:
+            assert False, "load_state should have rejected the state"
+        assert virtualtime.get_offset() == 0
+
+    def test_restart(self):
+        """A new process picks up the state left by the previous one from VIRTUALTIME_STATE_FILE"""
+        environment = dict(os.environ, VIRTUALTIME_STATE_FILE=self.path, PYTHONPATH=os.pathsep.join(sys.path))
+        subprocess.check_call([sys.executable, "-c", "import virtualtime; virtualtime.enable(); virtualtime.set_offset(7200, suppress_log=True)"], env=environment)
+        output = subprocess.check_output([sys.executable, "-c",
+            "import virtualtime, time; print('%r %r %d' % (virtualtime.enabled(), virtualtime.get_offset(), round(time.time() - virtualtime.raw_time())))"], env=environment)
+        assert output.decode().split() == ["True", "7200", "7200"]
+        assert persistence.read_state(self.path)["generation"] >= 1
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import scanner
+import datetime
+import logging
+import sys
+import time
+import types
+
+STALE_MODULE_SOURCE = '''
+from time import time, sleep as pause
+import datetime
+now = datetime.datetime.now
+
+class Clock(object):
+    read = staticmethod(time)
+    def wait(self, seconds, sleep=pause):
+        return sleep
+    def stamp(self, clock=time, *args, **kwargs):
+        return clock
+
+def current(clock=time):
+    return clock
+'''
+
+class TestScanner(object):
+    def setup_method(self, method):
+        virtualtime.disable()
+        self.module = types.ModuleType("scanner_test_module")
+        sys.modules[self.module.__name__] = self.module
+        exec(STALE_MODULE_SOURCE, self.module.__dict__)
+
+    def teardown_method(self, method):
+        scanner.uninstall()
+        virtualtime.disable()
+        del sys.modules[self.module.__name__]
+
+    def stale_descriptions(self):
+        return sorted(reference.description for reference, target in virtualtime.find_stale_references()
+                      if reference.module_name == self.module.__name__)
+
+    def test_nothing_stale_when_disabled(self):
+        assert self.stale_descriptions() == []
+
+    def test_find(self):
+        virtualtime.enable()
+        assert self.stale_descriptions() == [
+            "default argument 0 of scanner_test_module.Clock.stamp",
+            "default argument 0 of scanner_test_module.Clock.wait",
+            "default argument 0 of scanner_test_module.current",
+            "scanner_test_module.Clock.read",
+            "scanner_test_module.now",
+            "scanner_test_module.pause",
+            "scanner_test_module.time",
+        ]
+
+    def test_rebind(self):
+        virtualtime.enable()
+        virtualtime.rebind_stale_references()
+        module = self.module
+        assert module.time is virtualtime._virtual_time
+        assert module.pause is virtualtime._virtual_sleep
+        assert module.now == virtualtime._virtual_datetime_now
+        assert module.Clock.read is virtualtime._virtual_time
+        assert module.Clock().wait(1) is virtualtime._virtual_sleep
+        assert module.current() is virtualtime._virtual_time
+        assert self.stale_descriptions() == []
+        virtualtime.disable()
+        assert len(self.stale_descriptions()) == 7
+        virtualtime.rebind_stale_references()
+        assert module.time is virtualtime._original_time
+        assert module.Clock.read is virtualtime._original_time
+        assert module.current() is virtualtime._original_time
+
+    def test_install(self):
+        scanner.install()
+        virtualtime.enable()
+        virtualtime.set_offset(3600)
+        try:
+            assert self.module.time() - virtualtime._original_time() > 3599
+        finally:
+            virtualtime.restore_time()
+        virtualtime.disable()
+        assert self.module.time is virtualtime._original_time
+
+    def test_report(self):
+        scanner.install(rebind=False)
+        messages = []
+        class Handler(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+        handler = Handler()
+        logging.getLogger().addHandler(handler)
+        try:
+            virtualtime.enable()
+        finally:
+            logging.getLogger().removeHandler(handler)
+        assert "scanner_test_module.time holds the real time.time while virtual time is enabled" in messages
+        assert self.module.time is virtualtime._original_time
+
+    def test_new_globals(self):
+        """Globals added to an indexed module are found on the next scan"""
+        virtualtime.enable()
+        virtualtime.rebind_stale_references()
+        self.module.later = virtualtime._original_time
+        assert self.stale_descriptions() == ["scanner_test_module.later"]
+
+    def test_exclude(self):
+        scanner.exclude_module(self.module.__name__)
+        try:
+            virtualtime.enable()
+            assert self.stale_descriptions() == []
+        finally:
+            scanner.include_module(self.module.__name__)
+
+    def test_stdlib_left_alone(self):
+        """Standard library modules that keep the real clock functions aren't reported or rebound"""
+        import _strptime
+        import sched
+        converter = logging.Formatter.converter
+        delayfunc = sched.scheduler.__init__.__defaults__
+        virtualtime.enable()
+        assert [reference for reference, target in virtualtime.find_stale_references(full=True)
+                if reference.module_name in ('logging', 'sched', '_strptime', '_datetime', 'sqlite3.dbapi2')] == []
+        virtualtime.rebind_stale_references(full=True)
+        assert logging.Formatter.converter is converter
+        assert sched.scheduler.__init__.__defaults__ == delayfunc
+        assert _strptime.datetime_date is virtualtime._underlying_date_type
+
+    def test_type_targets_left_alone(self):
+        """References to classes aren't rebound, even if a patch target replaces one"""
+        owner = types.ModuleType("scanner_test_owner")
+        class original_type(object):
+            pass
+        class virtual_type(original_type):
+            pass
+        owner.clock_type = original_type
+        self.module.clock_type = original_type
+        virtualtime.register_patch_target("scanner_test_owner.clock_type", owner, "clock_type", virtual_type)
+        try:
+            virtualtime.enable()
+            assert owner.clock_type is virtual_type
+            assert "scanner_test_module.clock_type" not in self.stale_descriptions()
+            virtualtime.rebind_stale_references()
+            assert self.module.clock_type is original_type
+        finally:
+            virtualtime.disable()
+            virtualtime.unregister_patch_target("scanner_test_owner.clock_type")
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import scoped
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+
+SCOPED_MODULE_SOURCE = '''
+import time
+import datetime
+from time import time as timestamp
+from datetime import datetime as datetime_type, date
+
+class Clock(object):
+    def stamp(self, clock=timestamp):
+        return clock()
+'''
+
+class TestScoped(object):
+    def setup_method(self, method):
+        virtualtime.disable()
+        self.modules = []
+        for name in ("scoped_test_module", "scoped_test_other"):
+            module = types.ModuleType(name)
+            sys.modules[name] = module
+            exec(SCOPED_MODULE_SOURCE, module.__dict__)
+            self.modules.append(module)
+        self.scoped, self.other = self.modules
+        virtualtime.set_offset(3600)
+
+    def teardown_method(self, method):
+        virtualtime.disable_for("scoped_test_module", "scoped_test_package")
+        virtualtime.restore_time()
+        for module in self.modules:
+            del sys.modules[module.__name__]
+
+    def test_scoped(self):
+        virtualtime.enable_for("scoped_test_module")
+        assert scoped.enabled_for("scoped_test_module")
+        assert not virtualtime.enabled()
+        real = time.time()
+        assert abs(self.scoped.time.time() - real - 3600) < 1
+        assert abs(self.scoped.timestamp() - real - 3600) < 1
+        assert abs(self.scoped.Clock().stamp() - real - 3600) < 1
+        assert abs((self.scoped.datetime.datetime.now() - datetime.datetime.now()).total_seconds() - 3600) < 1
+        assert abs((self.scoped.datetime_type.now() - datetime.datetime.now()).total_seconds() - 3600) < 1
+        assert self.scoped.date is virtualtime.virtual_date
+        # everything else is left alone
+        assert time.time is virtualtime._original_time
+        assert self.other.time is time
+        assert self.other.timestamp is virtualtime._original_time
+        assert abs(self.other.timestamp() - real) < 1
+
+    def test_isinstance(self):
+        """Datetimes made inside and outside scoped modules match each other's datetime types, and are of the real type"""
+        virtualtime.enable_for("scoped_test_module")
+        scoped_type = self.scoped.datetime_type
+        assert self.scoped.datetime.datetime is scoped_type
+        outside_value = datetime.datetime(2020, 2, 20)
+        raw_value = virtualtime._underlying_datetime_type(2020, 2, 20)
+        assert isinstance(outside_value, scoped_type) and isinstance(raw_value, scoped_type)
+        assert issubclass(datetime.datetime, scoped_type)
+        for inside_value in (scoped_type.now(), scoped_type.today(), scoped_type.utcnow(), scoped_type(2020, 2, 20),
+                             scoped_type.fromtimestamp(0), self.scoped.datetime.datetime.now()):
+            assert type(inside_value) is datetime.datetime
+            assert isinstance(inside_value, datetime.datetime)
+            assert isinstance(inside_value, scoped_type)
+        assert abs((scoped_type.today() - datetime.datetime.now()).total_seconds() - 3600) < 1
+        assert scoped_type(2020, 2, 20) == outside_value
+
+    def test_proxy(self):
+        """Attributes without virtual versions come from the module itself, even if they change"""
+        virtualtime.enable_for("scoped_test_module")
+        proxy = self.scoped.time
+        assert proxy.tzname is time.tzname
+        assert proxy.mktime is time.mktime
+        assert self.scoped.datetime.timedelta is datetime.timedelta
+
+    def test_disable_for(self):
+        virtualtime.enable_for("scoped_test_module")
+        virtualtime.disable_for("scoped_test_module")
+        assert not scoped.enabled_for("scoped_test_module")
+        assert self.scoped.time is time
+        assert self.scoped.timestamp is virtualtime._original_time
+        assert self.scoped.datetime_type is datetime.datetime
+        assert self.scoped.Clock.stamp.__defaults__ == (virtualtime._original_time,)
+
+    def test_global_enable(self):
+        """Scoped modules stay virtual when virtual time is enabled and disabled globally"""
+        from virtualtime import scanner
+        scanner.install()
+        try:
+            virtualtime.enable_for("scoped_test_module")
+            virtualtime.enable()
+            virtualtime.disable()
+            assert self.scoped.timestamp is virtualtime._virtual_time
+        finally:
+            scanner.uninstall()
+
+    def test_later_import(self):
+        if sys.version_info < (3, 4):
+            return
+        package_dir = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(package_dir, "scoped_test_package"))
+            with open(os.path.join(package_dir, "scoped_test_package", "__init__.py"), "w") as f:
+                f.write("")
+            with open(os.path.join(package_dir, "scoped_test_package", "clock.py"), "w") as f:
+                f.write("from time import time\n")
+            sys.path.insert(0, package_dir)
+            virtualtime.enable_for("scoped_test_package")
+            from scoped_test_package import clock
+            assert clock.time is virtualtime._virtual_time
+        finally:
+            sys.path.remove(package_dir)
+            for name in ("scoped_test_package.clock", "scoped_test_package"):
+                sys.modules.pop(name, None)
+            shutil.rmtree(package_dir)
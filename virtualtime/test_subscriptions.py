@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import subscriptions
+import threading
+import sys
+
+class TestSubscriptions(object):
+    def setup_method(self, method):  # This is a wrapper of setUp for py.test (py.test and nose take different method setup methods)
+        self.setUp()
+
+    def setUp(self):
+        self.subscriptions = []
+
+    def teardown_method(self, method):  # This is a wrapper of tearDown for py.test (py.test and nose take different method setup methods)
+        self.tearDown()
+
+    def tearDown(self):
+        for subscription in self.subscriptions:
+            virtualtime.unsubscribe(subscription)
+        virtualtime.restore_time()
+        subscriptions.get_pool().join(5)
+
+    def subscribe(self, callback, **kwargs):
+        subscription = virtualtime.subscribe(callback, **kwargs)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def test_ordering(self):
+        """Each subscriber receives every change in order"""
+        received = [[] for n in range(10)]
+        for n in range(10):
+            self.subscribe(lambda change, log=received[n]: log.append(change.offset))
+        for offset in range(1, 101):
+            virtualtime.set_offset(offset, suppress_log=True)
+        assert subscriptions.get_pool().join(5)
+        for log in received:
+            assert log == list(range(1, 101))
+
+    def test_change_details(self):
+        received = []
+        self.subscribe(received.append)
+        virtualtime.set_offset(5)
+        virtualtime.fast_forward_time(1, step_wait=0)
+        virtualtime.restore_time()
+        assert subscriptions.get_pool().join(5)
+        assert received == [virtualtime.OffsetChange(5, 0, False), virtualtime.OffsetChange(6, 5, True), virtualtime.OffsetChange(0, 6, False)]
+
+    def test_error_isolation(self):
+        """A subscriber that raises doesn't stop other subscribers receiving changes"""
+        received = []
+        def broken(change):
+            raise ValueError("Broken subscriber")
+        broken_subscription = self.subscribe(broken)
+        self.subscribe(lambda change: received.append(change.offset))
+        virtualtime.set_offset(1, suppress_log=True)
+        virtualtime.set_offset(2, suppress_log=True)
+        assert subscriptions.get_pool().join(5)
+        assert received == [1, 2]
+        assert broken_subscription.errors == 2
+
+    def test_coalesce(self):
+        """A slow coalescing subscriber only sees the latest change once it is ready"""
+        received = []
+        release = threading.Event()
+        def slow(change):
+            release.wait(5)
+            received.append(change.offset)
+        self.subscribe(slow, coalesce=True)
+        for offset in range(1, 21):
+            virtualtime.set_offset(offset, suppress_log=True)
+        release.set()
+        assert subscriptions.get_pool().join(5)
+        assert received[-1] == 20
+        assert received == sorted(received)
+        assert len(received) <= 2
+
+    def test_max_pending(self):
+        """A subscriber that falls behind keeps only the latest max_pending changes"""
+        received = []
+        release = threading.Event()
+        def slow(change):
+            release.wait(5)
+            received.append(change.offset)
+        subscription = self.subscribe(slow, max_pending=5)
+        for offset in range(1, 21):
+            virtualtime.set_offset(offset, suppress_log=True)
+        release.set()
+        assert subscriptions.get_pool().join(5)
+        assert received[-5:] == [16, 17, 18, 19, 20]
+        assert len(received) <= 6
+        assert subscription.dropped == 20 - len(received)
+
+    def test_min_interval(self):
+        """Fast forward steps are thinned out to min_interval, but the final offset is still delivered"""
+        received = []
+        self.subscribe(received.append, min_interval=3)
+        virtualtime.fast_forward_time(11, step_wait=0)
+        virtualtime.set_offset(11.5, suppress_log=True)
+        assert subscriptions.get_pool().join(5)
+        assert [change.offset for change in received] == [1, 4, 7, 10, 11, 11.5]
+        assert [change.is_fast_forward_complete for change in received] == [False, False, False, False, True, False]
+
+    def test_fast_forward_complete(self):
+        received = []
+        self.subscribe(received.append, fast_forward_complete=True)
+        virtualtime.fast_forward_time(2, step_wait=0)
+        assert subscriptions.get_pool().join(5)
+        assert received == [virtualtime.OffsetChange(1, 0, True), virtualtime.OffsetChange(2, 1, True),
+                            virtualtime.OffsetChange(2, 0, True, True)]
+
+    def test_unsubscribe(self):
+        received = []
+        subscription = self.subscribe(received.append)
+        virtualtime.unsubscribe(subscription)
+        virtualtime.set_offset(1, suppress_log=True)
+        assert subscriptions.get_pool().join(5)
+        assert received == []
+
+    if sys.version_info >= (3, 5):
+        def test_coroutine_subscriber(self):
+            received = []
+            namespace = {'received': received}
+            exec("async def callback(change):\n    received.append(change.offset)\n", namespace)
+            self.subscribe(namespace['callback'])
+            virtualtime.set_offset(3, suppress_log=True)
+            assert subscriptions.get_pool().join(5)
+            assert received == [3]
+
+        def test_coroutine_loop_closed(self):
+            """The private event loop of a worker is closed when the worker exits"""
+            import asyncio
+            loops = []
+            namespace = {'loops': loops, 'asyncio': asyncio}
+            exec("async def callback(change):\n    loops.append(asyncio.get_event_loop())\n", namespace)
+            pool = subscriptions.SubscriberPool()
+            pool.add(subscriptions.Subscription(pool, namespace['callback']))
+            idle_timeout = subscriptions.WORKER_IDLE_TIMEOUT
+            subscriptions.WORKER_IDLE_TIMEOUT = 0.01
+            try:
+                pool.submit(virtualtime.OffsetChange(1, 0, False, False))
+                assert pool.join(5)
+                for _ in range(500):
+                    if loops[0].is_closed():
+                        break
+                    virtualtime._original_sleep(0.01)
+            finally:
+                subscriptions.WORKER_IDLE_TIMEOUT = idle_timeout
+            assert pool._worker_count == 0
+            assert len(loops) == 1
+            assert loops[0].is_closed()
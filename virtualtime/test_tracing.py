@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import tracing
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+class TestTracing(object):
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "trace.json")
+        virtualtime.enable()
+
+    def teardown_method(self, method):
+        tracing.stop_tracing()
+        virtualtime.restore_time()
+        virtualtime.disable()
+        shutil.rmtree(self.directory)
+
+    def load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_set_offset(self):
+        virtualtime.start_tracing(self.path)
+        virtualtime.set_offset(60, suppress_log=True)
+        virtualtime.stop_tracing()
+        events = self.load()
+        spans = [event for event in events if event["ph"] == "X"]
+        assert [span["name"] for span in spans] == ["set_offset"]
+        assert spans[0]["args"] == {"offset": 60}
+        assert spans[0]["dur"] >= 0
+        assert spans[0]["tid"] == threading.current_thread().ident
+        names = [event for event in events if event["ph"] == "M"]
+        assert names[0]["args"]["name"] == threading.current_thread().name
+
+    def test_set_time(self):
+        """set_time spans record the offset it results in, not the time it was given"""
+        virtualtime.start_tracing(self.path)
+        virtualtime.set_time(virtualtime._original_time() + 3600, suppress_log=True)
+        virtualtime.stop_tracing()
+        spans = [event for event in self.load() if event["ph"] == "X"]
+        assert abs(spans[0]["args"]["offset"] - 3600) < 1
+
+    def test_fast_forward(self):
+        """Waits are recorded with the event that was waited for, on the thread that waited"""
+        delay_event = threading.Event()
+        callback_event = threading.Event()
+        virtualtime.delay_fast_forward_until_set(delay_event)
+        virtualtime.wait_for_callback_on_change(callback_event)
+        stop = threading.Event()
+        def participant():
+            while not stop.is_set():
+                delay_event.set()
+                callback_event.set()
+                stop.wait(0.001)
+        thread = threading.Thread(target=participant)
+        thread.start()
+        virtualtime.start_tracing(self.path)
+        try:
+            handle = virtualtime.start_fast_forward_time(delta=3, step_size=1, step_wait=0.01)
+            assert handle.join(5)
+        finally:
+            virtualtime.stop_tracing()
+            stop.set()
+            thread.join()
+            virtualtime.undo_delay_fast_forward_until_set(delay_event)
+            virtualtime.undo_wait_for_callback_on_change(callback_event)
+        spans = [event for event in self.load() if event["ph"] == "X"]
+        names = set(span["name"] for span in spans)
+        assert names == set(["fast_forward", "fast_forward step", "step_wait", "delay_event wait", "callback wait"])
+        assert len([span for span in spans if span["name"] == "fast_forward step"]) == 3
+        fast_forward = [span for span in spans if span["name"] == "fast_forward"][0]
+        assert fast_forward["args"]["steps"] == 3
+        assert all(span["tid"] == fast_forward["tid"] for span in spans)
+        assert fast_forward["tid"] != threading.current_thread().ident
+        assert all(span["args"]["event"] == repr(delay_event) for span in spans if span["name"] == "delay_event wait")
+        assert all(span["args"]["event"] == repr(callback_event) for span in spans if span["name"] == "callback wait")
+        for span in spans:
+            if span is not fast_forward:
+                assert fast_forward["ts"] <= span["ts"] <= span["ts"] + span["dur"] <= fast_forward["ts"] + fast_forward["dur"] + 1
+
+    def test_unfinished(self):
+        """Trace viewers accept the file without the closing bracket, which is all that's missing before stop_tracing"""
+        virtualtime.start_tracing(self.path)
+        virtualtime.set_offset(60, suppress_log=True)
+        with open(self.path) as f:
+            assert json.loads(f.read() + "]")[-1]["name"] == "set_offset"
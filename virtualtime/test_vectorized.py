@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+import virtualtime
+from virtualtime import vectorized
+import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pandas
+except ImportError:
+    pandas = None
+
+DAY = 86400
+
+class FakeTimestamp(virtualtime._underlying_datetime_type):
+    """Stands in for pandas.Timestamp where pandas isn't installed, parsing 'now' as the real current time"""
+    def __new__(cls, ts_input=None, *args, **kwargs):
+        if vectorized._is_now_string(ts_input):
+            return cls.now()
+        return virtualtime._underlying_datetime_type.__new__(cls, ts_input, *args, **kwargs)
+
+def fake_to_datetime(arg, utc=False):
+    """Stands in for pandas.to_datetime, parsing 'now' on its own or in a sequence, and leaving other values as they are"""
+    if vectorized._is_now_string(arg):
+        return FakeTimestamp(arg)
+    return [FakeTimestamp(value) if vectorized._is_now_string(value) else value for value in arg]
+
+class TestVectorized(object):
+    def teardown_method(self, method):
+        virtualtime.restore_time()
+
+    if numpy is not None:
+        def test_datetime64_now(self):
+            real_now = numpy.datetime64('now')
+            assert abs(vectorized.datetime64_now() - real_now) <= numpy.timedelta64(1, 's')
+            virtualtime.set_offset(DAY, suppress_log=True)
+            virtual_now = vectorized.datetime64_now('ms')
+            assert virtual_now.dtype == numpy.dtype('datetime64[ms]')
+            assert abs(virtual_now - real_now - numpy.timedelta64(DAY, 's')) <= numpy.timedelta64(1, 's')
+
+    def test_wrappers(self):
+        """Checks the virtualized Timestamp and to_datetime on stand-ins for the pandas originals"""
+        timestamp_type = vectorized._build_virtual_timestamp(FakeTimestamp)
+        to_datetime = vectorized._build_virtual_to_datetime(fake_to_datetime, FakeTimestamp)
+        one_day = datetime.timedelta(days=1)
+        tolerance = datetime.timedelta(seconds=1)
+        real_now = FakeTimestamp.now()
+        assert abs(timestamp_type('now') - real_now) < tolerance
+        virtualtime.set_offset(DAY, suppress_log=True)
+        assert abs(timestamp_type('now') - real_now - one_day) < tolerance
+        assert abs(timestamp_type(ts_input='now') - real_now - one_day) < tolerance
+        assert abs(timestamp_type.now() - real_now - one_day) < tolerance
+        assert timestamp_type(2020, 2, 20) == FakeTimestamp(2020, 2, 20)
+        assert isinstance(FakeTimestamp(2020, 2, 20), timestamp_type)
+        assert abs(to_datetime('now') - real_now - one_day) < tolerance
+        values = [to_datetime(['now', 'today'])[0], to_datetime(('x', 'now'))[1]]
+        if numpy is not None:
+            values.append(to_datetime(numpy.array(['now', 'x'], dtype=object))[0])
+            values.append(to_datetime(numpy.array(['x', 'now']))[1])
+        for value in values:
+            assert abs(value - real_now - one_day) < tolerance
+        if numpy is not None:
+            grid = vectorized._replace_now_strings(numpy.array([['x', 'now'], ['now', 'y']]), 'replaced')
+            assert grid.shape == (2, 2) and grid.dtype == object
+            assert grid.tolist() == [['x', 'replaced'], ['replaced', 'y']]
+        untouched = numpy.array([1, 2]) if numpy is not None else [1, 2]
+        assert vectorized._replace_now_strings(untouched, 'replaced') is untouched
+
+    if pandas is not None:
+        def test_pandas(self):
+            original_timestamp = pandas.Timestamp
+            vectorized.patch_pandas()
+            try:
+                assert vectorized.pandas_patched()
+                one_day = pandas.Timedelta(days=1)
+                tolerance = pandas.Timedelta(seconds=1)
+                real_now = original_timestamp.now()
+                virtualtime.set_offset(DAY, suppress_log=True)
+                assert abs(pandas.Timestamp.now() - real_now - one_day) < tolerance
+                assert abs(pandas.Timestamp('now') - real_now - one_day) < tolerance
+                assert abs(pandas.Timestamp.today() - real_now - one_day) < tolerance
+                assert abs(pandas.Timestamp.utcnow() - original_timestamp.utcnow() - one_day) < tolerance
+                assert abs(pandas.to_datetime('now') - real_now - one_day) < tolerance
+                assert abs(pandas.to_datetime(['now', '2020-02-20'])[0] - real_now - one_day) < tolerance
+                assert abs(pandas.Timestamp(ts_input='now') - real_now - one_day) < tolerance
+                series = pandas.to_datetime(pandas.Series(['2020-02-20', 'now'], index=['a', 'b'], name='when'))
+                assert list(series.index) == ['a', 'b'] and series.name == 'when'
+                assert abs(series['b'] - real_now - one_day) < tolerance
+                assert abs(pandas.to_datetime(numpy.array(['now', '2020-02-20']))[0] - real_now - one_day) < tolerance
+                assert abs(pandas.to_datetime(pandas.Index(['now'], name='when'))[0] - real_now - one_day) < tolerance
+                assert pandas.Timestamp('2020-02-20') == original_timestamp('2020-02-20')
+                assert isinstance(original_timestamp('2020-02-20'), pandas.Timestamp)
+                assert isinstance(pandas.Timestamp('2020-02-20'), original_timestamp)
+            finally:
+                vectorized.unpatch_pandas()
+            assert pandas.Timestamp is original_timestamp
+            assert not vectorized.pandas_patched()
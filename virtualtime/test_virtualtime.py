@@ -165,6 +165,85 @@ class TestPartialPatching(object):
     def teardown_class(cls):
         virtualtime.disable()
 
+class TestPatchRegistry(object):
+    """Tests for the registry of patch targets, and the recorded state used by enabled()"""
+    def setup_method(self, method):  # This is a wrapper of setUp for py.test (py.test and nose take different method setup methods)
+        self.setUp()
+
+    def setUp(self):
+        virtualtime.disable()
+        self.clock_module = type(sys)("third_party_clock")
+        self.clock_module.now = lambda: "real"
+
+    def teardown_method(self, method):  # This is a wrapper of tearDown for py.test (py.test and nose take different method setup methods)
+        self.tearDown()
+
+    def tearDown(self):
+        if "third_party_clock.now" in virtualtime._patch_targets:
+            virtualtime.unregister_patch_target("third_party_clock.now")
+        virtualtime.disable()
+
+    def test_recorded_state(self):
+        assert not virtualtime.enabled()
+        virtualtime.enable()
+        assert virtualtime.enabled()
+        assert virtualtime.enabled(verify=True)
+        virtualtime.unpatch_datetime_module()
+        try:
+            virtualtime.enabled()
+        except ValueError:
+            pass
+        else:
+            assert False, "enabled() should detect partial patching"
+        virtualtime.disable()
+        assert not virtualtime.enabled()
+        assert not virtualtime.enabled(verify=True)
+
+    def test_verify(self):
+        """Only verify mode notices functions that have been replaced without going through virtualtime"""
+        virtualtime.enable()
+        time.time = virtualtime._original_time
+        try:
+            assert virtualtime.enabled()
+            try:
+                virtualtime.enabled(verify=True)
+            except ValueError:
+                pass
+            else:
+                assert False, "enabled(verify=True) should detect the unpatched time.time"
+        finally:
+            time.time = virtualtime._virtual_time
+
+    def test_register(self):
+        virtual_now = lambda: "virtual"
+        target = virtualtime.register_patch_target("third_party_clock.now", self.clock_module, "now", virtual_now)
+        assert target.original() == "real"
+        assert not virtualtime.enabled()
+        virtualtime.enable()
+        assert self.clock_module.now() == "virtual"
+        assert virtualtime.enabled(verify=True)
+        virtualtime.disable()
+        assert self.clock_module.now() == "real"
+        assert virtualtime.enabled(verify=True) is False
+
+    def test_register_while_enabled(self):
+        virtualtime.enable()
+        virtualtime.register_patch_target("third_party_clock.now", self.clock_module, "now", lambda: "virtual")
+        assert self.clock_module.now() == "virtual"
+        assert virtualtime.enabled()
+        virtualtime.unregister_patch_target("third_party_clock.now")
+        assert self.clock_module.now() == "real"
+        assert virtualtime.enabled()
+
+    def test_register_twice(self):
+        virtualtime.register_patch_target("third_party_clock.now", self.clock_module, "now", lambda: "virtual")
+        try:
+            virtualtime.register_patch_target("third_party_clock.now", self.clock_module, "now", lambda: "virtual")
+        except ValueError:
+            pass
+        else:
+            assert False, "registering the same target twice should fail"
+
 class RealTimeBase(object):
     """Tests for real time functions"""
     def test_time(self):
@@ -257,12 +336,99 @@ class RealTimeBase(object):
 
 
 
+    def test_fixed_strftime_matches_native(self):
+        """checks the pre-1900 formatting fallbacks give the same results as a strftime that supports all years"""
+        if sys.version_info < (3, 3):
+            return
+        formats = ["%Y-%m-%d %H:%M:%S", "%d%Y%m%H%Y%M%S1%Y1%y", "%F %T %j %a %U", "%C|%G|%g|%V|%%Y", "%c", "%Y %x %D", "no directives"]
+        dates = [(1812, 9, 10, 12, 7, 30), (12, 9, 10, 12, 7, 30), (912, 1, 1, 0, 0, 0), (1111, 11, 11, 11, 11, 11), (1600, 1, 2, 3, 4, 5), (1899, 12, 31, 23, 59, 59)]
+        original_min_year = virtualtime._STRFTIME_MIN_YEAR
+        virtualtime._STRFTIME_MIN_YEAR = 1900
+        try:
+            for date_fields in dates:
+                dt = datetime.datetime(*date_fields)
+                dt_tz = datetime_tz.datetime_tz(*date_fields, tzinfo=pytz.UTC)
+                for format_str in formats:
+                    native = virtualtime._underlying_strftime(format_str, dt.timetuple())
+                    assert virtualtime._fixed_strftime(format_str, dt.timetuple()) == native, (format_str, date_fields)
+                    assert virtualtime.datetime._fixed_strftime(dt, format_str) == native, (format_str, date_fields)
+                    assert virtualtime.datetime._fixed_strftime(dt_tz, format_str + " %z %Z") == native + " +0000 UTC", (format_str, date_fields)
+        finally:
+            virtualtime._STRFTIME_MIN_YEAR = original_min_year
+
+    def test_fixed_strftime_gnu_flags_match_native(self):
+        """checks the pre-1900 formatting fallbacks handle the GNU flag and field width forms of the year directives"""
+        if sys.version_info < (3, 3) or not sys.platform.startswith('linux'):
+            return
+        formats = ["%-Y", "%_Y", "%^Y", "%4Y", "%-m/%-d/%Y", "%_5Y|%-Y|%010Y", "%-06Y %0-6Y %_-6Y", "%6C %-6C %_C %3G %-3G",
+                   "%012F|%_12F|%-12F|%8F|%11F|%-F", "%_4Y %c", "%Ey %-%Y %%-Y"]
+        dates = [(1812, 9, 10, 12, 7, 30), (12, 9, 10, 12, 7, 30), (912, 1, 1, 0, 0, 0), (1, 1, 1, 0, 0, 0), (1899, 12, 31, 23, 59, 59)]
+        original_min_year = virtualtime._STRFTIME_MIN_YEAR
+        virtualtime._STRFTIME_MIN_YEAR = 1900
+        try:
+            for date_fields in dates:
+                dt = datetime.datetime(*date_fields)
+                for format_str in formats:
+                    native = virtualtime._underlying_strftime(format_str, dt.timetuple())
+                    assert virtualtime._fixed_strftime(format_str, dt.timetuple()) == native, (format_str, date_fields)
+                    assert virtualtime.datetime._fixed_strftime(dt, format_str) == native, (format_str, date_fields)
+        finally:
+            virtualtime._STRFTIME_MIN_YEAR = original_min_year
+
 class TestUnpatchedRealTime(RealTimeBase, RunUnpatched):
     """Tests for real time functions when virtualtime is disabled"""
 
 class TestPatchedRealTime(RealTimeBase, RunPatched):
     """Tests for real time functions when virtualtime is enabled"""
 
+class TestAdjustStrftime(object):
+    """Tests the fallback that fills in the datetime-specific strftime directives"""
+    def test_adjust_strftime(self):
+        adjust_strftime = virtualtime.alt_time_funcs.adjust_strftime
+        naive_date = datetime.datetime(2020, 2, 20, 20, 20, 20, 2020)
+        assert adjust_strftime(naive_date, '%Y-%m-%d %H:%M:%S.%f %z %Z') == '%Y-%m-%d %H:%M:%S.002020  '
+        bdt_date = pytz.timezone('Europe/London').localize(datetime.datetime(2020, 8, 20, 20, 20, 20, 2020))
+        assert adjust_strftime(bdt_date, '%f|%z|%Z|%%f|%z') == '002020|+0100|BST|%%f|+0100'
+        assert adjust_strftime(bdt_date, 'plain %Y') == 'plain %Y'
+        assert adjust_strftime(datetime.time(20, 20, 20, 5), '%H %f') == '%H 000005'
+
+    def test_format_cache(self):
+        parsed = []
+        def parse(format_str):
+            parsed.append(format_str)
+            return format_str.upper()
+        cache = virtualtime.alt_time_funcs.FormatCache(parse, maxsize=2)
+        assert cache.get('a') == 'A'
+        assert cache.get('b') == 'B'
+        assert cache.get('a') == 'A'
+        assert cache.get('c') == 'C'
+        assert cache.get('a') == 'A'
+        assert cache.get('b') == 'B'
+        assert parsed == ['a', 'b', 'c', 'b']
+
+class TestFallbackClock(object):
+    """Tests the fallbacks used to read the clock when datetime functions hit import lock errors"""
+    def check_close(self, dt, expected):
+        assert abs(dt - expected) < datetime.timedelta(seconds=1)
+
+    def test_fallback_clock(self):
+        alt_time_funcs = virtualtime.alt_time_funcs
+        self.check_close(alt_time_funcs.alt_get_local_datetime(), virtualtime._underlying_datetime_type.now())
+        self.check_close(alt_time_funcs.alt_get_utc_datetime(), virtualtime._underlying_datetime_utcnow())
+        london = pytz.timezone('Europe/London')
+        london_now = alt_time_funcs.alt_get_local_datetime(london)
+        assert london_now.tzinfo.zone == 'Europe/London'
+        self.check_close(london_now, virtualtime._underlying_datetime_type.now(pytz.utc))
+
+    if sys.platform.startswith('linux'):
+        def test_gettimeofday_clock(self):
+            """The clock used where Python doesn't provide clock_gettime"""
+            alt_time_funcs = virtualtime.alt_time_funcs
+            seconds, microseconds = alt_time_funcs._realtime()
+            for n in range(2):
+                gettimeofday_seconds, gettimeofday_microseconds = alt_time_funcs._gettimeofday_realtime()
+                assert 0 <= gettimeofday_seconds - seconds <= 1 and 0 <= gettimeofday_microseconds < 1000000
+
 class TestTimeNotification(RunPatched):
     """Tests the different notification events that happen when virtualtime is adjusted"""
     def test_notify_on_change(self):
@@ -285,6 +451,27 @@ class TestTimeNotification(RunPatched):
         restore_time = virtualtime._original_time()
         assert restore_time - set_time < 0.1
 
+    def test_offset_generation(self):
+        """Each way of changing the offset moves the generation on exactly once"""
+        generation = virtualtime._offset_generation
+        virtualtime.set_offset(1)
+        virtualtime.set_time(virtualtime._original_time() + 10)
+        virtualtime.restore_time()
+        assert virtualtime._offset_generation == generation + 3
+        assert not virtualtime.in_skip_time_change()
+
+    def test_change_logging_configures_logging(self):
+        """Offset changes are logged with logging.log, which sets up logging if nothing else has"""
+        configured = []
+        handlers, basic_config = logging.root.handlers, logging.basicConfig
+        logging.root.handlers = []
+        logging.basicConfig = lambda **kwargs: configured.append(kwargs)
+        try:
+            virtualtime.set_offset(1)
+        finally:
+            logging.root.handlers, logging.basicConfig = handlers, basic_config
+        assert configured == [{}]
+
     def callback_thread(self):
         """Repeatedly sets the target event whilst recording the offsets"""
         while not self.callback_stop:
@@ -401,6 +588,164 @@ class TestDisabledVirtualTime(VirtualTimeBase, RunUnpatched):
 class TestVirtualTime(VirtualTimeBase, RunPatched):
     """Tests that virtual time functions have no effect when VirtualTime is disabled"""
 
+class TestCachedVirtualTime(VirtualTimeBase, RunPatched):
+    """Tests virtual time functions with the per-second time cache enabled"""
+    @classmethod
+    def setup_class(cls):
+        super(TestCachedVirtualTime, cls).setup_class()
+        virtualtime.enable_time_cache()
+
+    @classmethod
+    def teardown_class(cls):
+        virtualtime.disable_time_cache()
+        super(TestCachedVirtualTime, cls).teardown_class()
+
+    def test_cached_values(self):
+        """Results are reused within a second, and match the uncached functions"""
+        virtualtime.set_time(1400000000.25)
+        first = time.localtime()
+        assert time.localtime() is first
+        assert time.strftime("%Y-%m-%d %H:%M:%S") is time.strftime("%Y-%m-%d %H:%M:%S")
+        assert time.asctime() is time.ctime()
+        assert first[:6] == virtualtime._original_localtime(virtualtime._virtual_time())[:6]
+        assert time.asctime() == virtualtime._original_asctime(first)
+        assert time.strftime("%Y-%m-%d %H:%M:%S %Z") == virtualtime._original_strftime("%Y-%m-%d %H:%M:%S %Z", first)
+
+    def test_offset_change(self):
+        virtualtime.set_time(1400000000.25)
+        before = time.strftime("%Y-%m-%d")
+        virtualtime.set_offset(virtualtime.get_offset() + 86400)
+        assert time.strftime("%Y-%m-%d") != before
+        virtualtime.set_offset(virtualtime.get_offset() - 86400)
+        assert time.strftime("%Y-%m-%d") == before
+
+class TestAdaptivePatching(RunPatched):
+    """Tests virtual time with adaptive patching enabled"""
+    @classmethod
+    def setup_class(cls):
+        super(TestAdaptivePatching, cls).setup_class()
+        virtualtime.enable_adaptive_patching()
+
+    @classmethod
+    def teardown_class(cls):
+        virtualtime.disable_adaptive_patching()
+        super(TestAdaptivePatching, cls).teardown_class()
+
+    def test_time(self):
+        """Functions looked up on the time module as they are called follow the offset"""
+        real = virtualtime._original_time()
+        virtualtime.set_offset(3600)
+        assert 3600 <= time.time() - real < 3601
+        assert time.localtime()[:6] == virtualtime._original_localtime(virtualtime._virtual_time())[:6]
+        virtualtime.restore_time()
+        assert 0 <= time.time() - real < 1
+
+    def test_raw_while_zero(self):
+        """The original functions are in place while the offset is zero, apart from time.sleep"""
+        virtualtime.restore_time()
+        assert time.time is virtualtime._original_time
+        assert time.strftime is virtualtime._original_strftime
+        assert time.sleep is virtualtime._virtual_sleep
+        assert datetime.datetime.now == virtualtime._virtual_datetime_now
+        assert virtualtime.enabled()
+        assert virtualtime.enabled(verify=True)
+        virtualtime.set_offset(3600)
+        assert time.time is virtualtime._virtual_time
+        assert virtualtime.enabled(verify=True)
+        virtualtime.set_time(virtualtime._original_time())
+        assert time.time is virtualtime._virtual_time
+        virtualtime.restore_time()
+        assert time.time is virtualtime._original_time
+
+    def test_notification(self):
+        """Changes are still notified when the overlays come and go"""
+        event = threading.Event()
+        virtualtime.notify_on_change(event)
+        try:
+            virtualtime.restore_time()
+            event.clear()
+            virtualtime.set_offset(60)
+            assert event.is_set()
+            event.clear()
+            virtualtime.restore_time()
+            assert event.is_set()
+        finally:
+            virtualtime.undo_notify_on_change(event)
+
+    def test_reenable(self):
+        virtualtime.restore_time()
+        virtualtime.disable()
+        assert time.time is virtualtime._original_time
+        assert time.sleep is virtualtime._original_sleep
+        assert not virtualtime.enabled(verify=True)
+        virtualtime.enable()
+        assert time.time is virtualtime._original_time
+        assert time.sleep is virtualtime._virtual_sleep
+        assert virtualtime.enabled(verify=True)
+
+    def test_timezone_change(self):
+        original_tz = os.environ.get('TZ')
+        try:
+            virtualtime.set_time(1400000000.25)
+            os.environ['TZ'] = 'UTC'
+            time.tzset()
+            utc_str = time.strftime("%H:%M %Z")
+            assert utc_str == virtualtime._original_strftime("%H:%M %Z", virtualtime._original_localtime(virtualtime._virtual_time()))
+            os.environ['TZ'] = 'Asia/Kolkata'
+            time.tzset()
+            local_str = time.strftime("%H:%M %Z")
+            assert local_str == virtualtime._original_strftime("%H:%M %Z", virtualtime._original_localtime(virtualtime._virtual_time()))
+            assert local_str != utc_str
+        finally:
+            if original_tz is None:
+                os.environ.pop('TZ', None)
+            else:
+                os.environ['TZ'] = original_tz
+            time.tzset()
+
+class TestVirtualDate(RunPatched):
+    """Tests datetime.date.today() under virtual time, and the memoized today() of virtual_date"""
+    def test_today(self):
+        real_today = virtualtime._underlying_date_type.today()
+        for date_type in (datetime.date, virtualtime.virtual_date):
+            assert date_type.today() == real_today
+            virtualtime.set_offset(3 * 86400)
+            assert date_type.today() == real_today + datetime.timedelta(days=3)
+            assert date_type.today() == datetime.datetime.now().date()
+            virtualtime.restore_time()
+            assert date_type.today() == real_today
+
+    def test_memoized(self):
+        first = virtualtime.virtual_date.today()
+        assert virtualtime.virtual_date.today() is first
+        virtualtime.set_offset(0)
+        second = virtualtime.virtual_date.today()
+        assert second == first and second is not first
+
+    def test_midnight(self):
+        """The memoized date expires at local midnight"""
+        virtualtime.set_local_datetime(datetime.datetime(2020, 2, 20, 23, 59, 59, 900000))
+        assert virtualtime.virtual_date.today() == datetime.date(2020, 2, 20)
+        time.sleep(0.2)
+        assert virtualtime.virtual_date.today() == datetime.date(2020, 2, 21)
+
+    def test_date_type(self):
+        """datetime.date is left as the original type, so dates pickle as usual"""
+        assert datetime.date is virtualtime._underlying_date_type
+        for value in (datetime.datetime.now().date(), datetime.date.today(), datetime.date.min, virtualtime.virtual_date.today()):
+            assert type(value) is virtualtime._underlying_date_type
+            assert pickle.loads(pickle.dumps(value)) == value
+
+    def test_virtual_date_type(self):
+        raw_date = virtualtime._underlying_date_type(2020, 2, 20)
+        assert isinstance(raw_date, virtualtime.virtual_date)
+        assert isinstance(datetime.datetime.now(), virtualtime.virtual_date)
+        assert issubclass(virtualtime._underlying_datetime_type, virtualtime.virtual_date)
+        assert virtualtime.virtual_date(2020, 2, 20) == raw_date
+        class date_subclass(virtualtime.virtual_date):
+            pass
+        assert type(date_subclass.today()) is date_subclass
+
 class SleepBase(object):
     def setup_method(self, method):  # This is a wrapper of setUp for py.test (py.test and nose take different method setup methods)
         self.setUp()
@@ -535,7 +880,9 @@ class TestFastForward(RunPatched):
         msg_dict['stop'] = True
         event.set()
         catcher_thread.join()
-        assert offsets == list(range(1, 1001)) + [0]
+        assert offsets[:1001] == list(range(1, 1001)) + [0]
+        # depends on how long the stop event takes?
+        assert (not offsets[1001:]) or offsets[1001:] == [0]
 
     @restore_time_after
     def test_fast_forward_datetime_style(self):
@@ -607,6 +954,71 @@ class TestFastForward(RunPatched):
         assert completion_time - start_time < 0.2
         assert delay_event.is_set()
 
+    @restore_time_after
+    def test_background_fast_forward(self):
+        """Test that a background fast forward can be paused, resumed and monitored"""
+        handle = virtualtime.start_fast_forward_time(10, step_wait=0.05)
+        virtualtime._original_sleep(0.12)
+        handle.pause()
+        virtualtime._original_sleep(0.1)
+        paused_offset = virtualtime._time_offset
+        assert 0 < paused_offset < 10
+        assert handle.paused and not handle.done()
+        virtualtime._original_sleep(0.1)
+        assert virtualtime._time_offset == paused_offset == handle.current_offset
+        assert handle.steps_done == paused_offset
+        assert handle.remaining_steps == 10 - paused_offset
+        assert handle.steps_per_second > 0 and handle.eta > 0
+        handle.resume()
+        assert handle.join(5)
+        assert virtualtime._time_offset == 10
+        assert handle.steps_done == 10 and handle.remaining_steps == 0 and handle.eta == 0
+        assert handle.error is None
+
+    @restore_time_after
+    def test_background_fast_forward_cancel(self):
+        """Test that cancelling a background fast forward leaves the offset where it reached"""
+        handle = virtualtime.start_fast_forward_time(100, step_wait=0.02)
+        virtualtime._original_sleep(0.1)
+        handle.cancel()
+        assert handle.join(5)
+        assert handle.cancelled
+        assert 0 < virtualtime._time_offset < 100
+        assert virtualtime._time_offset == handle.current_offset == handle.steps_done
+
+    @restore_time_after
+    def test_background_fast_forward_controller(self):
+        """Test that a controller can change the step size while the fast forward continues"""
+        offsets = []
+        def controller(handle):
+            offsets.append(handle.current_offset)
+            if handle.current_offset >= 3:
+                handle.set_step_size(2.5)
+        handle = virtualtime.start_fast_forward_time(10.5, step_wait=0.001, controller=controller, control_interval=0)
+        assert handle.join(5)
+        assert offsets[:3] == [1.0, 2.0, 3.0]
+        assert offsets[3:] == [5.5, 8.0, 10.5]
+        assert virtualtime._time_offset == 10.5
+        assert handle.steps_done == 6
+
+class TestConstruction(object):
+    """Tests the datetime subclass constructors, and that the import lock fallbacks are only installed where needed"""
+    def test_construction(self):
+        raw = virtualtime.raw_datetime(2020, 2, 20, 20, 20, 20, 2020, pytz.utc)
+        dt = datetime.datetime(raw)
+        assert type(dt) is datetime.datetime
+        assert dt == raw and dt.tzinfo is pytz.utc
+        assert pickle.loads(pickle.dumps(dt)) == dt
+        assert type(pickle.loads(pickle.dumps(dt))) is datetime.datetime
+        assert type(virtualtime.date_no_importerror(datetime.date(2020, 2, 20))) is virtualtime.date_no_importerror
+
+    def test_fallbacks_installed(self):
+        if virtualtime._import_lock_errors_possible:
+            assert 'timetuple' in virtualtime.datetime.__dict__
+        else:
+            assert 'timetuple' not in virtualtime.datetime.__dict__
+            assert 'strftime' not in virtualtime.time_no_importerror.__dict__
+
 class TestInheritance(object):
     """Tests how detection of inheritance works for datetime classes"""
     def setup_method(self, method):  # This is a wrapper of setUp for py.test (py.test and nose take different method setup methods)
@@ -786,3 +1198,14 @@ class TestVirtualDatetimeOffset:
         print (dt,"\t", dt1)
         return (dt - dt1) < datetime.timedelta(seconds=1)
 
+class TestImportCost(object):
+    """Guards the cost of importing virtualtime, which short-lived tools pay on every start"""
+    def test_deferred_imports(self):
+        """Optional and slow-to-import modules aren't imported until they are needed"""
+        deferred = ['asyncio', 'calendar', 'numpy', 'pandas']
+        assert outside("[name for name in %r if name in sys.modules]" % (deferred,), "virtualtime") == []
+
+    @attr('long_running')
+    def test_import_time_budget(self):
+        from virtualtime import benchmarks
+        assert benchmarks._import_seconds("import virtualtime") < benchmarks.IMPORT_TIME_BUDGET
@@ -0,0 +1,70 @@
+"""Traces where the wall clock time of offset changes and fast forwards goes, in the Chrome trace event format.
+
+While tracing, each set_offset (and fast forward step) is recorded as a span, as are the waits within them: for
+wait_for_callback_on_change events (up to MAX_CALLBACK_TIME), for delay_fast_forward_until_set events, and the
+step_wait sleeps between fast forward steps. Spans are recorded on the thread they happen in, and waits name the event
+they waited for, so loading the file into chrome://tracing or Perfetto shows which participant is stalling a run.
+Events are flushed to the file as they complete, in the JSON array format, which trace viewers can read even if the
+process stops before tracing is stopped."""
+
+import json
+import os
+import threading
+import time
+import virtualtime
+
+# a clock for durations, unaffected by virtual time and by changes to the system clock where possible
+_clock = getattr(time, 'perf_counter', virtualtime._original_time)
+
+class ChromeTracer(object):
+    """Writes complete ('X') trace events to the file at path, timestamped in microseconds"""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w')
+        self._file.write('[\n')
+        self._separator = ''
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._named_threads = set()
+
+    def now(self):
+        return _clock()
+
+    def _write(self, event):
+        # called with the lock held
+        self._file.write(self._separator + json.dumps(event))
+        self._separator = ',\n'
+
+    def complete(self, name, start, args=None):
+        """Records a span of the given name, from start (a value of now()) until now, on the current thread"""
+        end = _clock()
+        thread = threading.current_thread()
+        event = {"name": name, "ph": "X", "pid": self._pid, "tid": thread.ident, "ts": start * 1000000, "dur": (end - start) * 1000000}
+        if args:
+            event["args"] = args
+        with self._lock:
+            if self._file is None:
+                return
+            if thread.ident not in self._named_threads:
+                self._named_threads.add(thread.ident)
+                self._write({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": thread.ident, "args": {"name": thread.name}})
+            self._write(event)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.write('\n]\n')
+                self._file.close()
+                self._file = None
+
+def start_tracing(path):
+    """Starts tracing offset changes and fast forwards to the file at path, replacing any tracing already in progress"""
+    stop_tracing()
+    virtualtime._tracer = ChromeTracer(path)
+
+def stop_tracing():
+    """Stops tracing, and completes the trace file"""
+    tracer, virtualtime._tracer = virtualtime._tracer, None
+    if tracer is not None:
+        tracer.close()
@@ -0,0 +1,137 @@
+"""Opt-in virtual "now" for the pandas and NumPy entry points that read the clock themselves.
+
+pandas computes Timestamp.now(), Timestamp('now'), Timestamp.utcnow() and to_datetime('now') from the C-level
+datetime type, so they ignore the virtual time offset even when virtualtime is enabled. patch_pandas() replaces
+pandas.Timestamp and pandas.to_datetime with versions that add the offset, in the same way as the virtual
+datetime.now() does, including for 'now' values in lists, arrays, Series and Indexes passed to to_datetime. Timestamps created by pandas itself are still instances of the patched pandas.Timestamp.
+Code that imported Timestamp or to_datetime from pandas before patching keeps the originals.
+
+NumPy's datetime64 is a C scalar type whose parsing of 'now' can't be intercepted, so datetime64_now() is provided
+as the virtual equivalent of numpy.datetime64('now')."""
+
+import virtualtime
+
+_NOW_STRINGS = ('now', 'today')
+# the dtype kinds of arrays, Series and Indexes that can hold 'now' strings
+_STRING_KINDS = ('O', 'U')
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+_original_timestamp = None
+_original_to_datetime = None
+
+def _is_now_string(value):
+    return isinstance(value, _string_types) and value.strip().lower() in _NOW_STRINGS
+
+def _offset_timedelta():
+    # pandas Timestamps and DatetimeIndexes can have a datetime.timedelta added, so pandas isn't needed for this
+    return virtualtime._original_datetime_module.timedelta(seconds=virtualtime._time_offset)
+
+def _replace_now_strings(arg, now):
+    """returns arg with its 'now' and 'today' values replaced by now, for lists, tuples, and object or string arrays,
+    Series and Indexes; or arg itself if it has none"""
+    if isinstance(arg, (list, tuple)):
+        if not any(_is_now_string(value) for value in arg):
+            return arg
+        return type(arg)(now if _is_now_string(value) else value for value in arg)
+    if getattr(getattr(arg, 'dtype', None), 'kind', None) not in _STRING_KINDS:
+        return arg
+    # Series and Indexes iterate over their values, and ndarrays are flattened first so that every dimension is handled
+    values = list(arg.ravel() if hasattr(arg, 'reshape') and not hasattr(arg, 'name') else arg)
+    if not any(_is_now_string(value) for value in values):
+        return arg
+    values = [now if _is_now_string(value) else value for value in values]
+    if not hasattr(arg, 'name'):
+        import numpy
+        replaced = numpy.empty(len(values), dtype=object)
+        replaced[:] = values
+        return replaced.reshape(arg.shape)
+    if hasattr(arg, 'index'):
+        return type(arg)(values, index=arg.index, name=arg.name, dtype=object)
+    return type(arg)(values, name=arg.name, dtype=object)
+
+def _build_virtual_timestamp(original_timestamp):
+    """creates a subclass of pandas.Timestamp that virtualizes the current time, and still matches all Timestamp instances"""
+    class VirtualTimestampType(type(original_timestamp)):
+        def __instancecheck__(cls, instance):
+            return isinstance(instance, original_timestamp)
+
+        def __subclasscheck__(cls, subclass):
+            return issubclass(subclass, original_timestamp)
+
+    def __new__(cls, *args, **kwargs):
+        ts = original_timestamp(*args, **kwargs)
+        if virtualtime._time_offset and _is_now_string(args[0] if args else kwargs.get('ts_input')):
+            ts = ts + _offset_timedelta()
+        return ts
+
+    def now(cls, tz=None):
+        """Virtualized pandas.Timestamp.now()"""
+        ts = original_timestamp.now(tz)
+        return ts + _offset_timedelta() if virtualtime._time_offset else ts
+
+    def today(cls, tz=None):
+        """Virtualized pandas.Timestamp.today()"""
+        ts = original_timestamp.today(tz)
+        return ts + _offset_timedelta() if virtualtime._time_offset else ts
+
+    def utcnow(cls):
+        """Virtualized pandas.Timestamp.utcnow()"""
+        ts = original_timestamp.utcnow()
+        return ts + _offset_timedelta() if virtualtime._time_offset else ts
+
+    # calling the metaclass directly works the same way on Python 2 and 3
+    return VirtualTimestampType(original_timestamp.__name__, (original_timestamp,), {
+        '__doc__': "Virtualized pandas.Timestamp",
+        '__module__': original_timestamp.__module__,
+        '__new__': __new__,
+        'now': classmethod(now),
+        'today': classmethod(today),
+        'utcnow': classmethod(utcnow),
+    })
+
+def _build_virtual_to_datetime(original_to_datetime, original_timestamp):
+    def to_datetime(arg, *args, **kwargs):
+        """Virtualized pandas.to_datetime(), which adds the virtual time offset to 'now' and 'today' values"""
+        if not virtualtime._time_offset:
+            return original_to_datetime(arg, *args, **kwargs)
+        if _is_now_string(arg):
+            return original_to_datetime(arg, *args, **kwargs) + _offset_timedelta()
+        if isinstance(arg, (list, tuple)) or getattr(getattr(arg, 'dtype', None), 'kind', None) in _STRING_KINDS:
+            utc = kwargs.get('utc', False)
+            now = original_timestamp.utcnow() if utc else original_timestamp.now()
+            arg = _replace_now_strings(arg, now + _offset_timedelta())
+        return original_to_datetime(arg, *args, **kwargs)
+    to_datetime.__wrapped__ = original_to_datetime
+    return to_datetime
+
+def patch_pandas():
+    """Patches pandas.Timestamp and pandas.to_datetime to work on virtual time, importing pandas if necessary"""
+    global _original_timestamp, _original_to_datetime
+    import pandas
+    if _original_timestamp is None:
+        _original_timestamp = pandas.Timestamp
+        _original_to_datetime = pandas.to_datetime
+        pandas.Timestamp = _build_virtual_timestamp(_original_timestamp)
+        pandas.to_datetime = _build_virtual_to_datetime(_original_to_datetime, _original_timestamp)
+
+def unpatch_pandas():
+    """Restores the original pandas.Timestamp and pandas.to_datetime"""
+    global _original_timestamp, _original_to_datetime
+    if _original_timestamp is not None:
+        import pandas
+        pandas.Timestamp = _original_timestamp
+        pandas.to_datetime = _original_to_datetime
+        _original_timestamp = _original_to_datetime = None
+
+def pandas_patched():
+    """Returns whether patch_pandas is in effect"""
+    return _original_timestamp is not None
+
+def datetime64_now(unit='s'):
+    """Virtual equivalent of numpy.datetime64('now'), returning the current virtual UTC time with the given unit"""
+    import numpy
+    microseconds = int(round(virtualtime._virtual_time() * 1000000))
+    return numpy.datetime64(microseconds, 'us').astype('datetime64[%s]' % unit)